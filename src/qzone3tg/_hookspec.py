@@ -6,7 +6,9 @@ from tylisten import hookdef
 
 if t.TYPE_CHECKING:
     from aiogram.types import InlineKeyboardButton
-    from aioqzone_feed.type import FeedContent
+    from aioqzone_feed.type import BaseFeed, FeedContent
+
+    from qzone3tg.bot.atom import MsgAtom
 
 
 @hookdef
@@ -17,3 +19,35 @@ def is_uin_blocked(uin: int) -> bool:
 @hookdef
 def inline_buttons(feed: FeedContent) -> InlineKeyboardButton | None:
     return None
+
+
+@hookdef
+def chain_ready(
+    feed: BaseFeed, chain: list[tuple[BaseFeed, list[MsgAtom]]], packed: bool = False
+) -> None:
+    """Called before a feed is sent. :obj:`chain` contains atoms of the feed and its forwardee
+    which are to be sent, in sending order. It is also called before a sent feed is copied into
+    another chat, with its :class:`~qzone3tg.bot.atom.CopyAtom`.
+
+    If :obj:`packed` is True, :obj:`chain` contains text-only feeds which are sent in one digest
+    message, see :func:`~qzone3tg.bot.splitter.digest_atom`.
+
+    .. versionadded:: 0.9.9.dev3
+    """
+
+
+@hookdef
+def atom_sent(atom: MsgAtom, mids: list[int]) -> None:
+    """Called after an atom is sent successfully.
+
+    .. versionadded:: 0.9.9.dev3
+    """
+
+
+@hookdef
+def file_uploaded(ids: dict[str, str]) -> None:
+    """Called after medias are uploaded. :obj:`ids` maps keys of medias, see
+    :func:`~qzone3tg.bot.atom.media_keys`, to their telegram file_id.
+
+    .. versionadded:: 0.9.9.dev3
+    """
@@ -22,7 +22,7 @@ from aiohttp import ClientSession, ClientTimeout
 from aioqzone.api import ConstLoginMan, QrLoginManager, UpLoginManager
 from aioqzone.utils.time import sementic_time
 from aioqzone_feed.api import FeedApi
-from aioqzone_feed.type import FeedContent
+from aioqzone_feed.type import BaseFeed
 from apscheduler.job import Job
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
@@ -31,19 +31,28 @@ from tenacity import RetryError
 from tylisten.futstore import FutureStore
 
 from qzone3tg import AGREEMENT, DISCUSS
+from qzone3tg.app.filter import FeedFilter, FeedRouter
 from qzone3tg.app.storage import StorageMan, StorageMixin
 from qzone3tg.app.storage.loginman import *
+from qzone3tg.app.storage.outbox import PendingAtom
+from qzone3tg.app.storage.seen import FeedKey, MsgKey
 from qzone3tg.bot import ChatId
+from qzone3tg.bot.atom import CopyAtom
+from qzone3tg.bot.cache import MediaCache
 from qzone3tg.bot.queue import SendQueue, all_is_mid
+from qzone3tg.bot.ratelimit import RateLimiter, RateLimitMiddleware
+from qzone3tg.bot.retry import CircuitBreaker, ErrorClass, RetryPolicy
 from qzone3tg.bot.splitter import FetchSplitter
+from qzone3tg.bot.transcode import Transcoder
 from qzone3tg.settings import Settings, WebhookConf
+from qzone3tg.utils.batch import WriteBehind
 
 DISCUSS_HTML = TextLink("Qzone2TG Discussion", url=DISCUSS)
 
 
 class BaseApp(StorageMixin):
     start_time = 0
-    blockset: set[int]
+    feed_filter: FeedFilter
 
     def __init__(
         self,
@@ -67,6 +76,7 @@ class BaseApp(StorageMixin):
     async def __aenter__(self):
         self.client = await ClientSession().__aenter__()
         self.engine = await AsyncEngineFactory.sqlite3(self.conf.bot.storage.database).__aenter__()
+        StorageMan.apply_profile(self.engine, self.conf.bot.storage.profile)
 
         self.init_qzone()
         self.init_gram()
@@ -77,6 +87,11 @@ class BaseApp(StorageMixin):
         return self
 
     async def __aexit__(self, *exc):
+        await self.save_buffer.wait()
+        await self.store.outbox.wait()
+        await self.media_cache.save()
+        if self.transcoder:
+            self.transcoder.close()
         await self.client.__aexit__(*exc)
         await self.engine.dispose()
 
@@ -100,18 +115,55 @@ class BaseApp(StorageMixin):
         conf = self.conf.bot
         assert conf.token
 
-        session = self._init_network()
+        session = self._init_network() or AiohttpSession()
+        # all requests share one budget, and interactive replies go before sending feeds
+        self.limiter = RateLimiter(**conf.rate_limit.model_dump())
+        session.middleware(RateLimitMiddleware(self.limiter))
 
         self.dp = Dispatcher()
         self.bot = Bot(conf.token.get_secret_value(), session)
         self.log.debug("init_gram done")
 
     def init_queue(self):
+        retry = self.conf.bot.retry
+        self.router = FeedRouter(self.conf.bot.routes, self.conf.bot.mirrors)
         self.store = StorageMan(self.engine)
+        self.save_buffer = WriteBehind(
+            self.SaveFeeds, store=self.ch_db_write, on_error=self.RollbackFeeds
+        )
+        """Feeds and message ids to be saved. Feeds are saved in batches."""
+        media = self.conf.bot.media
+        self.media_cache = MediaCache(
+            self.client,
+            media.cache_dir,
+            int(media.max_size * 2**20),
+            media.keepdays,
+            budget=int(media.budget * 2**20),
+        )
+        self.transcoder = None
+        if media.transcode:
+            if Transcoder.available():
+                self.transcoder = Transcoder(self.media_cache, media.transcode_workers)
+            else:
+                self.log.warning("Pillow 未安装，图片压缩功能禁用")
         self.queue = SendQueue(
             self.bot,
-            FetchSplitter(self.client),
+            FetchSplitter(
+                self.client, self.media_cache, sniff=media.sniff, transcoder=self.transcoder
+            ),
             defaultdict(lambda: self.admin),
+            max_lanes=self.conf.bot.max_lanes,
+            window=self.conf.bot.stream_window,
+            policy=RetryPolicy(
+                {ErrorClass.NETWORK: retry.network, ErrorClass.PAYLOAD: retry.payload},
+                backoff=retry.backoff,
+                max_backoff=retry.max_backoff,
+            ),
+            breaker=CircuitBreaker(retry.breaker_threshold, retry.breaker_cooldown),
+            file_ids=self.store.file_ids.ids,
+            router=self.router.route if self.router else None,
+            digest=self.conf.bot.digest,
+            prefetch=media.prefetch,
         )
 
     def init_timers(self):
@@ -132,10 +184,31 @@ class BaseApp(StorageMixin):
 
         # clean database
         async def clean():
-            await self.store.clean(-self.conf.bot.storage.keepdays * 86400)
+            start = time()
+            keep = -self.conf.bot.storage.keepdays * 86400
+            n_feed, n_msg = await self.store.clean(keep)
+            n_file = await self.store.file_ids.clean(keep)
+            n_media = await self.media_cache.clean()
+            self.log.info(
+                f"数据库清理完成：删除{n_feed}条说说、{n_msg}条消息、{n_file}个文件缓存、"
+                f"{n_media}个媒体缓存，"
+                f"耗时{time() - start:.2f}秒"
+            )
 
         self.timers["cl"] = self.scheduler.add_job(clean, "interval", days=1, id="clean")
 
+        # checkpoint WAL
+        profile = self.conf.bot.storage.profile
+        if profile.journal_mode == "WAL" and profile.checkpoint_interval > 0:
+
+            async def checkpoint():
+                busy, wal, done = await self.store.checkpoint()
+                self.log.debug(f"WAL checkpoint: busy={busy}, log={wal}, checkpointed={done}")
+
+            self.timers["ck"] = self.scheduler.add_job(
+                checkpoint, "interval", minutes=profile.checkpoint_interval, id="checkpoint"
+            )
+
         async def lst_forever():
             self.log.info(self._status_dict(debug=True))
 
@@ -319,7 +392,8 @@ class BaseApp(StorageMixin):
 
         tasks = [
             qe.auto_update(),
-            self.store.create(),
+            self.store.create(default_chat_id=self.admin),
+            self.media_cache.load(),
         ]
 
         if first_run:
@@ -328,6 +402,7 @@ class BaseApp(StorageMixin):
             tasks.append(self.login.load_cached_cookie())
 
         await asyncio.wait([asyncio.ensure_future(i) for i in tasks])
+        await self._resume_outbox()
 
         self.log.info("启动所有定时器")
         self.scheduler.resume()
@@ -385,11 +460,15 @@ class BaseApp(StorageMixin):
         if (t := err_msg.render()) and t[0]:
             await self.bot.send_message(to, text=t[0], entities=t[1])
 
-        if got <= 0:
+        if got == 0 or got < 0 and self.queue.window is None:
             return
 
         # wait for all hook to finish
         await self.qzone.wait()
+        if got < 0:
+            # In streaming mode, feeds fetched before the error may have been sent.
+            # Send the rest of them and save all.
+            return await self._send_save()
         got -= self.queue.drop_num
         if got <= 0:
             if not is_period:
@@ -424,24 +503,87 @@ class BaseApp(StorageMixin):
         """wrap `.queue.send_all` with some post-sent database operation."""
 
         # forward
-        def _post_sent(task: asyncio.Future[None], feed: FeedContent) -> None:
+        def _post_sent(task: asyncio.Future[None], key: FeedKey) -> None:
+            slot = self.queue.slots[key]
+            feed = slot.feed
             if e := task.exception():
+                self.ch_db_write.add_awaitable(self.store.outbox.discard([key]))
                 return self.log.error(f"发送feed时出现错误：{feed}", exc_info=e)
 
-            mids = self.queue.feed_state[feed]
+            mids = slot.state
             if not mids:
+                self.ch_db_write.add_awaitable(self.store.outbox.discard([key]))
                 return self.log.error(f"feed似乎未发送，请检查日志. fid={feed.fid}")
             assert all_is_mid(mids)
-            self.ch_db_write.add_awaitable(self.SaveFeed(feed, mids))
+            msgs: list[MsgKey] = []
+            # message ids of each destination are recorded separately
+            for chat_id, m in [(slot.chat_id, mids), *slot.copied.items()]:
+                assert isinstance(chat_id, int)
+                if not slot.packed:
+                    # a digest message is shared, it is looked up with the label of the feed
+                    self.cache_mids(feed, chat_id, m)
+                msgs.extend((chat_id, mid) for mid in m)
+            self.store.seen.set(key, True)
+            self.save_buffer.push(key, (feed, msgs, slot.packed))
 
         feed_send = self.queue.send_all()
-        for feed, t in feed_send.items():
-            t.add_done_callback(partial(_post_sent, feed=feed))
-            if isinstance(feed.forward, FeedContent):
-                t.add_done_callback(partial(_post_sent, feed=feed.forward))
+        for key, t in feed_send.items():
+            t.add_done_callback(partial(_post_sent, key=key))
+            if (fwd := self.queue.slots[key].forward) is not None:
+                t.add_done_callback(partial(_post_sent, key=fwd.key))
 
         await asyncio.wait(feed_send.values())
 
+    async def _resume_outbox(self):
+        """Send atoms left in :obj:`StorageMan.outbox` by the last run, and save their message ids.
+
+        .. versionadded:: 0.9.9.dev3
+        """
+        chains = await self.store.outbox.pending()
+        if not chains:
+            return
+        self.log.info(f"恢复发送上次未完成的{len(chains)}条说说")
+
+        async def resume(chain: list[PendingAtom]):
+            head = chain[-1].feed
+            key = (head.uin, head.abstime)
+            if chain[0].line:
+                # feeds of a digest share one message
+                digest = [(p.atom, p.mids) for p in chain]
+                mids = await self.queue.send_digest(digest, key)  # type: ignore
+                r = [mids] * len(chain)
+            else:
+                # copies do not reply to each other
+                reply = not all(isinstance(p.atom, CopyAtom) for p in chain)
+                r = await self.queue.send_chain([(p.atom, p.mids) for p in chain], key, reply)
+            items: dict[FeedKey, tuple[BaseFeed, list[MsgKey], int]] = {}
+            for p, mids in zip(chain, r):
+                chat_id = p.atom.kwds["chat_id"]
+                items.setdefault((p.feed.uin, p.feed.abstime), (p.feed, [], p.line))[1].extend(
+                    (chat_id, mid) for mid in mids
+                )
+            return items
+
+        # chains in one chat are sent in order
+        lanes: dict[ChatId, list[list[PendingAtom]]] = defaultdict(list)
+        for chain in chains:
+            lanes[chain[0].atom.kwds["chat_id"]].append(chain)
+
+        async def lane(chains: list[list[PendingAtom]]):
+            return [await resume(c) for c in chains]
+
+        items: dict[FeedKey, tuple[BaseFeed, list[MsgKey], int]] = {}
+        for r in await asyncio.gather(*(lane(i) for i in lanes.values())):
+            for i in r:
+                # a feed may be resumed in several chats
+                for key, (feed, msgs, line) in i.items():
+                    items.setdefault(key, (feed, [], line))[1].extend(msgs)
+
+        await self.SaveFeeds({k: v for k, v in items.items() if v[1]})
+        if failed := [k for k, v in items.items() if not v[1]]:
+            self.log.error(f"{len(failed)}条说说恢复发送失败")
+            await self.store.outbox.discard(failed)
+
     async def license(self, to: ChatId):
         LICENSE_TEXT = f"""继续使用即代表您同意<a href="{AGREEMENT}">用户协议</a>。"""
         await self.bot.send_message(to, LICENSE_TEXT)
@@ -469,11 +611,21 @@ class BaseApp(StorageMixin):
                 self.dp._stopped_signal and not self.dp._stopped_signal.is_set()
             )
         if debug:
-            pass  # TODO: what can we add?
+            seen = self.store.seen
+            stat_dic["已发送索引"] = f"{len(seen)}条，命中{seen.hits}，未命中{seen.misses}"
+            mc = self.media_cache
+            stat_dic["媒体缓存"] = (
+                f"{len(mc)}个，{mc.size / 2**20:.1f}MB，命中{mc.hits}，未命中{mc.misses}，"
+                f"节省{mc.bytes_saved / 2**20:.1f}MB"
+            )
         return stat_dic
 
     async def status(self, to: ChatId, *, debug: bool = False):
         stat_dic = self._status_dict(debug=debug, hf=True)
+        if debug:
+            stat_dic.update(
+                (f"PRAGMA {k}", str(v)) for k, v in (await self.store.pragmas()).items()
+            )
         statm = as_marked_list(*(as_key_value(k, v) for k, v in stat_dic.items()))
         await self.bot.send_message(to, **statm.as_kwargs(), disable_notification=debug)
 
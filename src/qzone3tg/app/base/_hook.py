@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import asyncio
 from typing import TYPE_CHECKING
 
 from aiogram.utils.formatting import Pre, Text
@@ -33,39 +34,62 @@ def add_up_impls(self: BaseApp):
 def add_feed_impls(self: BaseApp):
     from aioqzone_feed.type import BaseFeed
 
-    from ..storage.orm import FeedOrm, MessageOrm
+    from qzone3tg.utils.batch import MicroBatcher
+
+    from ..filter import FeedFilter
+    from ..storage.orm import FeedOrm
 
     block = set(self.conf.qzone.block or ())
     if self.conf.qzone.block_self:
         block.add(self.conf.qzone.uin)
-    self.blockset = block
+    self.feed_filter = FeedFilter(self.conf.qzone.filters, uins=block)
+
+    mid_batcher = MicroBatcher(self.store.get_mids_many)
 
-    async def get_mids(feed: BaseFeed) -> list[int]:
-        """Get a list of message id from storage.
+    async def get_mids(feed: BaseFeed) -> list[tuple[int, int]]:
+        """Get a list of message id from storage. Feeds not yet flushed from
+        :obj:`~BaseApp.save_buffer` are read from the buffer. Lookups of concurrently processed
+        feeds are batched into one query by :class:`MicroBatcher`.
 
         :param feed: feed
-        :return: the list of message id associated with this feed, or None if not found.
+        :return: the list of ``(chat_id, mid)`` associated with this feed, may be empty.
         """
-        r = await self.store.get_msg_orms(*MessageOrm.fkey(feed))
-        return [i.mid for i in r]
+        key = (feed.uin, feed.abstime)
+        if (unsaved := self.save_buffer.peek(key)) is not None:
+            return unsaved[1] or []
+        return await mid_batcher.get(key)
+
+    async def no_mids() -> list[tuple[int, int]]:
+        return []
 
     @self.qzone.feed_processed.add_impl
     async def FeedProcEnd(bid: int, feed: FeedContent):
         self.log.debug(f"bid={bid}: {feed}")
+        if self.feed_filter.match(feed):
+            self.log.info(f"Filter hit: {feed.uin}({feed.nickname})")
+            return await FeedDropped(bid, feed)
         if any(await self.is_uin_blocked.results(feed.uin)):
             self.log.info(f"Blocklist hit: {feed.uin}({feed.nickname})")
             return await FeedDropped(bid, feed)
 
-        await self.ch_db_write.wait()
-        if feed_mids := await get_mids(feed):
+        # the forwardee is looked up in the same batch
+        feed_mids, forward_mids = await asyncio.gather(
+            get_mids(feed),
+            get_mids(feed.forward) if isinstance(feed.forward, FeedContent) else no_mids(),
+        )
+        if feed_mids:
             self.log.info(f"Feed {feed.fid} is sent before. Skipped.", extra=dict(feed=feed))
             self.log.debug(f"mids={feed_mids}")
-        else:
-            self.queue.add(
-                bid,
-                feed,
-                await get_mids(feed.forward) if isinstance(feed.forward, FeedContent) else None,
-            )
+            return
+        if not forward_mids:
+            return self.queue.add(bid, feed)
+        # the forwardee is sent to the same chats as the feed, so that it can be replied to
+        by_chat: dict[int, list[int]] = {}
+        for c, mid in forward_mids:
+            by_chat.setdefault(c, []).append(mid)
+        chat_id, *copies = self.queue.route(feed)
+        copied = {c: by_chat[c] for c in copies if c in by_chat}
+        self.queue.add(bid, feed, by_chat.get(chat_id), copied)  # type: ignore
 
     @self.qzone.feed_dropped.add_impl
     async def FeedDropped(bid: int, feed):
@@ -74,11 +98,13 @@ def add_feed_impls(self: BaseApp):
 
     @self.qzone.stop_fetch.add_impl
     async def StopFeedFetch(feed: FeedData | ProfileFeedData) -> bool:
-        return await self.store.exists(*FeedOrm.primkey(feed))
+        return FeedOrm.key(feed) in self.store.seen
 
-    @self.is_uin_blocked.add_impl
-    def in_blockset(uin: int):
-        return uin in self.blockset
+    # persist atoms before sending, so that sending can resume after restart
+    self.queue.chain_ready.add_impl(self.store.outbox.put)
+    self.queue.atom_sent.add_impl(self.store.outbox.ack)
+    # medias uploaded once are sent by file_id later
+    self.queue.file_uploaded.add_impl(self.store.file_ids.put)
 
 
 def add_hb_impls(self: BaseApp):
@@ -0,0 +1,157 @@
+"""This module filters feeds by :class:`~qzone3tg.settings.FilterRule`, and routes feeds by
+:class:`~qzone3tg.settings.RouteRule`.
+
+.. versionadded:: 0.9.9.dev3
+"""
+
+import re
+from bisect import bisect_right
+from typing import Iterable, Sequence
+
+from aioqzone.model import AtEntity, LinkEntity, TextEntity
+from aioqzone_feed.type import BaseFeed, FeedContent
+
+from qzone3tg.settings import FilterRule, RouteRule
+
+SEP = "\0"
+"""Separator of texts when scanning a batch. Keywords never contain it."""
+
+
+def feed_text(feed: BaseFeed) -> str:
+    """Plain text of a feed which keywords are matched against. Emojis are ignored."""
+    if not isinstance(feed, FeedContent) or not feed.entities:
+        return ""
+    s: list[str] = []
+    for e in feed.entities:
+        match e:
+            case TextEntity():
+                s.append(e.con)
+            case AtEntity():
+                s.append(f"@{e.nick}")
+            case LinkEntity():
+                s.append(e.text)
+    return "".join(s).replace(SEP, "")
+
+
+class _Rule:
+    __slots__ = ("uin", "nickname", "appid", "typeid", "has_keywords")
+
+    def __init__(self, rule: FilterRule) -> None:
+        self.uin = None if rule.uin is None else frozenset(rule.uin)
+        self.nickname = None if rule.nickname is None else re.compile(rule.nickname)
+        self.appid = None if rule.appid is None else frozenset(rule.appid)
+        self.typeid = None if rule.typeid is None else frozenset(rule.typeid)
+        self.has_keywords = bool(rule.keywords)
+
+    def match(self, feed: BaseFeed) -> bool:
+        """Check all conditions except keywords."""
+        return (
+            (self.uin is None or feed.uin in self.uin)
+            and (self.appid is None or feed.appid in self.appid)
+            and (self.typeid is None or feed.typeid in self.typeid)
+            and (self.nickname is None or self.nickname.search(feed.nickname) is not None)
+        )
+
+
+class FeedFilter:
+    """Compiled filter rules.
+
+    Rules with only :obj:`~FilterRule.uin` are merged into one set. Keywords of all rules are
+    compiled into one regex, and texts of a whole batch are scanned in one pass.
+
+    :param rules: filter rules.
+    :param uins: uins to block, same as a rule with only :obj:`~FilterRule.uin`.
+    """
+
+    def __init__(self, rules: Iterable[FilterRule] = (), uins: Iterable[int] = ()) -> None:
+        self.uins = set(uins)
+        self._rules: list[_Rule] = []
+        keywords: dict[str, set[int]] = {}
+        for rule in rules:
+            if rule.uin is not None and rule.model_dump(exclude_none=True).keys() == {"uin"}:
+                self.uins.update(rule.uin)
+                continue
+            for kw in rule.keywords or ():
+                keywords.setdefault(kw, set()).add(len(self._rules))
+            self._rules.append(_Rule(rule))
+
+        # At each position, the regex matches the longest keyword, since longer keywords come first.
+        # Keywords which are prefixes of it match at the same position, so their rules are hit too.
+        self._kw_rules = {
+            kw: frozenset().union(*(r for k, r in keywords.items() if kw.startswith(k)))
+            for kw in keywords
+        }
+        self._kw_re = None
+        if keywords:
+            alt = "|".join(re.escape(k) for k in sorted(keywords, key=len, reverse=True))
+            self._kw_re = re.compile(f"(?=({alt}))")
+
+    def __bool__(self) -> bool:
+        return bool(self.uins or self._rules)
+
+    def _keyword_hits(self, texts: Sequence[str]) -> list[set[int]]:
+        """Scan all texts with one regex search.
+
+        :return: indexes of rules whose keywords appear in each text.
+        """
+        hits: list[set[int]] = [set() for _ in texts]
+        if self._kw_re is None:
+            return hits
+        starts, pos = [], 0
+        for t in texts:
+            starts.append(pos)
+            pos += len(t) + len(SEP)
+        for m in self._kw_re.finditer(SEP.join(texts)):
+            hits[bisect_right(starts, m.start()) - 1].update(self._kw_rules[m.group(1)])
+        return hits
+
+    def match_many(self, feeds: Sequence[BaseFeed]) -> list[bool]:
+        """Check a batch of feeds.
+
+        :return: whether each feed should be dropped.
+        """
+        r = [feed.uin in self.uins for feed in feeds]
+        # rules which passed all conditions except keywords
+        cand: list[list[int]] = [
+            [] if r[i] else [j for j, rule in enumerate(self._rules) if rule.match(feed)]
+            for i, feed in enumerate(feeds)
+        ]
+        for i, rules in enumerate(cand):
+            if any(not self._rules[j].has_keywords for j in rules):
+                r[i] = True
+
+        need_text = [i for i, rules in enumerate(cand) if rules and not r[i]]
+        if need_text:
+            hits = self._keyword_hits([feed_text(feeds[i]) for i in need_text])
+            for i, hit in zip(need_text, hits):
+                r[i] = not hit.isdisjoint(cand[i])
+        return r
+
+    def match(self, feed: BaseFeed) -> bool:
+        """Check if a feed should be dropped."""
+        return self.match_many([feed])[0]
+
+
+class FeedRouter:
+    """Compiled routing rules. A feed is sent to chats of the first rule it matches, or to the
+    default chat if no rule matches. Mirrors receive every feed.
+
+    :param rules: routing rules, checked in order.
+    :param mirrors: chats which every feed is sent to.
+    """
+
+    def __init__(self, rules: Iterable[RouteRule] = (), mirrors: Iterable[int] = ()) -> None:
+        self._rules = [(FeedFilter([rule]), tuple(rule.to)) for rule in rules]
+        self.mirrors = tuple(mirrors)
+
+    def __bool__(self) -> bool:
+        return bool(self._rules or self.mirrors)
+
+    def route(self, feed: BaseFeed, default: int) -> tuple[int, ...]:
+        """Get destinations of a feed, without duplicates.
+
+        :param default: the chat to send to if no rule matches.
+        :return: chat ids, the first of which is where the feed is uploaded.
+        """
+        to = next((to for ff, to in self._rules if ff.match(feed)), (default,))
+        return tuple(dict.fromkeys(to + self.mirrors))
@@ -63,7 +63,7 @@ class InteractApp(BaseApp):
         add_qr_impls(self)
         add_up_impls(self)
         add_button_impls(self)
-        self.is_uin_blocked.add_impl(lambda uin: self.dyn_blockset.contains(uin))
+        self.is_uin_blocked.add_impl(lambda uin: uin in self.dyn_blockset)
 
     async def __aenter__(self):
         await super().__aenter__()
@@ -13,6 +13,7 @@ if TYPE_CHECKING:
 BLOCK_CMD_HELP = as_marked_section(
     Bold("帮助："),
     as_key_value(CommandText("/block"), "根据回复的消息查询 QQ，并将其加入黑名单"),
+    as_key_value(CommandText("/block <序号>"), "回复摘要时，根据其中指定序号的说说查询 QQ"),
     as_key_value(CommandText("/block add <uin>"), "将 uin 加入黑名单"),
     as_key_value(CommandText("/block rm <uin>"), "从黑名单中移除 uin"),
     as_key_value(CommandText("/block list"), Text("列出所有", Bold("动态添加的"), "黑名单 QQ")),
@@ -21,13 +22,15 @@ BLOCK_CMD_HELP = as_marked_section(
 
 async def block(self: InteractApp, message: Message):
     assert message.text
-    match message.text.split()[1:]:
-        case None | []:
+    match args := message.text.split()[1:]:
+        case [] | [_] if not args or args[0].isdigit():
             if message.reply_to_message is None:
                 await message.reply(**BLOCK_CMD_HELP.as_kwargs())
                 return
-            # message id to uin
-            feed = await self.Mid2Feed(message.reply_to_message.message_id)
+            # message id to uin, with the label of the feed if the message is a digest
+            reply = message.reply_to_message
+            line = int(args[0]) if args else None
+            feed = await self.Mid2Feed(reply.chat.id, reply.message_id, line)
             if feed is None:
                 await message.reply("uin not found. Try `/block add <uin>` instead.")
                 return
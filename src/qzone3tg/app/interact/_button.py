@@ -4,7 +4,7 @@ from typing import TYPE_CHECKING
 
 from aiogram import F, Router
 from aiogram.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Message
-from aioqzone.model import EmEntity, LikeData
+from aioqzone.model import EmEntity, LikeData, PersudoCurkey
 
 from .types import MAX_CALLBACK_DATA, SerialCbData
 
@@ -17,7 +17,9 @@ def add_button_impls(self: InteractApp):
 
     @self.queue.inline_buttons.add_impl
     def _comment_markup(feed: FeedContent) -> InlineKeyboardButton | None:
-        cbd = SerialCbData(command="comment")
+        # keyed by feed, since a digest message is shared by several feeds
+        curkey = str(PersudoCurkey(uin=feed.uin, abstime=feed.abstime))
+        cbd = SerialCbData(command="comment", sub_command=curkey)
         return InlineKeyboardButton(text="评论", callback_data=cbd.pack())
 
     @self.queue.inline_buttons.add_impl
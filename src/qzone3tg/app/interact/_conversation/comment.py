@@ -37,6 +37,7 @@ COMMENT_CMD_HELP = as_marked_section(
     as_key_value(CommandText("/comment list"), "查看当前引用说说的评论"),
     as_key_value(CommandText("/comment add <content>"), "回复引用的说说"),
     as_key_value(CommandText("/comment add private <content>"), "私密回复引用的说说"),
+    as_key_value(CommandText("/comment <序号> ..."), "引用摘要时，指定其中的说说"),
 )
 
 
@@ -51,7 +52,7 @@ async def btn_comment(query: CallbackQuery, callback_data: SerialCbData, state:
         return
 
     tasks = [
-        state.update_data(query_message=query.message),
+        state.update_data(query_message=query.message, feed_key=callback_data.sub_command),
         state.set_state(CommentForm.GET_COMMAND),
         query.message.reply(
             **Text("输入命令：", Pre("list"), Pre("add"), Pre("add private")).as_kwargs(),
@@ -117,7 +118,7 @@ async def btn_comment_refresh(
 async def input_content(self: InteractApp, message: Message, state: FSMContext):
     data = await state.get_data()
     feed_message = data["query_message"]
-    await comment_core(self, feed_message, message, message.text, state)
+    await comment_core(self, feed_message, message, message.text, state, data.get("feed_key"))
     with suppress(TelegramBadRequest):
         await message.delete_reply_markup()
 
@@ -137,7 +138,18 @@ async def comment_core(
     trigger_message: Message | None,
     command: str | None,
     state: FSMContext | None = None,
+    feed_key: str | None = None,
+    line: int | None = None,
 ):
+    """
+    :param feed_key: :class:`PersudoCurkey` of the feed, if the message is shared by several
+        feeds, e.g. a digest. Otherwise the feed is looked up by :obj:`feed_message`.
+    :param line: label of the feed if :obj:`feed_message` is a digest.
+
+    .. versionchanged:: 0.9.9.dev3
+
+        Add ``feed_key`` and ``line``.
+    """
     if trigger_message is None:
         trigger_message = feed_message
 
@@ -146,10 +158,18 @@ async def comment_core(
         return
 
     async def query_fid(mid: int):
-        feed = await self.Mid2Feed(mid)
+        if feed_key:
+            feed = await self.store.get_feed_orm(
+                *FeedOrm.primkey(PersudoCurkey.from_str(feed_key))
+            )
+        else:
+            feed = await self.Mid2Feed(feed_message.chat.id, mid, line)
         if not feed:
+            hint = ""
+            if not feed_key and line is None:
+                hint = "若引用的是摘要，请附上说说的序号，如 /comment 2 list"
             await trigger_message.reply(
-                f"未找到该消息，可能已超出 {self.conf.bot.storage.keepdays} 天。"
+                f"未找到该消息，可能已超出 {self.conf.bot.storage.keepdays} 天。{hint}"
             )
             return
         return feed
@@ -231,7 +251,12 @@ async def comment(self: InteractApp, message: Message, command: CommandObject):
             await message.reply(**COMMENT_CMD_HELP.as_kwargs())
         return
 
-    await comment_core(self, feed_message, message, command.args)
+    # the label of the feed if the replied message is a digest
+    args, line = command.args, None
+    match (args or "").split(maxsplit=1):
+        case [n, rest] if n.isdigit():
+            args, line = rest, int(n)
+    await comment_core(self, feed_message, message, args, line=line)
 
 
 command_comment = BotCommand(command="comment", description="查看评论、发评论")
@@ -21,15 +21,28 @@ if TYPE_CHECKING:
     from . import InteractApp
 
 
-async def like_core(self: InteractApp, key: str | int, like=True) -> str | None:
+async def like_core(
+    self: InteractApp, key: str | tuple[int, int, int | None], like=True
+) -> str | None:
+    """
+    :param key: :class:`PersudoCurkey` of the feed, or ``(chat_id, mid, line)`` of its message.
+        ``line`` is the label of the feed if the message is a digest.
+
+    .. versionchanged:: 0.9.9.dev3
+
+        Add ``line`` to the message key.
+    """
+    hint = ""
     match key:
         case str():
             feed = await self.store.get_feed_orm(*FeedOrm.primkey(PersudoCurkey.from_str(key)))
-        case int():
-            feed = await self.Mid2Feed(key)
+        case (int() as chat_id, int() as mid, line):
+            feed = await self.Mid2Feed(chat_id, mid, line)
+            if line is None:
+                hint = "。若回复的是摘要，请附上说说的序号，如 /like 2"
 
     if feed is None:
-        return f"未找到该消息，可能已超出{self.conf.bot.storage.keepdays}天"
+        return f"未找到该消息，可能已超出{self.conf.bot.storage.keepdays}天{hint}"
 
     if feed.unikey is None:
         return "该说说不支持点赞"
@@ -144,7 +157,9 @@ async def like(self: InteractApp, message: Message, command: CommandObject):
         )
         return
 
-    err_msg = await like_core(self, int(reply.message_id))
+    # the label of the feed if the replied message is a digest
+    line = int(command.args) if command.args and command.args.isdigit() else None
+    err_msg = await like_core(self, (reply.chat.id, reply.message_id, line))
     if err_msg is None:
         await message.reply("点赞成功")
     else:
@@ -1,20 +1,124 @@
-import asyncio
+import logging
 from time import time
-from typing import Sequence
+from typing import Iterable, Mapping, Sequence
 
 from aioqzone_feed.type import BaseFeed
 from qzemoji.base import AsyncSessionProvider
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import and_, delete, event, literal_column, select, text, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
 
-from .orm import FeedOrm, MessageOrm
+from qzone3tg.settings import SqliteProfile
+from qzone3tg.utils.cache import LRUCache
+from qzone3tg.utils.iter import split_by_len
+
+from .fileid import FileIdCache
+from .migration import migrate
+from .orm import Base, FeedOrm, MessageOrm, OutboxOrm
+from .outbox import Outbox
+from .seen import MAX_KEYS_PER_QUERY, FeedKey, MsgKey, SeenIndex
+
+FeedMsgs = tuple[BaseFeed, list[MsgKey] | None] | tuple[BaseFeed, list[MsgKey] | None, int]
+"""A feed and its ``(chat_id, mid)`` list. A feed sent in a digest has its label appended, see
+:obj:`.MessageOrm.line`.
+
+.. versionadded:: 0.9.9.dev3
+"""
+CLEAN_CHUNK_SIZE = 500
+"""Max rows deleted in one transaction by :meth:`StorageMan.clean`."""
+AUTO_VACUUM_INCREMENTAL = 2
+"""Value of ``PRAGMA auto_vacuum`` in ``INCREMENTAL`` mode."""
+MID_CACHE_SIZE = 4096
+"""Max number of message ids cached by :obj:`StorageMan.mid_cache`."""
+
+log = logging.getLogger(__name__)
+
+
+def _line(v: FeedMsgs) -> int:
+    return v[2] if len(v) > 2 else 0
+
+
+def enable_foreign_keys(dbapi_conn, _):
+    """SQLite disables foreign key constraints by default, which is a per-connection setting."""
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA foreign_keys = ON")
+    cursor.close()
 
 
 class StorageMan(AsyncSessionProvider):
-    async def create(self):
+    def __init__(self, engine: AsyncEngine) -> None:
+        super().__init__(engine)
+        self.seen = SeenIndex()
+        """Keys of sent feeds. Check this instead of :meth:`.exists` on hot paths."""
+        self.mid_cache: LRUCache[MsgKey, BaseFeed] = LRUCache(MID_CACHE_SIZE)
+        """``(chat_id, mid)`` to feed, used by :meth:`StorageMixin.Mid2Feed`."""
+        self.outbox = Outbox(engine)
+        """Atoms being sent, to resume sending after restart."""
+        self.file_ids = FileIdCache(engine)
+        """Telegram file_id of uploaded medias."""
+        if not event.contains(engine.sync_engine, "connect", enable_foreign_keys):
+            event.listen(engine.sync_engine, "connect", enable_foreign_keys)
+
+    @staticmethod
+    def apply_profile(engine: AsyncEngine, profile: SqliteProfile):
+        """Apply pragmas in :obj:`profile` on every new connection of :obj:`engine`.
+        This should be called before the engine connects to the database.
+        """
+        pragmas = [f"PRAGMA {k} = {v}" for k, v in profile.pragmas().items()]
+
+        @event.listens_for(engine.sync_engine, "connect")
+        def _apply_profile(dbapi_conn, _):
+            cursor = dbapi_conn.cursor()
+            for sql in pragmas:
+                cursor.execute(sql)
+            cursor.close()
+
+    async def pragmas(self) -> dict[str, str | int]:
+        """Get effective pragmas of a connection."""
+        r = {}
+        async with self.engine.connect() as conn:
+            for k in [*SqliteProfile().pragmas(), "foreign_keys", "auto_vacuum"]:
+                r[k] = await conn.scalar(text(f"PRAGMA {k}"))
+        return r
+
+    async def checkpoint(self) -> tuple[int, int, int]:
+        """Checkpoint the WAL file and truncate it.
+
+        :return: ``(busy, log, checkpointed)``, see https://www.sqlite.org/pragma.html#pragma_wal_checkpoint
+        """
+        async with self.engine.connect() as conn:
+            r = (await conn.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))).one()
+        return tuple(r)  # type: ignore
+
+    async def create(self, default_chat_id: int | None = None):
+        """Create tables and migrate the existing database.
+
+        :param default_chat_id: the chat which messages saved by older versions are sent to.
+            It is required if the database is older than version 3.
+        """
+        await self.ensure_incremental_vacuum()
+        await migrate(self.engine, MessageOrm.__tablename__, default_chat_id=default_chat_id)
         async with self.engine.begin() as conn:
             await self._create(FeedOrm, conn)
             await self._create(MessageOrm, conn)
+            await self._create(OutboxOrm, conn)
+        await self.file_ids.create()
+        await self.warm_seen()
+
+    async def warm_seen(self):
+        """Load keys of all sent feeds into :obj:`.seen`."""
+        stmt = (
+            select(FeedOrm.uin, FeedOrm.abstime)
+            .join(
+                MessageOrm,
+                (MessageOrm.uin == FeedOrm.uin) & (MessageOrm.abstime == FeedOrm.abstime),
+            )
+            .distinct()
+        )
+        async with self.sess() as sess:
+            r = await sess.execute(stmt)
+            self.seen.clear()
+            self.seen.update((uin, abstime) for uin, abstime in r)
 
     async def exists(self, *pred) -> bool:
         """check if a feed exists in this database _AND_ it has a message id.
@@ -42,31 +146,85 @@ class StorageMan(AsyncSessionProvider):
             stmt = stmt.where(*where)
         return await sess.scalar(stmt)
 
-    async def get_msg_orms(self, *where, sess: AsyncSession | None = None) -> Sequence[MessageOrm]:
+    async def get_msg_orms(
+        self, *where, chat_id: int | None = None, sess: AsyncSession | None = None
+    ) -> Sequence[MessageOrm]:
         """Get all satisfying orms from ``message`` table, with given criteria.
 
+        :param chat_id: only get messages in this chat, defaults to all chats.
         :return: list of :class:`.MessageOrm`s if exist, else None.
         """
         if sess is None:
             async with self.sess() as newsess:
-                return await self.get_msg_orms(*where, sess=newsess)
+                return await self.get_msg_orms(*where, chat_id=chat_id, sess=newsess)
 
         stmt = select(MessageOrm)
+        if chat_id is not None:
+            where = (*where, MessageOrm.chat_id == chat_id)
         if where:
             stmt = stmt.where(*where)
         r = await sess.scalars(stmt)
         return r.all()
 
-    async def get(self, *pred) -> tuple[BaseFeed, list[int]] | None:
+    async def get_mids_many(
+        self, keys: Iterable[FeedKey], sess: AsyncSession | None = None
+    ) -> dict[FeedKey, list[MsgKey]]:
+        """Get message ids of a batch of feeds. Keys are resolved with one query per
+        :obj:`MAX_KEYS_PER_QUERY` keys instead of one query per feed.
+
+        :param keys: ``(uin, abstime)`` of feeds.
+        :return: a dict mapping every given key to its ``(chat_id, mid)`` list, which may be empty.
+        """
+        if sess is None:
+            async with self.sess() as newsess:
+                return await self.get_mids_many(keys, sess=newsess)
+
+        r: dict[FeedKey, list[MsgKey]] = {k: [] for k in keys}
+        for chunk in split_by_len(list(r), MAX_KEYS_PER_QUERY):
+            stmt = select(
+                MessageOrm.uin, MessageOrm.abstime, MessageOrm.chat_id, MessageOrm.mid
+            ).where(tuple_(MessageOrm.uin, MessageOrm.abstime).in_(chunk))
+            for uin, abstime, chat_id, mid in await sess.execute(stmt):
+                r[(uin, abstime)].append((chat_id, mid))
+        return r
+
+    async def exists_many(
+        self, keys: Iterable[FeedKey], sess: AsyncSession | None = None
+    ) -> set[FeedKey]:
+        """Batched version of :meth:`.exists`.
+
+        :param keys: ``(uin, abstime)`` of feeds.
+        :return: keys of feeds which exist in this database _AND_ have message ids.
+        """
+        if sess is None:
+            async with self.sess() as newsess:
+                return await self.exists_many(keys, sess=newsess)
+
+        r: set[FeedKey] = set()
+        for chunk in split_by_len(list(set(keys)), MAX_KEYS_PER_QUERY):
+            stmt = (
+                select(FeedOrm.uin, FeedOrm.abstime)
+                .join(
+                    MessageOrm,
+                    (MessageOrm.uin == FeedOrm.uin) & (MessageOrm.abstime == FeedOrm.abstime),
+                )
+                .where(tuple_(FeedOrm.uin, FeedOrm.abstime).in_(chunk))
+                .distinct()
+            )
+            r.update((uin, abstime) for uin, abstime in await sess.execute(stmt))
+        return r
+
+    async def get(self, *pred, chat_id: int | None = None) -> tuple[BaseFeed, list[int]] | None:
         """Get a feed and its message ids from database, with given criteria.
         If multiple records satisfy the criteria, returns the first.
 
+        :param chat_id: only get message ids in this chat, defaults to all chats.
         :return: :external:class:`aioqzone_feed.type.BaseFeed` and message ids, optional
         """
         if (orm := await self.get_feed_orm(*pred)) is None:
             return
 
-        orms = await self.get_msg_orms(*MessageOrm.fkey(orm))
+        orms = await self.get_msg_orms(*MessageOrm.fkey(orm), chat_id=chat_id)
         mids = [i.mid for i in orms]
         return (
             BaseFeed(
@@ -75,28 +233,66 @@ class StorageMan(AsyncSessionProvider):
             mids,
         )
 
-    async def clean(self, seconds: float):
+    async def clean(self, seconds: float, chunk: int = CLEAN_CHUNK_SIZE) -> tuple[int, int]:
         """clean feeds out of date, based on `abstime`.
 
+        Rows are deleted by ``DELETE ... WHERE abstime < ?`` statements, each of which removes at most
+        :obj:`chunk` rows in its own transaction. Freed pages are returned to the filesystem by
+        :meth:`.incremental_vacuum` at last.
+
         :param seconds: Timestamp in second, clean the feeds before this time. Means back from now if the value < 0.
-        :return: pending set is empty
+        :param chunk: max rows to delete in one transaction.
+        :return: number of deleted feeds and messages.
+
+        .. versionchanged:: 0.9.9.dev3
+
+            Delete in chunks and return the number of deleted rows.
         """
 
         if seconds <= 0:
             seconds += time()
-        async with self.sess() as sess:
-            async with sess.begin():
-                result = await sess.scalars(select(FeedOrm).where(FeedOrm.abstime < seconds))
-                taskm, taskf = [], []
-                for mo in result:
-                    r = await sess.scalars(select(MessageOrm).where(*MessageOrm.fkey(mo)))
-                    taskm.extend(asyncio.create_task(sess.delete(i)) for i in r)
-                    taskf.append(asyncio.create_task(sess.delete(mo)))
-
-                if taskm:
-                    await asyncio.wait(taskm)
-                if taskf:
-                    await asyncio.wait(taskf)
+        self.seen.evict(seconds)
+        self.mid_cache.evict_if(lambda _, feed: feed.abstime < seconds)
+
+        n_msg = await self._delete_chunked(MessageOrm, MessageOrm.abstime < seconds, chunk)
+        n_feed = await self._delete_chunked(FeedOrm, FeedOrm.abstime < seconds, chunk)
+        if n_msg or n_feed:
+            await self.incremental_vacuum()
+        return n_feed, n_msg
+
+    async def _delete_chunked(self, orm: type[Base], where, chunk: int) -> int:
+        rowid = literal_column("rowid")
+        stmt = delete(orm).where(
+            rowid.in_(select(rowid).select_from(orm).where(where).limit(chunk))
+        )
+        total = 0
+        while True:
+            async with self.engine.begin() as conn:
+                n = (await conn.execute(stmt)).rowcount
+            total += n
+            if n < chunk:
+                return total
+
+    async def ensure_incremental_vacuum(self):
+        """Switch ``auto_vacuum`` of the database to ``INCREMENTAL`` if it is not yet.
+        An existing database must be rebuilt by ``VACUUM`` to change this mode."""
+        async with self.engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            if await conn.scalar(text("PRAGMA auto_vacuum")) == AUTO_VACUUM_INCREMENTAL:
+                return
+            log.warning("rebuilding database with auto_vacuum=INCREMENTAL, this may take a while")
+            start = time()
+            await conn.execute(text("PRAGMA auto_vacuum = INCREMENTAL"))
+            await conn.execute(text("VACUUM"))
+            log.info(f"database rebuilt in {time() - start:.2f}s")
+
+    async def incremental_vacuum(self):
+        """Release free pages of the database file."""
+        async with self.engine.connect() as conn:
+            raw = await conn.get_raw_connection()
+            # A pragma statement only steps once, which frees only one page.
+            # `executescript` runs the statement to the end.
+            await raw.driver_connection.executescript("PRAGMA incremental_vacuum")  # type: ignore
 
 
 class StorageMixin:
@@ -109,67 +305,139 @@ class StorageMixin:
     def sess_maker(self):
         return self.store.sess
 
-    async def _update_message_ids(
-        self,
-        feed: BaseFeed,
-        mids: list[int] | None,
-        sess: AsyncSession | None = None,
-        flush: bool = True,
+    async def SaveFeed(
+        self, feed: BaseFeed, mids: list[int] | None = None, chat_id: int | None = None
     ):
-        if sess is None:
-            async with self.sess_maker() as newsess:
-                await self._update_message_ids(feed, mids, sess=newsess, flush=flush)
-            return
+        """Add/Update an record by the given feed and messages id.
 
-        if flush:
-            await self._update_message_ids(feed, mids, sess=sess, flush=False)
-            await sess.commit()
-            return
+        :param feed: feed
+        :param mids: message id list, defaults to None
+        :param chat_id: the chat which messages are sent to, required if :obj:`mids` is given.
 
-        # query existing mids
-        stmt = select(MessageOrm)
-        stmt = stmt.where(*MessageOrm.fkey(feed))
-        result = await sess.scalars(stmt)
+        .. versionchanged:: 0.9.9.dev3
+
+            Add ``chat_id``.
+        """
+        if mids and chat_id is None:
+            raise ValueError("chat_id is required to save message ids")
+        msgs = [(chat_id, mid) for mid in mids] if mids else None
+        await self.SaveFeeds({(feed.uin, feed.abstime): (feed, msgs)})  # type: ignore
+
+    async def SaveFeeds(self, items: Mapping[FeedKey, FeedMsgs]):
+        """Add/Update a batch of feeds and their message ids in one transaction.
+        Feeds are upserted by ``INSERT ... ON CONFLICT``. Message ids of these feeds in the given
+        chats are replaced by the given ones, and those in other chats are kept, e.g. a forwardee
+        which is sent to other chats before. All message ids of a feed are deleted if it is given
+        without message ids. Replaced message ids are evicted from :obj:`StorageMan.mid_cache`.
 
-        # delete existing mids
-        tasks = [asyncio.create_task(sess.delete(i)) for i in result]
-        if tasks:
-            await asyncio.wait(tasks)
+        :param items: feed key to feed and ``(chat_id, mid)`` list, see :obj:`FeedMsgs`.
 
-        if mids is None:
+        .. versionadded:: 0.9.9.dev3
+        """
+        if not items:
             return
-        for mid in mids:
-            sess.add(MessageOrm(uin=feed.uin, abstime=feed.abstime, mid=mid))
 
-    async def SaveFeed(self, feed: BaseFeed, mids: list[int] | None = None):
-        """Add/Update an record by the given feed and messages id.
+        feeds = [FeedOrm.from_base(v[0]).dict() for v in items.values()]
+        msgs = [
+            dict(chat_id=chat_id, mid=mid, uin=v[0].uin, abstime=v[0].abstime, line=_line(v))
+            for v in items.values()
+            for chat_id, mid in v[1] or ()
+        ]
+
+        # a message id maps to one feed, so a conflicting row is a stale one
+        insert_msg = sqlite_insert(MessageOrm)
+        insert_msg = insert_msg.on_conflict_do_update(
+            index_elements=[MessageOrm.chat_id, MessageOrm.mid, MessageOrm.line],
+            set_=dict(uin=insert_msg.excluded.uin, abstime=insert_msg.excluded.abstime),
+        )
 
-        :param feed: feed
-        :param mids: message id list, defaults to None
+        # messages are replaced per chat, or per feed if it has no message ids
+        by_chat = list({(m["uin"], m["abstime"], m["chat_id"]) for m in msgs})
+        unsent = [k for k, v in items.items() if not v[1]]
+
+        # rows of these feeds in outbox must be written before they are deleted below
+        await self.store.outbox.wait()
+        replaced: set[MsgKey] = set()
+        async with self.sess_maker() as sess, sess.begin():
+            await sess.execute(FeedOrm.upsert(), feeds)
+            for cols, keys in (
+                ((MessageOrm.uin, MessageOrm.abstime, MessageOrm.chat_id), by_chat),
+                ((MessageOrm.uin, MessageOrm.abstime), unsent),
+            ):
+                # each key costs len(cols) bound variables
+                for chunk in split_by_len(keys, MAX_KEYS_PER_QUERY * 2 // len(cols)):
+                    r = await sess.execute(
+                        delete(MessageOrm)
+                        .where(tuple_(*cols).in_(chunk))
+                        .returning(MessageOrm.chat_id, MessageOrm.mid)
+                    )
+                    replaced.update((chat_id, mid) for chat_id, mid in r)
+            for chunk in split_by_len(list(items), MAX_KEYS_PER_QUERY):
+                # these feeds are sent, and their atoms in outbox are no longer needed
+                await sess.execute(
+                    delete(OutboxOrm).where(tuple_(OutboxOrm.uin, OutboxOrm.abstime).in_(chunk))
+                )
+            if msgs:
+                await sess.execute(insert_msg, msgs)
+
+        replaced.difference_update((m["chat_id"], m["mid"]) for m in msgs)
+        for msg in replaced:
+            self.store.mid_cache.pop(msg)
+        for key, v in items.items():
+            self.store.seen.set(key, bool(v[1]))
+
+    def RollbackFeeds(self, items: Mapping[FeedKey, FeedMsgs]):
+        """Roll back in-memory indexes of feeds which cannot be saved by :meth:`.SaveFeeds`, so
+        that they are not considered as sent. Whether they are sent is then checked in database.
+
+        .. versionadded:: 0.9.9.dev3
         """
+        for key, v in items.items():
+            self.store.seen.set(key, False)
+            for msg in v[1] or ():
+                self.store.mid_cache.pop(msg)
 
-        async def _update_feed(feed, sess: AsyncSession):
-            prev = await self.store.get_feed_orm(*FeedOrm.primkey(feed), sess=sess)
-            if prev:
-                # if exist: update
-                FeedOrm.set_by(prev, feed)
-            else:
-                # not exist: add
-                sess.add(FeedOrm.from_base(feed))
+    async def Mid2Feed(self, chat_id: int, mid: int, line: int | None = None) -> BaseFeed | None:
+        """Get the feed which a message belongs to. Results are cached in
+        :obj:`StorageMan.mid_cache`, except those of digests.
 
-        async with self.sess_maker() as sess:
-            async with sess.begin():
-                # BUG: asyncio.wait/gather raises error at the end of a transaction
-                await self._update_message_ids(feed, mids, sess=sess, flush=False)
-                await _update_feed(feed, sess=sess)
-
-    async def Mid2Feed(self, mid: int) -> BaseFeed | None:
-        mo = await self.store.get_msg_orms(MessageOrm.mid == mid)
-        if not mo:
-            return
-        orm = await self.store.get_feed_orm(
-            FeedOrm.uin == mo[0].uin, FeedOrm.abstime == mo[0].abstime
+        :param chat_id: the chat which the message is in.
+        :param mid: message id.
+        :param line: label of the feed if the message is a digest, see :obj:`.MessageOrm.line`.
+            It is ignored if the message is not a digest.
+        :return: the feed, or None if not found, or the message is a digest but :obj:`line` is
+            not given.
+
+        .. versionchanged:: 0.9.9.dev3
+
+            Query with one JOIN and cache the result. Add ``chat_id`` and ``line``.
+        """
+        key = (chat_id, mid)
+        if (feed := self.store.mid_cache.get(key)) is not None:
+            return feed
+
+        stmt = (
+            select(FeedOrm, MessageOrm.line)
+            .join(MessageOrm, and_(*MessageOrm.fkey(FeedOrm)))  # type: ignore
+            .where(
+                MessageOrm.chat_id == chat_id,
+                MessageOrm.mid == mid,
+                MessageOrm.line.in_((0, line or 0)),
+            )
+            .limit(1)
         )
-        if orm is None:
+        async with self.sess_maker() as sess:
+            row = (await sess.execute(stmt)).first()
+        if row is None:
             return
-        return BaseFeed(**orm.dict())  # type: ignore
+        orm, line = row
+        feed = BaseFeed(**orm.dict())  # type: ignore
+        if line == 0:
+            self.store.mid_cache[key] = feed
+        return feed
+
+    def cache_mids(self, feed: BaseFeed, chat_id: int, mids: list[int]):
+        """Put sent message ids of a feed into :obj:`StorageMan.mid_cache`."""
+        base = BaseFeed(**FeedOrm.from_base(feed).dict())  # type: ignore
+        for mid in mids:
+            self.store.mid_cache[(chat_id, mid)] = base
@@ -1,33 +1,73 @@
+from typing import Iterable
+
 from qzemoji.base import AsyncSessionProvider
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import event, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
 
 from .orm import BlockOrm
 
 
 class BlockSet(AsyncSessionProvider):
+    """Uins blocked by the admin. The ``Block`` table is loaded into memory by :meth:`.create`,
+    and :meth:`.add`/:meth:`.delete` write through it once their session commits. So membership
+    checks need no database query.
+
+    .. versionchanged:: 0.9.9.dev3
+
+        Replace ``contains`` with synchronous ``uin in blockset``.
+    """
+
+    def __init__(self, engine: AsyncEngine) -> None:
+        super().__init__(engine)
+        self._uins: set[int] = set()
+
     async def create(self):
         await self._create(BlockOrm)
+        async with self.sess() as sess:
+            self._uins = set(await sess.scalars(select(BlockOrm.uin)))
 
-    async def contains(self, uin: int, sess: AsyncSession | None = None):
-        if sess is None:
-            async with self.sess() as sess:
-                return await self.contains(uin, sess=sess)
+    def __contains__(self, uin: int) -> bool:
+        return uin in self._uins
 
-        stmt = select(BlockOrm).where(BlockOrm.uin == uin)
-        return (await sess.scalar(stmt)) is not None
+    def __len__(self) -> int:
+        return len(self._uins)
+
+    def _on_commit(self, sess: AsyncSession, add: Iterable[int] = (), discard: Iterable[int] = ()):
+        """Apply changes to the in-memory set after the session commits. They are dropped if the
+        session rolls back instead."""
+        sync = sess.sync_session
+
+        # a listener cannot be removed while its own event is dispatching, so each listener
+        # fires once and removes the other one.
+        def _apply(_):
+            event.remove(sync, "after_rollback", _drop)
+            self._uins.update(add)
+            self._uins.difference_update(discard)
+
+        def _drop(_):
+            event.remove(sync, "after_commit", _apply)
+
+        event.listen(sync, "after_commit", _apply, once=True)
+        event.listen(sync, "after_rollback", _drop, once=True)
 
     async def add(self, uin: int, sess: AsyncSession | None = None, flush=True):
+        if uin in self._uins:
+            return
         if sess is None:
             async with self.sess() as sess:
                 return await self.add(uin, sess=sess, flush=flush)
 
-        sess.add(BlockOrm(uin=uin))
+        # concurrent adds of the same uin may all miss the in-memory set
+        await sess.execute(sqlite_insert(BlockOrm).values(uin=uin).on_conflict_do_nothing())
+        self._on_commit(sess, add=(uin,))
 
         if flush:
             await sess.commit()
 
     async def delete(self, uin: int, sess: AsyncSession | None = None, flush=True) -> bool:
+        if uin not in self._uins:
+            return False
         if sess is None:
             async with self.sess() as sess:
                 return await self.delete(uin, sess=sess, flush=flush)
@@ -35,6 +75,7 @@ class BlockSet(AsyncSessionProvider):
         stmt = select(BlockOrm).where(BlockOrm.uin == uin)
         if r := await sess.scalar(stmt):
             await sess.delete(r)
+            self._on_commit(sess, discard=(uin,))
             if flush:
                 await sess.commit()
             return True
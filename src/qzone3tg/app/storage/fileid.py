@@ -0,0 +1,60 @@
+"""This module caches telegram file_id of uploaded medias, so that they are not uploaded again.
+
+.. versionadded:: 0.9.9.dev3
+"""
+
+from time import time
+
+from qzemoji.base import AsyncSessionProvider
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from .orm import FileIdOrm
+
+
+class FileIdCache(AsyncSessionProvider):
+    """The ``file_id`` table is loaded into :obj:`.ids` by :meth:`.create`, and :meth:`.put`
+    writes through it. So lookups need no database query."""
+
+    def __init__(self, engine: AsyncEngine) -> None:
+        super().__init__(engine)
+        self.ids: dict[str, str] = {}
+        """Media key to file_id. It is updated in place, so it can be shared."""
+
+    async def create(self):
+        await self._create(FileIdOrm)
+        async with self.sess() as sess:
+            r = await sess.execute(select(FileIdOrm.key, FileIdOrm.file_id))
+            self.ids.clear()
+            self.ids.update((k, v) for k, v in r)
+
+    async def put(self, ids: dict[str, str]):
+        """Save file_ids of uploaded medias."""
+        self.ids.update(ids)
+        now = int(time())
+        stmt = sqlite_insert(FileIdOrm)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[FileIdOrm.key],
+            set_=dict(file_id=stmt.excluded.file_id, updated=stmt.excluded.updated),
+        )
+        async with self.sess() as sess, sess.begin():
+            await sess.execute(stmt, [dict(key=k, file_id=v, updated=now) for k, v in ids.items()])
+
+    async def clean(self, seconds: float) -> int:
+        """Delete file_ids uploaded before the given time.
+
+        :param seconds: Timestamp in second, clean the file_ids before this time. Means back from
+            now if the value < 0.
+        :return: number of deleted file_ids.
+        """
+        if seconds <= 0:
+            seconds += time()
+        async with self.sess() as sess, sess.begin():
+            r = await sess.execute(
+                delete(FileIdOrm).where(FileIdOrm.updated < seconds).returning(FileIdOrm.key)
+            )
+            keys = r.scalars().all()
+        for k in keys:
+            self.ids.pop(k, None)
+        return len(keys)
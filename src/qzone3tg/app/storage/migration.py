@@ -0,0 +1,167 @@
+"""This module evolves the schema of existing databases. Schema version is saved in
+``PRAGMA user_version``. Each migration upgrades the schema by one version, in its own transaction.
+
+.. versionadded:: 0.9.9.dev3
+"""
+
+import logging
+from typing import Any, Callable
+
+from sqlalchemy import Connection, inspect
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+log = logging.getLogger(__name__)
+
+Migration = Callable[..., None]
+MIGRATIONS: list[Migration] = []
+"""Migration of version ``i`` upgrades the schema from version ``i`` to ``i + 1``.
+Each migration is called with the connection and keyword arguments passed to :func:`migrate`."""
+
+
+def migration(func: Migration) -> Migration:
+    MIGRATIONS.append(func)
+    return func
+
+
+def _exec(conn: Connection, *sqls: str):
+    for sql in sqls:
+        conn.exec_driver_sql(sql)
+
+
+@migration
+def message_feed_index(conn: Connection, **_):
+    """Add composite index on ``message(uin, abstime)``."""
+    _exec(conn, "CREATE INDEX IF NOT EXISTS ix_message_feed ON message (uin, abstime)")
+
+
+@migration
+def message_feed_fkey(conn: Connection, **_):
+    """Replace two independent foreign keys of ``message`` with a composite one which
+    cascades on delete. Orphan messages are dropped."""
+    _exec(
+        conn,
+        """CREATE TABLE message_new (
+            mid INTEGER NOT NULL,
+            uin INTEGER NOT NULL,
+            abstime INTEGER NOT NULL,
+            PRIMARY KEY (mid),
+            FOREIGN KEY (uin, abstime) REFERENCES feed (uin, abstime)
+                ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED
+        )""",
+        """INSERT INTO message_new (mid, uin, abstime)
+            SELECT m.mid, m.uin, m.abstime FROM message AS m
+            JOIN feed AS f ON f.uin = m.uin AND f.abstime = m.abstime""",
+        "DROP TABLE message",
+        "ALTER TABLE message_new RENAME TO message",
+        "CREATE INDEX ix_message_feed ON message (uin, abstime)",
+    )
+
+
+@migration
+def message_chat_id(conn: Connection, *, default_chat_id: int | None = None, **_):
+    """Key ``message`` by ``(chat_id, mid)`` since message ids are only unique in a chat.
+    Existing messages are considered to be sent to :obj:`default_chat_id`."""
+    if default_chat_id is None:
+        raise ValueError("default_chat_id is required to migrate existing messages")
+    _exec(
+        conn,
+        """CREATE TABLE message_new (
+            chat_id INTEGER NOT NULL,
+            mid INTEGER NOT NULL,
+            uin INTEGER NOT NULL,
+            abstime INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, mid),
+            FOREIGN KEY (uin, abstime) REFERENCES feed (uin, abstime)
+                ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED
+        )""",
+    )
+    conn.exec_driver_sql(
+        """INSERT INTO message_new (chat_id, mid, uin, abstime)
+            SELECT ?, mid, uin, abstime FROM message""",
+        (default_chat_id,),
+    )
+    _exec(
+        conn,
+        "DROP TABLE message",
+        "ALTER TABLE message_new RENAME TO message",
+        "CREATE INDEX ix_message_feed ON message (uin, abstime)",
+    )
+
+
+@migration
+def message_digest_line(conn: Connection, **_):
+    """Key ``message`` by ``(chat_id, mid, line)``, since a digest message is shared by several
+    feeds, which are told apart by their labels. Existing messages are not digests. Add ``line``
+    to ``outbox`` as well."""
+    _exec(
+        conn,
+        """CREATE TABLE message_new (
+            chat_id INTEGER NOT NULL,
+            mid INTEGER NOT NULL,
+            uin INTEGER NOT NULL,
+            abstime INTEGER NOT NULL,
+            line INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, mid, line),
+            FOREIGN KEY (uin, abstime) REFERENCES feed (uin, abstime)
+                ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED
+        )""",
+        """INSERT INTO message_new (chat_id, mid, uin, abstime, line)
+            SELECT chat_id, mid, uin, abstime, 0 FROM message""",
+        "DROP TABLE message",
+        "ALTER TABLE message_new RENAME TO message",
+        "CREATE INDEX ix_message_feed ON message (uin, abstime)",
+    )
+    insp = inspect(conn)
+    if insp.has_table("outbox") and "line" not in {c["name"] for c in insp.get_columns("outbox")}:
+        _exec(conn, "ALTER TABLE outbox ADD COLUMN line INTEGER NOT NULL DEFAULT 0")
+
+
+def schema_version() -> int:
+    """The schema version defined by current orms."""
+    return len(MIGRATIONS)
+
+
+def _migrate(conn: Connection, fresh: bool, kw: dict[str, Any]) -> int:
+    version: int = conn.exec_driver_sql("PRAGMA user_version").scalar() or 0
+    latest = schema_version()
+    if fresh:
+        # tables will be created by orms, which are already the latest.
+        _exec(conn, f"PRAGMA user_version = {latest}")
+        return latest
+    if version >= latest:
+        return version
+
+    # foreign keys must be disabled when rebuilding tables.
+    # This pragma is a no-op inside a transaction.
+    _exec(conn, "PRAGMA foreign_keys = OFF")
+    try:
+        for v in range(version, latest):
+            func = MIGRATIONS[v]
+            log.info(f"migrating database to version {v + 1}: {func.__name__}")
+            _exec(conn, "BEGIN")
+            try:
+                func(conn, **kw)
+                _exec(conn, f"PRAGMA user_version = {v + 1}")
+            except:
+                _exec(conn, "ROLLBACK")
+                raise
+            _exec(conn, "COMMIT")
+    finally:
+        _exec(conn, "PRAGMA foreign_keys = ON")
+    return latest
+
+
+async def migrate(engine: AsyncEngine, table: str, **kw) -> int:
+    """Upgrade the database schema to the latest version.
+
+    :param engine: the database engine.
+    :param table: a table created since the first version. If it does not exist, the database is
+        considered fresh and just stamped with the latest version.
+    :param kw: extra arguments required by some migrations, e.g. ``default_chat_id``.
+    :return: the schema version after migration.
+    """
+    async with engine.connect() as conn:
+        # transactions are controlled by ourselves
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        fresh = not await conn.run_sync(lambda c: inspect(c).has_table(table))
+        return await conn.run_sync(_migrate, fresh, kw)
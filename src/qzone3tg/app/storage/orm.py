@@ -3,6 +3,7 @@
 import sqlalchemy as sa
 from aioqzone.model import FeedData, PersudoCurkey, ProfileFeedData
 from aioqzone_feed.type import BaseFeed
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import DeclarativeBase, Mapped, MappedAsDataclass, mapped_column, relationship
 
 
@@ -51,13 +52,36 @@ class FeedOrm(Base):
         record.unikey = obj.unikey and str(obj.unikey)
         return record
 
+    @classmethod
+    def upsert(cls):
+        """An ``INSERT ... ON CONFLICT DO UPDATE`` statement which updates all columns
+        except the primary key.
+
+        .. versionadded:: 0.9.9.dev3
+        """
+        stmt = sqlite_insert(cls)
+        return stmt.on_conflict_do_update(
+            index_elements=[cls.uin, cls.abstime],
+            set_={
+                c.name: stmt.excluded[c.name]
+                for c in cls.__table__.columns
+                if c.name not in ("uin", "abstime")
+            },
+        )
+
     @classmethod
     def primkey(cls, feed: BaseFeed | PersudoCurkey | FeedData | ProfileFeedData):
+        uin, abstime = cls.key(feed)
+        return cls.uin == uin, cls.abstime == abstime
+
+    @staticmethod
+    def key(feed: "BaseFeed | PersudoCurkey | FeedData | ProfileFeedData | FeedOrm"):
+        """Get ``(uin, abstime)`` of a feed-like object."""
         match feed:
             case FeedData():
-                return cls.uin == feed.userinfo.uin, cls.abstime == feed.abstime
+                return feed.userinfo.uin, feed.abstime
             case BaseFeed() | FeedOrm() | PersudoCurkey():
-                return cls.uin == feed.uin, cls.abstime == feed.abstime
+                return feed.uin, feed.abstime
             case _:
                 raise TypeError(type(feed))
 
@@ -77,16 +101,40 @@ class FeedOrm(Base):
 
 class MessageOrm(Base):
     __tablename__ = "message"
-
+    __table_args__ = (
+        sa.ForeignKeyConstraint(
+            ["uin", "abstime"],
+            ["feed.uin", "feed.abstime"],
+            ondelete="CASCADE",
+            deferrable=True,
+            initially="DEFERRED",
+        ),
+        sa.Index("ix_message_feed", "uin", "abstime"),
+    )
+
+    chat_id: Mapped[int] = mapped_column(sa.Integer, primary_key=True)
+    """Message ids are only unique in a chat.
+
+    .. versionadded:: 0.9.9.dev3
+    """
     mid: Mapped[int] = mapped_column(sa.Integer, primary_key=True)
-    uin: Mapped[int] = mapped_column(sa.ForeignKey("feed.uin"))
-    abstime: Mapped[int] = mapped_column(sa.ForeignKey("feed.abstime"))
+    uin: Mapped[int] = mapped_column(sa.Integer)
+    abstime: Mapped[int] = mapped_column(sa.Integer)
+    line: Mapped[int] = mapped_column(sa.Integer, primary_key=True, default=0)
+    """A digest message is shared by several feeds. This is the label of the feed in the digest,
+    which starts from 1, so that a row still maps to one feed. It is 0 if the message is not a
+    digest.
+
+    .. versionadded:: 0.9.9.dev3
+    """
 
     @staticmethod
-    def set_by(record: "MessageOrm", obj: BaseFeed, mid: int):
+    def set_by(record: "MessageOrm", obj: BaseFeed, chat_id: int, mid: int, line: int = 0):
+        record.chat_id = chat_id
         record.mid = mid
         record.uin = obj.uin
         record.abstime = obj.abstime
+        record.line = line
         return record
 
     @classmethod
@@ -94,6 +142,61 @@ class MessageOrm(Base):
         return cls.uin == feed.uin, cls.abstime == feed.abstime
 
 
+class OutboxOrm(Base):
+    """Atoms which are being sent. Rows are deleted once message ids of their feed are saved.
+
+    .. versionadded:: 0.9.9.dev3
+    """
+
+    __tablename__ = "outbox"
+    __table_args__ = (
+        sa.ForeignKeyConstraint(
+            ["uin", "abstime"],
+            ["feed.uin", "feed.abstime"],
+            ondelete="CASCADE",
+            deferrable=True,
+            initially="DEFERRED",
+        ),
+    )
+
+    id: Mapped[int] = mapped_column(sa.Integer, primary_key=True, init=False)
+    """Atoms in a chain are sent in the order of ``id``."""
+    head_uin: Mapped[int] = mapped_column(sa.Integer)
+    """``uin`` of the feed which starts sending this chain."""
+    head_abstime: Mapped[int] = mapped_column(sa.Integer)
+    uin: Mapped[int] = mapped_column(sa.Integer)
+    """``uin`` of the feed which this atom belongs to. It differs from :obj:`.head_uin` if this
+    atom belongs to a forwardee."""
+    abstime: Mapped[int] = mapped_column(sa.Integer)
+    chat_id: Mapped[int] = mapped_column(sa.Integer)
+    payload: Mapped[dict] = mapped_column(sa.JSON)
+    """See :meth:`~qzone3tg.bot.atom.MsgAtom.dump`."""
+    status: Mapped[int] = mapped_column(sa.Integer, default=0)
+    """:obj:`OUTBOX_PENDING` or :obj:`OUTBOX_SENT`."""
+    mids: Mapped[list[int] | None] = mapped_column(sa.JSON, default=None)
+    line: Mapped[int] = mapped_column(sa.Integer, default=0)
+    """See :obj:`MessageOrm.line`. Atoms with lines are sent as one digest."""
+
+
+OUTBOX_PENDING = 0
+OUTBOX_SENT = 1
+
+
+class FileIdOrm(Base):
+    """Telegram file_id of uploaded medias.
+
+    .. versionadded:: 0.9.9.dev3
+    """
+
+    __tablename__ = "file_id"
+
+    key: Mapped[str] = mapped_column(sa.VARCHAR, primary_key=True)
+    """See :func:`~qzone3tg.bot.atom.media_keys`."""
+    file_id: Mapped[str] = mapped_column(sa.VARCHAR)
+    updated: Mapped[int] = mapped_column(sa.Integer)
+    """Timestamp when the media is uploaded."""
+
+
 class CookieOrm(Base):
     __tablename__ = "cookie"
 
@@ -0,0 +1,172 @@
+"""This module persists atoms being sent, so that sending can resume after a crash or restart.
+
+.. versionadded:: 0.9.9.dev3
+"""
+
+import asyncio
+import logging
+from typing import NamedTuple, Sequence
+from weakref import WeakKeyDictionary
+
+from aioqzone_feed.type import BaseFeed
+from qzemoji.base import AsyncSessionProvider
+from sqlalchemy import delete, func, select, tuple_, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from qzone3tg.bot.atom import MsgAtom, load_atom
+from qzone3tg.utils.batch import WriteBehind
+from qzone3tg.utils.iter import split_by_len
+
+from .orm import OUTBOX_PENDING, OUTBOX_SENT, FeedOrm, OutboxOrm
+from .seen import MAX_KEYS_PER_QUERY, FeedKey
+
+log = logging.getLogger(__name__)
+
+
+class PendingAtom(NamedTuple):
+    feed: BaseFeed
+    """The feed which the atom belongs to."""
+    atom: MsgAtom
+    mids: list[int] | None
+    """Message ids if the atom is sent already."""
+    line: int = 0
+    """Label of the feed if the chain is sent as one digest, see :obj:`.OutboxOrm.line`."""
+
+
+class Outbox(AsyncSessionProvider):
+    """Atoms are saved by :meth:`.put` before their feed is sent, and marked as sent by
+    :meth:`.ack` once they are sent. When message ids of a feed are saved by
+    :meth:`~qzone3tg.app.storage.StorageMixin.SaveFeeds`, its atoms are deleted.
+    So rows left in this table are atoms not finished in the last run.
+
+    Rows are written through :obj:`.buffer`, so that puts and acks of concurrent sends are
+    grouped into one transaction instead of one per atom. Row ids are allocated in memory, so an
+    ack can be merged with its put if they fall into the same batch. Atoms sent in the last
+    :obj:`~qzone3tg.utils.batch.WriteBehind.delay` before a crash may not be resumed; their feeds
+    are not saved either, so they are fetched and sent again.
+    """
+
+    def __init__(self, engine: AsyncEngine) -> None:
+        super().__init__(engine)
+        self._rows: WeakKeyDictionary[MsgAtom, int] = WeakKeyDictionary()
+        """Atom to its row id."""
+        self._next_id: int | None = None
+        """The next row id to allocate. Loaded from database at the first allocation."""
+        self._id_lock = asyncio.Lock()
+        self.buffer: WriteBehind[int, tuple[dict | None, dict]] = WriteBehind(self._write)
+        """Row id to the feed to upsert with the row, and values of the row. A row without
+        ``payload`` only updates its status."""
+
+    async def _alloc(self, n: int) -> int:
+        """Allocate :obj:`n` consecutive row ids.
+
+        :return: the first row id.
+        """
+        async with self._id_lock:
+            if self._next_id is None:
+                async with self.sess() as sess:
+                    self._next_id = (await sess.scalar(select(func.max(OutboxOrm.id))) or 0) + 1
+            start = self._next_id
+            self._next_id += n
+        return start
+
+    async def _write(self, rows: dict[int, tuple[dict | None, dict]]):
+        feeds = {(f["uin"], f["abstime"]): f for f, _ in rows.values() if f is not None}
+        puts = [r for _, r in rows.values() if "payload" in r]
+        acks = [r for _, r in rows.values() if "payload" not in r]
+        insert = sqlite_insert(OutboxOrm)
+        insert = insert.on_conflict_do_update(
+            index_elements=[OutboxOrm.id],
+            set_=dict(status=insert.excluded.status, mids=insert.excluded.mids),
+        )
+        async with self.sess() as sess, sess.begin():
+            if feeds:
+                await sess.execute(FeedOrm.upsert(), list(feeds.values()))
+            if puts:
+                await sess.execute(insert, puts)
+            if acks:
+                await sess.execute(update(OutboxOrm), acks)
+
+    async def put(
+        self,
+        head: BaseFeed,
+        chain: Sequence[tuple[BaseFeed, Sequence[MsgAtom]]],
+        packed: bool = False,
+    ):
+        """Save atoms to be sent, together with their feeds.
+
+        :param head: the feed which starts sending this chain.
+        :param chain: feeds and their atoms, in sending order.
+        :param packed: the chain is sent as one digest, each feed has one atom.
+        """
+        rowid = await self._alloc(sum(len(atoms) for _, atoms in chain))
+        for line, (feed, atoms) in enumerate(chain, 1):
+            feed_row = FeedOrm.from_base(feed).dict()
+            for atom in atoms:
+                self._rows[atom] = rowid
+                row = dict(
+                    id=rowid,
+                    head_uin=head.uin,
+                    head_abstime=head.abstime,
+                    uin=feed.uin,
+                    abstime=feed.abstime,
+                    chat_id=atom.kwds["chat_id"],
+                    payload=atom.dump(),
+                    status=OUTBOX_PENDING,
+                    mids=None,
+                    line=line if packed else 0,
+                )
+                self.buffer.push(rowid, (feed_row, row))
+                rowid += 1
+
+    async def ack(self, atom: MsgAtom, mids: list[int]):
+        """Mark an atom as sent with its message ids."""
+        if (rowid := self._rows.pop(atom, None)) is None:
+            return
+        values = dict(status=OUTBOX_SENT, mids=mids)
+        if (unsaved := self.buffer.peek(rowid)) is not None:
+            # merge into the row if it is not written yet
+            self.buffer.push(rowid, (unsaved[0], {**unsaved[1], **values}))
+        else:
+            self.buffer.push(rowid, (None, dict(id=rowid, **values)))
+
+    async def wait(self):
+        """Write all buffered rows."""
+        await self.buffer.wait()
+
+    async def discard(self, keys: Sequence[FeedKey]):
+        """Delete atoms of the given feeds, e.g. when they failed to be sent."""
+        await self.wait()
+        async with self.sess() as sess, sess.begin():
+            for chunk in split_by_len(list(keys), MAX_KEYS_PER_QUERY):
+                await sess.execute(
+                    delete(OutboxOrm).where(tuple_(OutboxOrm.uin, OutboxOrm.abstime).in_(chunk))
+                )
+
+    async def pending(self) -> list[list[PendingAtom]]:
+        """Load atoms left by the last run. Atoms of one head are split by chat, since copies
+        into other chats are sent apart from the uploaded chain.
+
+        :return: chains of atoms, in sending order.
+        """
+        stmt = (
+            select(OutboxOrm, FeedOrm)
+            .join(FeedOrm, (FeedOrm.uin == OutboxOrm.uin) & (FeedOrm.abstime == OutboxOrm.abstime))
+            .order_by(OutboxOrm.id)
+        )
+        chains: dict[tuple[int, int, int], list[PendingAtom]] = {}
+        await self.wait()
+        async with self.sess() as sess:
+            for row, feed in await sess.execute(stmt):
+                try:
+                    atom = load_atom(row.payload)
+                except:
+                    log.error(f"cannot load atom {row.id}, skipped.", exc_info=True)
+                    continue
+                if row.status == OUTBOX_PENDING:
+                    self._rows[atom] = row.id
+                chains.setdefault((row.head_uin, row.head_abstime, row.chat_id), []).append(
+                    PendingAtom(BaseFeed(**feed.dict()), atom, row.mids, row.line)  # type: ignore
+                )
+        return list(chains.values())
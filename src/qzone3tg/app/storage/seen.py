@@ -0,0 +1,60 @@
+"""This module defines a process-local index of sent feeds."""
+
+from typing import Iterable
+
+FeedKey = tuple[int, int]
+"""A feed is identified by ``(uin, abstime)``."""
+MsgKey = tuple[int, int]
+"""A message is identified by ``(chat_id, mid)``."""
+MAX_KEYS_PER_QUERY = 400
+"""SQLite limits the number of bound variables in one statement, each key costs two."""
+
+
+class SeenIndex:
+    """Keys of feeds which are saved with message ids, i.e. sent. It mirrors the
+    ``feed``/``message`` tables so that checking whether a feed is sent needs no database query.
+
+    The index is warmed by :meth:`StorageMan.create`, updated by :meth:`StorageMixin.SaveFeed`
+    and evicted by :meth:`StorageMan.clean`.
+    """
+
+    __slots__ = ("_keys", "hits", "misses")
+
+    def __init__(self, keys: Iterable[FeedKey] = ()) -> None:
+        self._keys = set(keys)
+        self.hits = 0
+        """number of lookups that found a sent feed."""
+        self.misses = 0
+        """number of lookups that found nothing."""
+
+    def __contains__(self, key: FeedKey) -> bool:
+        if key in self._keys:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def update(self, keys: Iterable[FeedKey]):
+        self._keys.update(keys)
+
+    def set(self, key: FeedKey, sent: bool):
+        """Mark a feed as sent or not sent."""
+        if sent:
+            self._keys.add(key)
+        else:
+            self._keys.discard(key)
+
+    def evict(self, before: float) -> int:
+        """Remove keys whose ``abstime`` is earlier than the given timestamp.
+
+        :return: number of evicted keys.
+        """
+        expired = [k for k in self._keys if k[1] < before]
+        self._keys.difference_update(expired)
+        return len(expired)
+
+    def clear(self):
+        self._keys.clear()
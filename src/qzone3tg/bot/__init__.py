@@ -22,3 +22,4 @@ MAX_TEXT_LENGTH: Final[int] = 4096
 CAPTION_LENGTH: Final[int] = 1024
 LIM_TXT: Final[int] = MAX_TEXT_LENGTH - 1
 LIM_MD_TXT: Final[int] = CAPTION_LENGTH - 1
+MAX_COPY_MESSAGES: Final[int] = 100
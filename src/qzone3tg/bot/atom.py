@@ -4,18 +4,30 @@ from __future__ import annotations
 
 import logging
 from abc import ABC, abstractmethod
-from typing import ClassVar, Self, Sequence
+from hashlib import sha1
+from typing import ClassVar, Mapping, Self, Sequence
 
 from aiogram import Bot
 from aiogram.enums import InputMediaType
-from aiogram.types import BufferedInputFile, Message
+from aiogram.types import (
+    BufferedInputFile,
+    InlineKeyboardMarkup,
+    InputFile,
+    InputMedia,
+    Message,
+    MessageEntity,
+    MessageId,
+)
 from aiogram.utils.formatting import Text, TextLink, as_list
 from aiogram.utils.media_group import MediaGroupBuilder
 from aioqzone_feed.type import VisualMedia
 
 from . import *
+from .cache import CachedInputFile
 
-PIPE_OBJS = tuple[Text, list[VisualMedia], list[bytes | None], list[InputMediaType]]
+RawMedia = bytes | InputFile | None
+"""Fetched content of a media, or a source to read it when uploading."""
+PIPE_OBJS = tuple[Text, list[VisualMedia], list[RawMedia], list[InputMediaType]]
 
 
 log = logging.getLogger(__name__)
@@ -25,6 +37,39 @@ def url_basename(url: str):
     return url[url.rfind("/") + 1 :]
 
 
+def media_keys(ty: str, meta: VisualMedia, raw: InputFile | None = None) -> list[str]:
+    """Keys of a media in the file_id cache, i.e. ``{type}:{url}``, and the digest of its content
+    if the media is fetched. The type is included since a file_id can only be sent as its type.
+
+    .. versionadded:: 0.9.9.dev3
+    """
+    keys = [f"{ty}:{meta.raw}"]
+    match raw:
+        case BufferedInputFile():
+            keys.append(f"{ty}:sha1:{sha1(raw.data).hexdigest()}")
+        case CachedInputFile() if digest := raw.digest:
+            keys.append(f"{ty}:sha256:{digest}")
+    return keys
+
+
+def _input_file(meta: VisualMedia, raw: RawMedia) -> InputFile | None:
+    if isinstance(raw, bytes):
+        return BufferedInputFile(raw, url_basename(meta.raw)) if raw else None
+    return raw
+
+
+def media_file_id(msg: Message) -> str | None:
+    """Get the file_id of the media in a sent message.
+
+    .. versionadded:: 0.9.9.dev3
+    """
+    if msg.photo:
+        return msg.photo[-1].file_id
+    for media in (msg.animation, msg.video, msg.document):
+        if media is not None:
+            return media.file_id
+
+
 class MsgAtom(ABC):
     """Message atom is the atomic unit to send/retry in sending progress.
     One feed can be seperated into more than one atoms. One atom corresponds
@@ -43,12 +88,11 @@ class MsgAtom(ABC):
         pass
 
     @classmethod
-    @abstractmethod
     def pipeline(
         cls,
         txt: str,
         metas: list[VisualMedia],
-        raws: list[bytes | None],
+        raws: list[RawMedia],
         md_types: list[InputMediaType],
         **kwds,
     ) -> tuple[Self, PIPE_OBJS]:
@@ -60,6 +104,9 @@ class MsgAtom(ABC):
         :param metas: media metas in pipeline, got from feed medias.
         :param raws: media raw in pipeline, got from network (using url from corresponding media meta).
         :param md_types: media type, got from :meth:`LocalSplitter.guess_md_type`.
+
+        By default nothing is popped. Atoms not built from feeds, such as :class:`CopyAtom`,
+        need not override this.
         """
         return cls(**kwds), (txt, metas, raws, md_types)
 
@@ -96,6 +143,30 @@ class MsgAtom(ABC):
             case _:
                 self.kwds["reply_to_message_id"] = i
 
+    @property
+    def message_num(self) -> int:
+        """Number of messages this atom sends, counted by rate limits.
+
+        .. versionadded:: 0.9.9.dev3
+        """
+        return 1
+
+    def dump(self) -> dict:
+        """Serialize this atom into a json-compatible dict, which can be loaded by :func:`load_atom`.
+        Raw media data and ``reply_to_message_id`` are not saved.
+
+        .. versionadded:: 0.9.9.dev3
+        """
+        kwds = {k: v for k, v in self.kwds.items() if k != "reply_to_message_id"}
+        if isinstance(markup := kwds.get("reply_markup"), InlineKeyboardMarkup):
+            kwds["reply_markup"] = markup.model_dump(mode="json", exclude_none=True)
+        d: dict = dict(meth=self.meth, kwds=kwds)
+        if self.text is not None:
+            text, entities = self.text.render()
+            d["text"] = text
+            d["entities"] = [e.model_dump(mode="json", exclude_none=True) for e in entities]
+        return d
+
 
 class TextAtom(MsgAtom):
     """Text atom represents a pure text message.
@@ -117,7 +188,7 @@ class TextAtom(MsgAtom):
         cls,
         txt: Text,
         metas: list[VisualMedia],
-        raws: list[bytes | None],
+        raws: list[RawMedia],
         md_types: list[InputMediaType],
         **kwds,
     ) -> tuple[Self, PIPE_OBJS]:
@@ -130,26 +201,70 @@ class MediaAtom(MsgAtom):
     when MediaPartial is called. Thus "send_{meth}" must be a callable in :class:`Bot`.
     """
 
-    __slots__ = ("meta", "_raw", "__md_cls__")
+    __slots__ = ("meta", "_raw", "file_id", "__md_cls__")
     __md_cls__: ClassVar[type[SupportMedia]]
     meth: ClassVar[str]
 
     def __init__(
         self,
         media: VisualMedia,
-        raw: bytes | None,
+        raw: RawMedia,
         text: Text | None = None,
         **kw,
     ) -> None:
         super().__init__(**kw)
         self.meta = media
-        self._raw = BufferedInputFile(raw, url_basename(media.raw)) if raw else None
+        self._raw = _input_file(media, raw)
         self.text = text
+        self.file_id: str | None = None
+        """Telegram file_id of the media if it is uploaded before."""
 
     @property
-    def content(self) -> BufferedInputFile | str:
-        """returns the media url or its raw data if :obj:`._raw` is not None."""
-        return self._raw or self.meta.raw
+    def content(self) -> InputFile | str:
+        """returns :obj:`.file_id` if known, otherwise the media url or its raw data
+        if :obj:`._raw` is not None.
+
+        .. versionchanged:: 0.9.9.dev3
+
+            Prefer :obj:`.file_id`. The raw data may be streamed when uploading.
+        """
+        return self.file_id or self._raw or self.meta.raw
+
+    def use_file_ids(self, ids: Mapping[str, str]) -> bool:
+        """Send the file_id instead of the url or raw data if the media is uploaded before.
+
+        :param ids: cached file_ids, keyed by :func:`media_keys`.
+        :return: whether a file_id is used.
+
+        .. versionadded:: 0.9.9.dev3
+        """
+        keys = media_keys(self.meth, self.meta, self._raw)
+        self.file_id = next((ids[k] for k in keys if k in ids), None)
+        return self.file_id is not None
+
+    def drop_file_ids(self) -> bool:
+        """Send the url or raw data again, e.g. when the file_id is rejected.
+
+        :return: whether a file_id was used.
+
+        .. versionadded:: 0.9.9.dev3
+        """
+        used, self.file_id = self.file_id is not None, None
+        return used
+
+    def sent_file_ids(self, r: Message) -> dict[str, str]:
+        """Get file_ids of newly uploaded medias from the sent message.
+
+        .. versionadded:: 0.9.9.dev3
+        """
+        if self.file_id is not None or (file_id := media_file_id(r)) is None:
+            return {}
+        return dict.fromkeys(media_keys(self.meth, self.meta, self._raw), file_id)
+
+    def dump(self) -> dict:
+        d = super().dump()
+        d["media"] = self.meta.model_dump(mode="json")
+        return d
 
     async def __call__(self, bot: Bot, *args, **kwds) -> Message:
         f = getattr(bot, f"send_{self.meth}")
@@ -163,7 +278,7 @@ class MediaAtom(MsgAtom):
         cls,
         txt: Text,
         metas: list[VisualMedia],
-        raws: list[bytes | None],
+        raws: list[RawMedia],
         md_types: list[InputMediaType],
         **kwds,
     ) -> tuple["MediaAtom", PIPE_OBJS]:
@@ -227,6 +342,10 @@ class MediaGroupAtom(MsgAtom):
         super().__init__(**kw)
         self.text = text
         self.builder = MediaGroupBuilder()
+        self.metas: list[tuple[VisualMedia, InputMediaType]] = []
+        """Medias and their types in this group, used by :meth:`.dump`."""
+        self._uploaded: dict[int, InputMedia] = {}
+        """Medias replaced by their file_id, keyed by index."""
 
     @MsgAtom.reply_markup.getter
     def reply_markup(self):
@@ -236,29 +355,76 @@ class MediaGroupAtom(MsgAtom):
     def reply_markup(self, value: ReplyMarkup | None):
         assert value is None
 
+    @property
+    def message_num(self) -> int:
+        return len(self.builder._media)
+
+    def _media_keys(self, i: int) -> list[str]:
+        meta, ty = self.metas[i]
+        raw = self.builder._media[i].media
+        return media_keys(ty.value, meta, raw if isinstance(raw, InputFile) else None)
+
+    def use_file_ids(self, ids: Mapping[str, str]) -> bool:
+        """See :meth:`MediaAtom.use_file_ids`.
+
+        .. versionadded:: 0.9.9.dev3
+        """
+        for i, im in enumerate(self.builder._media):
+            if i in self._uploaded:
+                continue
+            if file_id := next((ids[k] for k in self._media_keys(i) if k in ids), None):
+                self._uploaded[i] = im
+                self.builder._media[i] = im.model_copy(update=dict(media=file_id))
+        return bool(self._uploaded)
+
+    def drop_file_ids(self) -> bool:
+        """See :meth:`MediaAtom.drop_file_ids`.
+
+        .. versionadded:: 0.9.9.dev3
+        """
+        for i, im in self._uploaded.items():
+            self.builder._media[i] = im
+        used = bool(self._uploaded)
+        self._uploaded.clear()
+        return used
+
+    def sent_file_ids(self, r: Sequence[Message]) -> dict[str, str]:
+        """See :meth:`MediaAtom.sent_file_ids`.
+
+        .. versionadded:: 0.9.9.dev3
+        """
+        ids = {}
+        for i, msg in enumerate(r[: len(self.metas)]):
+            if i not in self._uploaded and (file_id := media_file_id(msg)) is not None:
+                ids.update(dict.fromkeys(self._media_keys(i), file_id))
+        return ids
+
+    def dump(self) -> dict:
+        d = super().dump()
+        d["media"] = [dict(meta=m.model_dump(mode="json"), type=ty) for m, ty in self.metas]
+        d["is_doc"] = self.is_doc
+        return d
+
     async def __call__(self, bot: Bot, *args, **kwds) -> Sequence[Message]:
         assert self.builder._media
         if self.text:
             self.builder.caption, self.builder.caption_entities = self.text.render()
         return await bot.send_media_group(*args, media=self.builder.build(), **(self.kwds | kwds))
 
-    def append(self, meta: VisualMedia, raw: bytes | None, cls: InputMediaType, **kw):
+    def append(self, meta: VisualMedia, raw: RawMedia, cls: InputMediaType, **kw):
         """append a media into this atom."""
         assert cls in (InputMediaType.PHOTO, InputMediaType.DOCUMENT, InputMediaType.VIDEO)
         assert len(self.builder._media) < MAX_GROUP_MEDIA
 
-        if raw:
-            media = BufferedInputFile(raw, url_basename(meta.raw))
-        else:
-            media = meta.raw
-        self.builder.add(type=cls, media=media, **kw)
+        self.builder.add(type=cls, media=_input_file(meta, raw) or meta.raw, **kw)
+        self.metas.append((meta, cls))
 
     @classmethod
     def pipeline(
         cls,
         txt: Text,
         metas: list[VisualMedia],
-        raws: list[bytes | None],
+        raws: list[RawMedia],
         md_types: list[InputMediaType],
         **kwds,
     ) -> tuple[Self, PIPE_OBJS]:
@@ -324,3 +490,75 @@ class MediaGroupAtom(MsgAtom):
 
         self.text = as_list(txt[:rest], hint, sep="\n\n")
         return self, (txt[rest:], metas, raws, md_types)
+
+
+class CopyAtom(MsgAtom):
+    """CopyAtom copies messages which are sent already into another chat, so that medias are
+    not uploaded again. Calling this will trigger :meth:`Bot.copy_message` if there is only one
+    message, which keeps its ``reply_markup``. Otherwise :meth:`Bot.copy_messages` is called,
+    which keeps albums grouped.
+
+    .. versionadded:: 0.9.9.dev3
+    """
+
+    __slots__ = ("from_chat_id", "message_ids", "__weakref__")
+    meth = "copy"
+
+    def __init__(self, from_chat_id: ChatId, message_ids: list[int], **kw) -> None:
+        assert 0 < len(message_ids) <= MAX_COPY_MESSAGES
+        super().__init__(**kw)
+        self.text = None
+        self.from_chat_id = from_chat_id
+        self.message_ids = message_ids
+
+    @property
+    def message_num(self) -> int:
+        return len(self.message_ids)
+
+    async def __call__(self, bot: Bot, *args, **kwds) -> list[MessageId]:
+        kwds = self.kwds | kwds
+        if len(self.message_ids) == 1:
+            r = await bot.copy_message(
+                *args, from_chat_id=self.from_chat_id, message_id=self.message_ids[0], **kwds
+            )
+            return [r]
+        kwds.pop("reply_markup", None)
+        return await bot.copy_messages(
+            *args, from_chat_id=self.from_chat_id, message_ids=self.message_ids, **kwds
+        )
+
+    def dump(self) -> dict:
+        d = super().dump()
+        d["from_chat_id"] = self.from_chat_id
+        d["message_ids"] = self.message_ids
+        return d
+
+
+def load_atom(d: dict) -> MsgAtom:
+    """Load an atom dumped by :meth:`MsgAtom.dump`. Medias will be sent by url.
+
+    .. versionadded:: 0.9.9.dev3
+    """
+    kwds = dict(d["kwds"])
+    if (markup := kwds.get("reply_markup")) is not None:
+        kwds["reply_markup"] = InlineKeyboardMarkup.model_validate(markup)
+    text = None
+    if "text" in d:
+        entities = [MessageEntity.model_validate(e) for e in d["entities"]]
+        text = Text.from_entities(d["text"], entities)
+
+    match d["meth"]:
+        case TextAtom.meth:
+            assert text is not None
+            return TextAtom(text, **kwds)
+        case MediaGroupAtom.meth:
+            atom = MediaGroupAtom(text, **kwds)
+            for m in d["media"]:
+                atom.append(VisualMedia.model_validate(m["meta"]), None, InputMediaType(m["type"]))
+            atom.is_doc = d["is_doc"]
+            return atom
+        case CopyAtom.meth:
+            return CopyAtom(d["from_chat_id"], d["message_ids"], **kwds)
+        case meth:
+            cls = next(c for c in InputMedia2Partial.values() if c.meth == meth)
+            return cls(VisualMedia.model_validate(d["media"]), None, text, **kwds)
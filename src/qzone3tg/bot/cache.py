@@ -0,0 +1,410 @@
+"""Media cache of :class:`~qzone3tg.bot.splitter.FetchSplitter`.
+
+A media is fetched only once even if it is requested concurrently, or requested again when
+retrying a send. Medias are saved by the sha256 of their content, so that a post forwarded by
+several friends is stored only once. The cache is capped by size and evicts the least recently
+used medias first. Medias expire ``keepdays`` after they are fetched.
+
+To guess the type of a media, :meth:`MediaCache.sniff` fetches only its first bytes and size.
+Medias are uploaded by :class:`CachedInputFile`, which streams them from the cache, or from the
+url if they are evicted, so that they are not held in memory until sent. Bytes held by fetches
+in flight are limited by a :class:`MemoryBudget`.
+
+.. versionadded:: 0.9.9.dev3
+"""
+
+import asyncio
+import json
+import logging
+import os
+from collections import OrderedDict
+from contextlib import asynccontextmanager, nullcontext
+from hashlib import sha256
+from pathlib import Path
+from time import time
+from typing import AsyncGenerator, Final, NamedTuple
+
+from aiogram import Bot
+from aiogram.types import InputFile
+from aiogram.types.input_file import DEFAULT_CHUNK_SIZE
+from qqqr.utils.net import ClientAdapter
+
+INDEX_NAME = "index.json"
+"""Name of the file which maps urls to medias in the cache directory."""
+SNIFF_SIZE: Final[int] = 4096
+"""Bytes fetched by :meth:`MediaCache.sniff`."""
+
+log = logging.getLogger(__name__)
+
+
+class Sniff(NamedTuple):
+    head: bytes
+    """The first bytes of a media."""
+    size: int | None
+    """Size of the whole media. None if unknown."""
+
+
+def _content_size(content_range: str | None) -> int | None:
+    """Get the total size from a ``Content-Range`` header, e.g. ``bytes 0-4095/123456``."""
+    if content_range is None:
+        return
+    total = content_range.rpartition("/")[2]
+    return int(total) if total.isdigit() else None
+
+
+class MemoryBudget:
+    """Limits bytes held at the same time. Holders wait until there is enough room, and a
+    holder larger than the budget waits until all others are done.
+
+    :param total: bytes of the budget.
+    """
+
+    def __init__(self, total: int) -> None:
+        assert total > 0
+        self.total = total
+        self.used = 0
+        self._cond = asyncio.Condition()
+
+    @asynccontextmanager
+    async def hold(self, n: int):
+        """Hold :obj:`n` bytes in this block."""
+        n = min(n, self.total)
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.used + n <= self.total)
+            self.used += n
+        try:
+            yield
+        finally:
+            self.used -= n
+            async with self._cond:
+                self._cond.notify_all()
+
+
+class _Blob:
+    __slots__ = ("size", "stored", "data")
+
+    def __init__(self, size: int, stored: float, data: bytes | None = None) -> None:
+        self.size = size
+        self.stored = stored
+        """Timestamp when the media is fetched."""
+        self.data = data
+        """Content of the media if it is kept in memory."""
+
+
+class MediaCache:
+    """Content-addressed media cache with single-flight fetching.
+
+    :param client: client to fetch medias.
+    :param root: directory to save medias. Medias are kept in memory if None.
+    :param max_size: max total bytes of cached medias.
+    :param keepdays: days to keep a media after it is fetched.
+    :param budget: max bytes held by fetches in flight. Not limited if None.
+    """
+
+    def __init__(
+        self,
+        client: ClientAdapter,
+        root: Path | None = None,
+        max_size: int = 64 * 2**20,
+        keepdays: float = 3,
+        budget: int | None = None,
+    ) -> None:
+        self.client = client
+        self.budget = None if budget is None else MemoryBudget(budget)
+        self.root = root
+        self.max_size = max_size
+        self.ttl = keepdays * 86400
+        self._urls: dict[str, str] = {}
+        """Url to the digest of its content."""
+        self._blobs: OrderedDict[str, _Blob] = OrderedDict()
+        """Digest to media, the least recently used first."""
+        self._flights: dict[str, asyncio.Task[bytes]] = {}
+        """Url to the task fetching it."""
+        self.size = 0
+        """Total bytes of cached medias."""
+        self.hits = 0
+        """number of requests served without fetching."""
+        self.misses = 0
+        """number of fetches."""
+        self.bytes_saved = 0
+        """bytes not fetched thanks to the cache."""
+        self.sniffs = 0
+        """number of ranged requests sent by :meth:`.sniff`."""
+
+    def __len__(self) -> int:
+        return len(self._blobs)
+
+    def _path(self, digest: str) -> Path:
+        assert self.root
+        return self.root / digest[:2] / digest
+
+    def _drop(self, digest: str):
+        if (blob := self._blobs.pop(digest, None)) is None:
+            return
+        self.size -= blob.size
+        if blob.data is None:
+            self._path(digest).unlink(missing_ok=True)
+
+    def _blob(self, url: str) -> tuple[str, _Blob] | None:
+        """Find the cached media of an url, and mark it as recently used."""
+        if (digest := self._urls.get(url)) is None:
+            return
+        blob = self._blobs.get(digest)
+        if blob is None or blob.stored + self.ttl < time():
+            del self._urls[url]
+            self._drop(digest)
+            return
+        self._blobs.move_to_end(digest)
+        return digest, blob
+
+    def _unreadable(self, url: str, digest: str):
+        log.warning(f"cannot read cached media of {url}", exc_info=True)
+        self._urls.pop(url, None)
+        self._drop(digest)
+
+    async def _lookup(self, url: str) -> bytes | None:
+        if (hit := self._blob(url)) is None:
+            return
+        digest, blob = hit
+        if blob.data is not None:
+            return blob.data
+        try:
+            return await asyncio.to_thread(self._path(digest).read_bytes)
+        except OSError:
+            self._unreadable(url, digest)
+
+    async def peek(self, url: str) -> bytes | None:
+        """Get a cached media without fetching it."""
+        return await self._lookup(url)
+
+    async def put(self, url: str, data: bytes):
+        """Cache a media, e.g. a transcoded one keyed by a name instead of an url."""
+        await self._put(url, data)
+
+    async def fetch(self, url: str):
+        """Make sure a media is cached if it fits. A cached media is not read.
+
+        :raise: errors when fetching.
+        """
+        if self._blob(url) is None:
+            await self.get(url)
+
+    def digest(self, url: str) -> str | None:
+        """Get the sha256 of a cached media, without reading it."""
+        if (hit := self._blob(url)) is not None:
+            return hit[0]
+
+    def _write(self, digest: str, data: bytes):
+        path = self._path(digest)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+    async def _put(self, url: str, data: bytes):
+        if len(data) > self.max_size:
+            return
+        digest = sha256(data).hexdigest()
+        self._urls[url] = digest
+        if digest in self._blobs:
+            # the same media from another url
+            self._blobs.move_to_end(digest)
+            return
+
+        if self.root is None:
+            blob = _Blob(len(data), time(), data)
+        else:
+            try:
+                await asyncio.to_thread(self._write, digest, data)
+            except OSError:
+                log.warning(f"cannot save media of {url}", exc_info=True)
+                del self._urls[url]
+                return
+            blob = _Blob(len(data), time())
+
+        self._blobs[digest] = blob
+        self.size += blob.size
+        while self.size > self.max_size:
+            self._drop(next(iter(self._blobs)))
+
+    async def _fetch(self, url: str) -> bytes:
+        async with self.client.get(url) as r:
+            r.raise_for_status()
+            if self.budget is None:
+                hold = nullcontext()
+            else:
+                # the whole budget is held if the size is unknown
+                hold = self.budget.hold(r.content_length or self.budget.total)
+            async with hold:
+                data = await r.content.read()
+                await self._put(url, data)
+        return data
+
+    def _landed(self, url: str, task: asyncio.Task):
+        self._flights.pop(url, None)
+        if not task.cancelled():
+            task.exception()  # retrieved even if all waiters are cancelled
+
+    async def get(self, url: str) -> bytes:
+        """Get content of a media. It is fetched only if it is not cached, and concurrent calls
+        with the same url share one fetch.
+
+        :raise: errors when fetching.
+        """
+        if (data := await self._lookup(url)) is None:
+            if (task := self._flights.get(url)) is None:
+                self.misses += 1
+                task = self._flights[url] = asyncio.ensure_future(self._fetch(url))
+                task.add_done_callback(lambda t: self._landed(url, t))
+                return await asyncio.shield(task)
+            data = await asyncio.shield(task)
+
+        self.hits += 1
+        self.bytes_saved += len(data)
+        return data
+
+    async def sniff(self, url: str, n: int = SNIFF_SIZE) -> Sniff:
+        """Get the first :obj:`n` bytes and the size of a media. Only these bytes are fetched
+        with a ``Range`` request if the media is not cached.
+
+        :raise: errors when fetching.
+        """
+        if (data := await self._lookup(url)) is None and (task := self._flights.get(url)):
+            data = await asyncio.shield(task)
+        if data is not None:
+            return Sniff(data[:n], len(data))
+
+        self.sniffs += 1
+        async with self.client.get(url, headers={"Range": f"bytes=0-{n - 1}"}) as r:
+            r.raise_for_status()
+            head = b""
+            while len(head) < n and (chunk := await r.content.read(n - len(head))):
+                head += chunk
+            if r.status == 206:
+                size = _content_size(r.headers.get("Content-Range"))
+            else:
+                # range is not supported, the connection is closed without reading the rest
+                size = r.content_length
+
+        if r.status != 206 and size == len(head):
+            await self._put(url, head)
+        return Sniff(head, size)
+
+    async def stream(
+        self, url: str, chunk_size: int = DEFAULT_CHUNK_SIZE
+    ) -> AsyncGenerator[bytes, None]:
+        """Read a media in chunks. It is read from the cache if cached, otherwise it is streamed
+        from the url without being cached.
+
+        :raise: errors when fetching.
+        """
+        if (hit := self._blob(url)) is not None:
+            digest, blob = hit
+            if blob.data is not None:
+                self.hits += 1
+                self.bytes_saved += blob.size
+                for i in range(0, blob.size, chunk_size):
+                    yield blob.data[i : i + chunk_size]
+                return
+            try:
+                f = await asyncio.to_thread(self._path(digest).open, "rb")
+            except OSError:
+                self._unreadable(url, digest)
+            else:
+                self.hits += 1
+                self.bytes_saved += blob.size
+                with f:
+                    while chunk := await asyncio.to_thread(f.read, chunk_size):
+                        yield chunk
+                return
+
+        self.misses += 1
+        async with self.client.get(url) as r:
+            r.raise_for_status()
+            async for chunk in r.content.iter_chunked(chunk_size):
+                yield chunk
+
+    async def clean(self) -> int:
+        """Delete expired medias and save the index.
+
+        :return: number of deleted medias.
+        """
+        expire = time() - self.ttl
+        expired = [k for k, blob in self._blobs.items() if blob.stored < expire]
+        for digest in expired:
+            self._drop(digest)
+        self._urls = {u: d for u, d in self._urls.items() if d in self._blobs}
+        await self.save()
+        return len(expired)
+
+    async def load(self):
+        """Load the index saved by :meth:`.save`. Files not in the index are deleted."""
+        if self.root is None:
+            return
+        await asyncio.to_thread(self._load_index)
+
+    def _load_index(self):
+        assert self.root
+        try:
+            index = json.loads((self.root / INDEX_NAME).read_text())
+        except FileNotFoundError:
+            index = dict(urls={}, blobs={})
+        except (OSError, ValueError):
+            log.warning("cannot load media cache index, start with an empty cache", exc_info=True)
+            index = dict(urls={}, blobs={})
+
+        expire = time() - self.ttl
+        blobs = sorted(index["blobs"].items(), key=lambda i: i[1][1])
+        for digest, (size, stored) in blobs:
+            if stored >= expire and self._path(digest).is_file():
+                self._blobs[digest] = _Blob(size, stored)
+                self.size += size
+        self._urls.update((u, d) for u, d in index["urls"].items() if d in self._blobs)
+
+        for path in self.root.glob("??/*"):
+            if path.name not in self._blobs:
+                path.unlink(missing_ok=True)
+        while self.size > self.max_size:
+            self._drop(next(iter(self._blobs)))
+
+    async def save(self):
+        """Save the index of cached medias, so that they can be used after restart."""
+        if self.root is None:
+            return
+        index = dict(
+            urls={u: d for u, d in self._urls.items() if d in self._blobs},
+            blobs={d: (blob.size, blob.stored) for d, blob in self._blobs.items()},
+        )
+        await asyncio.to_thread(self._write_index, json.dumps(index))
+
+    def _write_index(self, s: str):
+        assert self.root
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = self.root / f"{INDEX_NAME}.tmp"
+        tmp.write_text(s)
+        os.replace(tmp, self.root / INDEX_NAME)
+
+
+class CachedInputFile(InputFile):
+    """A media to be uploaded, which is read by :meth:`MediaCache.stream` only when it is sent.
+
+    :param cache: the cache which has fetched the media.
+    :param url: url of the media.
+    :param filename: filename to be propagated to telegram.
+    """
+
+    def __init__(
+        self, cache: MediaCache, url: str, filename: str, chunk_size: int = DEFAULT_CHUNK_SIZE
+    ):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.cache = cache
+        self.url = url
+
+    @property
+    def digest(self) -> str | None:
+        """sha256 of the media if it is cached."""
+        return self.cache.digest(self.url)
+
+    async def read(self, bot: Bot) -> AsyncGenerator[bytes, None]:
+        async for chunk in self.cache.stream(self.url, self.chunk_size):
+            yield chunk
@@ -1,37 +1,34 @@
 import asyncio
 import logging
-from bisect import insort
-from collections import defaultdict
+from collections import Counter, defaultdict
 from contextlib import suppress
-from typing import Mapping, Sequence, TypeGuard
+from heapq import heappop, heappush
+from typing import Callable, Hashable, Mapping, Sequence, TypeGuard
 
 from aiogram import Bot
 from aiogram.exceptions import TelegramBadRequest as BadRequest
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.types.message import Message
 from aiogram.utils.formatting import Text
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aioqzone_feed.type import FeedContent
-from tenacity import (
-    RetryError,
-    TryAgain,
-    retry,
-    retry_if_exception_type,
-    stop_after_attempt,
-    wait_exponential,
-)
-from tylisten.futstore import FutureStore
-
-from qzone3tg._hookspec import inline_buttons
-from qzone3tg.utils.iter import countif
+from aioqzone_feed.type import BaseFeed, FeedContent
+
+from qzone3tg._hookspec import atom_sent, chain_ready, file_uploaded, inline_buttons
+from qzone3tg.utils.iter import split_by_len
 
 from . import *
-from .atom import MediaAtom, MediaGroupAtom, MsgAtom
-from .splitter import FetchSplitter, Splitter
+from .atom import CopyAtom, MediaAtom, MediaGroupAtom, MsgAtom, TextAtom
+from .ratelimit import Priority, RateLimiter, use_priority
+from .retry import CircuitBreaker, ErrorClass, RetryExhausted, RetryPolicy, classify
+from .splitter import FetchSplitter, Splitter, digest_atom, pack_digest
 
 Atom = MediaGroupAtom | MsgAtom
 MidOrAtoms = list[Atom] | list[int]
 MidOrFeed = FeedContent | list[int]
-MAX_RETRY: Final[int] = 2
+FeedKey = tuple[int, int]
+"""``(uin, abstime)`` of a feed."""
+Router = Callable[[BaseFeed, ChatId], Sequence[ChatId]]
+"""Get destinations of a feed, given the default chat."""
 
 log = logging.getLogger(__name__)
 
@@ -50,11 +47,78 @@ def all_is_atom(l: MidOrAtoms) -> TypeGuard[list[Atom]]:
     return False
 
 
+def _base_feed(feed: BaseFeed) -> BaseFeed:
+    """Copy fields of :class:`BaseFeed` only, dropping entities, medias and the forwardee."""
+    return BaseFeed.model_construct(**{k: getattr(feed, k) for k in BaseFeed.model_fields})
+
+
+class FeedSlot:
+    """Bookkeeping of a feed in a batch. Once atoms are built, the feed content is released
+    and only fields of :class:`BaseFeed` are kept in :obj:`.feed`.
+
+    Atoms are built in two phases. The feed is planned in :obj:`.plan` when added, and its atoms
+    are built, which probes its medias, only when it is about to be sent.
+
+    .. versionadded:: 0.9.9.dev3
+    """
+
+    __slots__ = (
+        "key",
+        "feed",
+        "chat_id",
+        "copies",
+        "seq",
+        "forward",
+        "state",
+        "markup",
+        "copied",
+        "text_only",
+        "packed",
+        "plan",
+        "ready",
+        "task",
+    )
+
+    def __init__(self, feed: BaseFeed, dests: Sequence[ChatId]) -> None:
+        self.key: FeedKey = (feed.uin, feed.abstime)
+        self.feed = feed
+        self.chat_id = dests[0]
+        """The chat which the feed is uploaded to."""
+        self.copies = tuple(dests[1:])
+        """Other chats, which messages in :obj:`.chat_id` are copied to."""
+        self.seq = -1
+        """The order in which this feed is added, or -1 if it is only referenced as a forwardee."""
+        self.forward: FeedSlot | None = None
+        self.state: MidOrAtoms = []
+        """Unsent atoms, or message ids once sent."""
+        self.markup: tuple[int, ReplyMarkup] | None = None
+        """Index of the message with ``reply_markup`` in the sent message ids, and the markup."""
+        self.copied: dict[ChatId, list[int]] = {}
+        """Message ids in each chat of :obj:`.copies`."""
+        self.text_only = False
+        """The feed has neither medias nor a forwardee, so it may be packed into a digest."""
+        self.packed = 0
+        """Label of the feed in the digest message it shares with other feeds, starting from 1.
+        0 if the feed is not packed."""
+        self.plan: FeedContent | None = None
+        """The feed whose atoms are not built yet."""
+        self.ready: asyncio.Task[None] | None = None
+        """Done when atoms are built. None if the build is not started."""
+        self.task: asyncio.Task[None] | None = None
+        """Sending task, set when the feed is released."""
+
+    def __repr__(self) -> str:
+        return f"FeedSlot{self.key}"
+
+
 class QueueHook:
     keyboard_width = 2
 
     def __init__(self) -> None:
         self.inline_buttons = inline_buttons()
+        self.chain_ready = chain_ready()
+        self.atom_sent = atom_sent()
+        self.file_uploaded = file_uploaded()
 
     async def reply_markup(self, feed: FeedContent) -> ReplyMarkup | None:
         """Allow app to generate `reply_markup` according to its own policy.
@@ -71,47 +135,123 @@ class QueueHook:
 
 
 class SendQueue(QueueHook):
+    """Feeds of a batch are indexed by their :obj:`FeedKey` in :obj:`.slots`, and ordered by a
+    heap of ``(abstime, seq)``. So bookkeeping costs O(log n) per feed.
+
+    .. versionchanged:: 0.9.9.dev3
+
+        Replace ``feed_state``, ``ch_feed`` and ``_send_order`` with :obj:`.slots`.
+    """
+
     bid = -1
-    feed_state: dict[FeedContent, MidOrAtoms]
-    """Feed to sent/unsent atoms."""
-    ch_feed: dict[FeedContent, FutureStore]
-    """Future store per feed."""
-    _send_order: list[FeedContent]
-    _dup_cache: dict[int, FeedContent]
-    """A cache that saves feed according to uin. It is used to check if two feeds are duplicated."""
+    slots: dict[FeedKey, FeedSlot]
+    """Feeds in this batch, including forwardees."""
+    _heap: list[tuple[int, int, FeedSlot]]
+    """``(abstime, seq, slot)`` of feeds not released yet."""
+    _tasks: dict[FeedKey, asyncio.Task[None]]
+    """Sending task of released feeds."""
+    _lanes: dict[ChatId, asyncio.Task[None]]
+    """The last released task of each chat."""
+    _digests: dict[ChatId, tuple[list[FeedSlot], asyncio.Task[None]]]
+    """The digest of each chat which can still take feeds, and its sending task."""
+    _dup_cache: dict[int, tuple[int, list | None]]
+    """uin to ``(abstime, entities)`` of a feed. It is used to check if two feeds are duplicated."""
+    exc_groups: defaultdict[Hashable, list[BaseException]]
+    """Errors of each feed key."""
 
     def __init__(
         self,
         bot: Bot,
         splitter: Splitter,
         forward_map: Mapping[int, ChatId],
+        limiter: RateLimiter | None = None,
+        max_lanes: int = 8,
+        window: float | None = None,
+        policy: RetryPolicy | None = None,
+        breaker: CircuitBreaker | None = None,
+        file_ids: Mapping[str, str] | None = None,
+        router: Router | None = None,
+        digest: int = 0,
+        prefetch: int = 16,
     ) -> None:
+        """
+        :param limiter: paces sending and honors ``retry_after``. Defaults to one without pacing.
+            If the session of :obj:`bot` is paced by
+            :class:`~qzone3tg.bot.ratelimit.RateLimitMiddleware`, leave this as default.
+        :param max_lanes: max number of chats to send to in parallel.
+        :param window: enables streaming mode if not None. A feed is sent once it has been in
+            the queue for :obj:`window` seconds, instead of waiting for :meth:`.send_all`.
+            Earlier feeds in sending order are released along with it.
+        :param policy: retry budgets of each error class.
+        :param breaker: pauses all sending when telegram seems unreachable.
+        :param file_ids: known telegram file_ids of medias, keyed by
+            :func:`~qzone3tg.bot.atom.media_keys`. Medias in it are not uploaded again.
+        :param router: destinations of feeds. A feed is uploaded to the first one, and copied to
+            the others. Defaults to the chat in :obj:`.forward_map`.
+        :param digest: max feeds packed into one digest message. Consecutive text-only feeds
+            of a chat are packed if this is larger than 1.
+        :param prefetch: max feeds whose atoms are built ahead of sending.
+
+        .. versionchanged:: 0.9.9.dev3
+
+            Add ``limiter``, ``max_lanes``, ``window``, ``policy``, ``breaker``, ``file_ids``,
+            ``router``, ``digest`` and ``prefetch``.
+        """
         super().__init__()
-        self.feed_state = defaultdict(list)
-        self.ch_feed = defaultdict(lambda: FutureStore())
-        self._send_order = []
+        self.slots = {}
+        self._heap = []
+        self._tasks = {}
+        self._lanes = {}
+        self._digests = {}
+        self._timers: list[asyncio.TimerHandle] = []
         self._dup_cache = {}
 
         self.bot = bot
         self.splitter = splitter
         self.forward_map = forward_map
+        self.router = router
+        self.digest = digest
+        self.limiter = limiter or RateLimiter()
+        self._sem = asyncio.Semaphore(max_lanes)
+        self._prefetch = asyncio.Semaphore(prefetch)
+        self.window = window
+        self.policy = policy or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        self.file_ids = {} if file_ids is None else file_ids
         self.exc_groups = defaultdict(list)
+        self._failed: set[Hashable] = set()
+        """Keys of feeds which have atoms failed to be sent."""
+        self.add_num = 0
+        """number of feeds added in this batch"""
         self.drop_num = 0
         """number of dropped feeds in this batch"""
 
     @property
     def exc_num(self):
-        return countif(self.exc_groups.values(), lambda i: len(i) >= MAX_RETRY)
+        """Number of feeds which have atoms failed to be sent.
+
+        .. versionchanged:: 0.9.9.dev3
+
+            Count feeds which gave up retrying, instead of feeds with ``MAX_RETRY`` errors.
+        """
+        return len(self._failed)
 
     def new_batch(self, bid: int):
         assert bid != self.bid
         # clear states
+        self.add_num = 0
         self.drop_num = 0
-        self.feed_state.clear()
-        self.ch_feed.clear()
-        self._send_order.clear()
+        self.slots.clear()
+        self._heap.clear()
+        self._tasks.clear()
+        self._lanes.clear()
+        self._digests.clear()
+        for timer in self._timers:
+            timer.cancel()
+        self._timers.clear()
         self._dup_cache.clear()
         self.exc_groups.clear()
+        self._failed.clear()
 
         self.bid = bid
 
@@ -121,170 +261,353 @@ class SendQueue(QueueHook):
             return
         self.drop_num += 1
 
-    def add(self, bid: int, feed: FeedContent, forward_mid: list[int] | None = None):
+    def route(self, feed: BaseFeed) -> tuple[ChatId, ...]:
+        """Get destinations of a feed, without duplicates. The feed is uploaded to the first one.
+
+        .. versionadded:: 0.9.9.dev3
+        """
+        default = self.forward_map[feed.uin]
+        if self.router is None:
+            return (default,)
+        return tuple(dict.fromkeys(self.router(feed, default))) or (default,)
+
+    def _slot(self, feed: FeedContent, dests: Sequence[ChatId] | None = None) -> FeedSlot:
+        """Get the slot of a feed, or create one.
+
+        :param dests: destinations of the feed, defaults to :meth:`.route`.
+        """
+        key = (feed.uin, feed.abstime)
+        if (slot := self.slots.get(key)) is None:
+            slot = self.slots[key] = FeedSlot(feed, dests or self.route(feed))
+        return slot
+
+    def _build(self, slot: FeedSlot, feed: FeedContent):
+        """Split the feed into atoms in background. The feed content is released after that."""
+
+        async def build():
+            try:
+                atoms, reply_markup = await asyncio.gather(
+                    self.splitter.split(feed), self.reply_markup(feed)
+                )
+            finally:
+                slot.feed = _base_feed(feed)
+
+            # log input
+            log.debug(f"got atoms: {atoms}")
+            log.debug(f"got reply_markup: {reply_markup}")
+
+            # set chat_id fields
+            for p in atoms:
+                p.kwds.update(chat_id=slot.chat_id)
+
+            # set reply_markup fields
+            if reply_markup:
+                if part := next(filter(lambda p: not isinstance(p, MediaGroupAtom), atoms), None):
+                    part.reply_markup = reply_markup
+
+            slot.state = list(atoms)
+
+        slot.ready = asyncio.create_task(build())
+
+    def _materialize(self, slot: FeedSlot) -> asyncio.Task[None] | None:
+        """Start building atoms of a planned feed and its forwardee.
+
+        :return: the building task of the feed, None if its atoms are given already.
+        """
+        for s in (slot.forward, slot):
+            if s is not None and s.ready is None and s.plan is not None:
+                self._build(s, s.plan)
+                s.plan = None
+        return slot.ready
+
+    def add(
+        self,
+        bid: int,
+        feed: FeedContent,
+        forward_mid: list[int] | None = None,
+        forward_copied: Mapping[ChatId, list[int]] | None = None,
+    ):
         """Add a feed into queue. The :obj:`bid` should equal to current :obj:`~MsgQueue.bid`, or
         the feed will be dropped directly.
 
-        This operation will:
+        The feed is only planned here. When it is about to be sent, this will be done:
 
         1. Split the feed into atoms.
-        2. Add ``chat_id`` field into atom keywords, according to :obj:`.forward_map`.
+        2. Add ``chat_id`` field into atom keywords, according to :meth:`.route`.
         3. Attach `reply_markup` to atoms.
 
+        The forwardee is sent to the same chats as the feed, so that the feed can reply to it.
+
         :param bid: batch id, should equals to current `.bid`.
         :param feed: the feed to add into queue.
-        :param forward_mid: forward message ids.
+        :param forward_mid: message ids of the forwardee in the chat the feed is uploaded to.
+        :param forward_copied: message ids of the forwardee in other destinations of the feed.
+
+        .. versionchanged:: 0.9.9.dev3
+
+            Add ``forward_copied``.
         """
         if bid != self.bid:
             log.warning(f"incoming bid ({bid}) != current bid ({self.bid}), skipped.")
             return
 
-        last_feed = self._dup_cache.get(feed.uin)
-        if last_feed is None or last_feed.abstime > feed.abstime:
-            self._dup_cache[feed.uin] = feed
+        last = self._dup_cache.get(feed.uin)
+        if last is None or last[0] > feed.abstime:
+            self._dup_cache[feed.uin] = (feed.abstime, feed.entities)
 
         # check if this is duplicated
-        if (
-            last_feed
-            # and self.feed_state[last_feed]  # BUG: must be waited
-            and abs(feed.abstime - last_feed.abstime) < 1000
-        ):
+        if last and abs(feed.abstime - last[0]) < 1000:
             # compare with last feed
-            if last_feed.entities == feed.entities:
-                log.info(f"Feed {last_feed} and {feed} has the same content. Skip the last one.")
+            if last[1] == feed.entities:
+                log.info(f"Feed {feed} has the same content with the last one. Skipped.")
                 # if all entities are the same, save the last mid and continue.
                 return
 
-        def set_atom_keywords(
-            f: FeedContent,
-            atoms: Sequence[MsgAtom],
-            reply_markup: ReplyMarkup | None,
-        ):
-            # log input
-            log.debug(f"got atoms: {atoms}")
-            log.debug(f"got reply_markup: {reply_markup}")
+        slot = self._slot(feed)
+        if slot.seq >= 0:
+            log.debug(f"{slot} is added already, skipped.")
+            return
+        slot.seq = self.add_num
+        slot.text_only = not feed.media and feed.forward is None
+        self.add_num += 1
+        heappush(self._heap, (feed.abstime, slot.seq, slot))
+        if self.window is not None:
+            loop = asyncio.get_running_loop()
+            self._timers.append(loop.call_later(self.window, self._release_due, slot))
+        if slot.ready is None and not slot.state:
+            slot.plan = feed
+
+        if isinstance(ff := feed.forward, FeedContent):
+            slot.forward = fslot = self._slot(ff, (slot.chat_id, *slot.copies))
+            if forward_copied:
+                fslot.copied.update(forward_copied)
+            if forward_mid:
+                fslot.state = forward_mid
+            elif fslot.ready is None and not fslot.state:
+                fslot.plan = ff
+
+    async def _send_atom(self, atom: Atom, key: Hashable) -> list[int]:
+        """Send an atom. Errors are classified by :func:`.classify`, and retried according to
+        :obj:`.policy`.
 
-            # set chat_id fields
-            chat_id = self.forward_map[f.uin]
-            for p in atoms:
-                p.kwds.update(chat_id=chat_id)
+        :param atom: a :class:`MsgPartial` object
+        :param key: key of errors in :obj:`.exc_groups`, usually the :obj:`FeedKey` of the feed
+        :return: a list of message ids.
+        :raise RetryExhausted: if the retry budget of an error class is used up.
 
-            # set reply_markup fields
-            if reply_markup:
-                if part := next(filter(lambda p: not isinstance(p, MediaGroupAtom), atoms), None):
-                    part.reply_markup = reply_markup
+        .. versionchanged:: 0.9.9.dev3
 
-            # push into queue
-            self.feed_state[f] = list(atoms)
-
-        insort(self._send_order, feed)
-        self.ch_feed[feed].add_awaitable(
-            asyncio.gather(
-                self.splitter.split(feed),
-                self.reply_markup(feed),
-            ),
-        ).add_done_callback(lambda s: set_atom_keywords(feed, *s.result()))
-
-        if forward_mid:
-            assert isinstance(feed.forward, FeedContent)
-            self.feed_state[feed.forward] = forward_mid
-        elif isinstance(ff := feed.forward, FeedContent):
-            self.ch_feed[ff].add_awaitable(
-                asyncio.gather(
-                    self.splitter.split(ff),
-                    self.reply_markup(ff),
-                ),
-            ).add_done_callback(lambda s: set_atom_keywords(ff, *s.result()))
-
-    @retry(
-        stop=stop_after_attempt(MAX_RETRY),
-        wait=wait_exponential(max=60),
-        retry=retry_if_exception_type(TryAgain),
-    )
-    async def _send_atom(self, atom: Atom, feed: FeedContent) -> list[int]:
+            Retry by error classes instead of a fixed number of attempts.
         """
-        :param atom: a :class:`MsgPartial` object
-        :param feed: the feed to be sent
-        :return: a list of message ids if success, or a `MsgPartial` if resend, or None if skip.
+        failures: Counter[ErrorClass] = Counter()
+        media = atom if isinstance(atom, (MediaAtom, MediaGroupAtom)) else None
+        if media and media.use_file_ids(self.file_ids):
+            log.debug("send medias by file_id.")
+        while True:
+            log.debug(f"sending atom {atom}.")
+            try:
+                match r := await self._send_atom_paced(atom):
+                    case Message():
+                        mids = [r.message_id]
+                    case _ if isinstance(r, Sequence):
+                        mids = [i.message_id for i in r]
+                    case _:
+                        raise ValueError
+            except asyncio.CancelledError:
+                raise
+            except BaseException as e:
+                self.exc_groups[key].append(e)
+                kind = classify(e)
+                failures[kind] += 1
+                if kind == ErrorClass.PERMANENT:
+                    log.error(
+                        "Uncaught %s in send_%s.", e.__class__.__name__, atom.meth, exc_info=e
+                    )
+                    self._failed.add(key)
+                    raise
+                if self.policy.exhausted(kind, failures[kind]):
+                    log.error(f"{kind} error in send_{atom.meth}, give up: {e}")
+                    self._failed.add(key)
+                    raise RetryExhausted(kind, e) from e
+                if not await self._fix_atom(atom, e, kind):
+                    self._failed.add(key)
+                    raise
+                await asyncio.sleep(self.policy.wait(kind, failures[kind]))
+                continue
+
+            log.debug("atom is sent successfully.")
+            if media and (ids := media.sent_file_ids(r)):  # type: ignore
+                await self.file_uploaded.emit(ids)
+            return mids
+
+    async def _fix_atom(self, atom: Atom, e: BaseException, kind: ErrorClass) -> bool:
+        """Prepare an atom for the next attempt.
+
+        :return: whether the atom can be retried.
+        """
+        if kind == ErrorClass.NETWORK:
+            log.info(f"发送失败（{e.__class__.__name__}）：等待重发")
+            if isinstance(e, asyncio.TimeoutError):
+                # the message may have been sent, mark the resent one
+                if atom.text is None:
+                    atom.text = Text("🔁")
+                elif len(atom.text) < (
+                    MAX_TEXT_LENGTH if atom.meth == "message" else CAPTION_LENGTH
+                ):
+                    atom.text = Text("🔁", atom.text)
+            return True
+
+        assert isinstance(e, BadRequest)
+        reason = e.message.lower()
+        log.error(f"BadRequest in _send_atom: {reason}")
+        if "replied message not found" in reason:
+            if atom.reply_to_message_id is not None:
+                atom.reply_to_message_id = None
+                log.warning("'reply_to_message_id' keyword removed.")
+                return True
+            log.error("'reply_to_message_id' keyword not found, skip.")
+            log.debug(atom)
+        elif isinstance(atom, (MediaAtom, MediaGroupAtom)) and atom.drop_file_ids():
+            log.warning("file_id is rejected, send the media again.")
+            return True
+        elif isinstance(self.splitter, FetchSplitter):
+            if isinstance(atom, (MediaAtom, MediaGroupAtom)):
+                await self.splitter.force_bytes(atom)
+                return True
+            log.error("no file is to be sent, skip.")
+            log.debug(atom)
+        else:
+            log.warning("fetch is not enabled, skip.")
+        return False
+
+    async def _send_atom_paced(self, atom: Atom):
+        """Send an atom when :obj:`.breaker` is closed and :obj:`.limiter` allows.
+        ``TelegramRetryAfter`` is waited and retried here, so it never counts toward any budget.
+        Atoms are sent with :obj:`~Priority.BULK` priority, so interactive replies go first.
         """
-        log.debug(f"sending atom {atom}.")
+        with use_priority(Priority.BULK):
+            chat_id = atom.kwds.get("chat_id", "")
+            while True:
+                await self.breaker.wait()
+                try:
+                    await self.limiter.acquire(chat_id, atom.message_num)
+                except asyncio.CancelledError:
+                    # this sender may be the probe, let another one probe
+                    self.breaker.cancel()
+                    raise
+                try:
+                    r = await atom(self.bot)
+                except TelegramRetryAfter as e:
+                    self.breaker.record(ErrorClass.RETRY_AFTER)
+                    self.limiter.retry_after(chat_id, e.retry_after)
+                    continue
+                except asyncio.CancelledError:
+                    self.breaker.cancel()
+                    raise
+                except BaseException as e:
+                    self.breaker.record(classify(e))
+                    raise
+                self.breaker.record(None)
+                return r
+
+    async def send_chain(
+        self, chain: Sequence[tuple[Atom, list[int] | None]], key: Hashable, reply: bool = True
+    ) -> list[list[int]]:
+        """Send atoms one by one, each replies to the previous one. This is used to resume
+        sending atoms which are not created by :meth:`.add`.
+
+        :param chain: atoms and their message ids. Atoms with message ids are skipped.
+        :param key: key of errors in :obj:`.exc_groups`.
+        :param reply: whether atoms reply to the previous one. Copies do not.
+        :return: message ids of each atom, empty if failed.
+
+        .. versionadded:: 0.9.9.dev3
+        """
+        last: int | None = None
+        r: list[list[int]] = []
+        for atom, mids in chain:
+            if not mids:
+                if reply and last is not None:
+                    atom.reply_to_message_id = last
+                mids = []
+                with suppress(RetryExhausted):
+                    mids = await self._send_atom(atom, key)
+                if mids:
+                    await self.atom_sent.emit(atom, mids)
+            if mids:
+                last = mids[-1]
+            r.append(mids)
+        return r
+
+    async def send_digest(
+        self, chain: Sequence[tuple[TextAtom, list[int] | None]], key: Hashable
+    ) -> list[int]:
+        """Send text atoms of several feeds as one digest message. This is also used to resume
+        sending a digest.
+
+        :param chain: atoms and their message ids. If any atom has message ids, the digest is
+            sent already and these ids are shared by all atoms.
+        :param key: key of errors in :obj:`.exc_groups`.
+        :return: message ids of the digest, empty if failed.
+
+        .. versionadded:: 0.9.9.dev3
+        """
+        if mids := next((m for _, m in chain if m), None):
+            return mids
+        mids = []
         try:
-            match await atom(self.bot):
-                case Message() as r:
-                    log.debug("atom is sent successfully.")
-                    return [r.message_id]
-                case r if isinstance(r, Sequence):
-                    log.debug("atom is sent successfully.")
-                    return [i.message_id for i in r]
-                case _:
-                    raise ValueError
-        except asyncio.TimeoutError as e:
-            self.exc_groups[feed].append(e)
-            log.debug(f"current timeout={atom.timeout:.2f}")
-            log.info("发送超时：等待重发")
-            # log.debug(f"increased timeout={atom.timeout:.2f}")
-            if atom.text is None:
-                atom.text = Text("🔁")
-            elif len(atom.text) < (MAX_TEXT_LENGTH if atom.meth == "message" else CAPTION_LENGTH):
-                atom.text = Text("🔁", atom.text)
-            raise TryAgain
-        except BadRequest as e:
-            self.exc_groups[feed].append(e)
-            reason = e.message.lower()
-            log.error(f"BadRequest in _send_atom_once: {reason}")
-            if "replied message not found" in reason:
-                if atom.reply_to_message_id is not None:
-                    atom.reply_to_message_id = None
-                    log.warning("'reply_to_message_id' keyword removed.")
-                    raise TryAgain
-                log.error("'reply_to_message_id' keyword not found, skip.")
-                log.debug(atom)
-            elif "http url content" in reason:
-                if isinstance(self.splitter, FetchSplitter):
-                    if isinstance(atom, (MediaAtom, MediaGroupAtom)):
-                        await self.splitter.force_bytes(atom)
-                        raise TryAgain
-                    log.error("no file is to be sent, skip.")
-                    log.debug(atom)
-                else:
-                    log.warning("fetch is not enabled, skip.")
-            raise
-        except BaseException as e:
-            self.exc_groups[feed].append(e)
-            log.error("Uncaught %s in send_%s.", e.__class__.__name__, atom.meth, exc_info=e)
-            raise
-
-    async def _send_one_feed(self, feed: FeedContent) -> None:
-        await self.ch_feed[feed].wait(wait_new=False)
-        assert feed in self.feed_state
-        log.debug(f"sending feed {feed.uin}{feed.abstime}.")
-
-        atoms = self.feed_state[feed]
+            mids = await self._send_atom(digest_atom([a for a, _ in chain]), key)
+        except Exception:
+            # logged in _send_atom
+            pass
+        if mids:
+            for atom, _ in chain:
+                await self.atom_sent.emit(atom, mids)
+        return mids
+
+    async def _send_one_feed(self, slot: FeedSlot) -> None:
+        self._materialize(slot)
+        fwd = slot.forward
+        if fwd is not None and fwd.ready is not None:
+            await asyncio.wait([fwd.ready])
+        if slot.ready is not None:
+            await slot.ready
+        log.debug(f"sending feed {slot.key}.")
+
         reply: int | None = None
 
-        async def _send_atom_with_reply(atom: Atom, feed: FeedContent):
+        chain = [(s.feed, s.state) for s in (fwd, slot) if s and s.state and all_is_atom(s.state)]
+        if chain:
+            await self.chain_ready.emit(slot.feed, chain)
+
+        async def _send_atom_with_reply(atom: Atom, key: FeedKey):
             nonlocal reply
             if reply is not None:
                 atom.reply_to_message_id = reply
 
             r = []
-            with suppress(RetryError):
-                r = await self._send_atom(atom, feed)
+            with suppress(RetryExhausted):
+                r = await self._send_atom(atom, key)
             if r:
                 reply = r[-1]
+                await self.atom_sent.emit(atom, r)
             return r
 
-        # send forward
-        if isinstance(feed.forward, FeedContent):
-            await self.ch_feed[feed.forward].wait(wait_new=False)
-            assert feed.forward in self.feed_state
+        async def _send_atoms(s: FeedSlot, atoms: list[Atom]):
+            mids: list[int] = []
+            for p in atoms:
+                # the markup is lost in copied messages, record it to be added back
+                markup = p.reply_markup
+                if (r := await _send_atom_with_reply(p, s.key)) and markup is not None:
+                    s.markup = (len(mids) + len(r) - 1, markup)
+                mids.extend(r)
+            s.state = mids
 
-            if atoms_forward := self.feed_state[feed.forward]:
+        # send forward
+        if fwd is not None:
+            if atoms_forward := fwd.state:
                 if all_is_atom(atoms_forward):
-                    mids = sum(
-                        [await _send_atom_with_reply(p, feed.forward) for p in atoms_forward], []
-                    )
-                    self.feed_state[feed.forward] = mids
+                    await _send_atoms(fwd, atoms_forward)
                 else:
                     assert all_is_mid(atoms_forward)
                     log.info(f"Forward feed is skipped with message ids {atoms_forward}")
@@ -292,15 +615,197 @@ class SendQueue(QueueHook):
                         reply = atoms_forward[-1]
 
         # send feed
+        atoms = slot.state
         assert atoms
         if all_is_atom(atoms):
-            mids = sum([await _send_atom_with_reply(p, feed) for p in atoms], [])
-            self.feed_state[feed] = mids
+            await _send_atoms(slot, atoms)
         else:
             assert all_is_mid(atoms)
             log.info(f"Feed is skipped with message ids {atoms}")
             if atoms:
                 reply = atoms[-1]
 
-    def send_all(self) -> dict[FeedContent, asyncio.Task[None]]:
-        return {feed: asyncio.create_task(self._send_one_feed(feed)) for feed in self._send_order}
+    async def _send_in_lane(self, slot: FeedSlot, prev: asyncio.Task | None) -> None:
+        # atoms are built while waiting for the previous feed, but only a few feeds ahead
+        async with self._prefetch:
+            self._materialize(slot)
+            if prev is not None:
+                # the previous feed in this lane is done, no matter it succeeded or not
+                await asyncio.wait([prev])
+            async with self._sem:
+                await self._send_one_feed(slot)
+
+    def _copy_atoms(self, slot: FeedSlot, chat_id: ChatId) -> list[CopyAtom]:
+        """Atoms to copy sent messages of a feed into another chat. The message with
+        ``reply_markup`` is copied alone, so that its markup is kept."""
+        mids = slot.state
+        assert all_is_mid(mids)
+        i, markup = slot.markup or (len(mids), None)
+        atoms: list[CopyAtom] = []
+        for seg, reply_markup in (
+            (mids[:i], None),
+            (mids[i : i + 1], markup),
+            (mids[i + 1 :], None),
+        ):
+            for chunk in split_by_len(seg, MAX_COPY_MESSAGES):
+                atom = CopyAtom(slot.chat_id, chunk, chat_id=chat_id)
+                if reply_markup is not None:
+                    atom.reply_markup = reply_markup
+                atoms.append(atom)
+        return atoms
+
+    async def _copy_one_feed(self, slot: FeedSlot, chat_id: ChatId) -> None:
+        """Copy a sent feed, and its forwardee if not copied yet, into a chat.
+        Message ids are saved in :obj:`FeedSlot.copied`. Copies are emitted by
+        :obj:`.chain_ready` and :obj:`.atom_sent` like other atoms, so they can be resumed."""
+        for s in (slot.forward, slot):
+            if s is None or chat_id == s.chat_id or chat_id in s.copied:
+                continue
+            if not s.state or not all_is_mid(s.state):
+                continue
+            log.debug(f"copying {s} to {chat_id}.")
+            mids = s.copied[chat_id] = []
+            atoms = self._copy_atoms(s, chat_id)
+            await self.chain_ready.emit(s.feed, [(s.feed, atoms)])
+            for atom in atoms:
+                try:
+                    r = await self._send_atom(atom, (s.key, chat_id))
+                except asyncio.CancelledError:
+                    raise
+                except BaseException:
+                    # logged in _send_atom
+                    break
+                mids.extend(r)
+                await self.atom_sent.emit(atom, r)
+
+    async def _copy_in_lane(
+        self, slot: FeedSlot, chat_id: ChatId, sent: asyncio.Task, prev: asyncio.Task | None
+    ) -> None:
+        await asyncio.wait([sent] if prev is None else [sent, prev])
+        async with self._sem:
+            await self._copy_one_feed(slot, chat_id)
+
+    @staticmethod
+    async def _join(sent: asyncio.Task[None], copies: list[asyncio.Task[None]]) -> None:
+        """Wait for a feed to be sent and copied. Only errors of sending are raised."""
+        try:
+            await sent
+        finally:
+            await asyncio.wait(copies)
+
+    async def _send_shared(self, slot: FeedSlot) -> None:
+        """Send a feed whose task is shared with other feeds, so its errors are not raised."""
+        try:
+            await self._send_one_feed(slot)
+        except Exception:
+            log.error(f"error when sending {slot}", exc_info=True)
+            slot.state = []
+
+    async def _send_packed(self, slots: list[FeedSlot]) -> None:
+        """Pack text-only feeds into digests and send them. A feed left alone is sent as usual."""
+        atoms: list[TextAtom] = [s.state[0] for s in slots]  # type: ignore
+        for group in pack_digest([a.text for a in atoms], self.digest):  # type: ignore
+            if len(group) == 1:
+                await self._send_shared(slots[group[0]])
+                continue
+
+            packed = [slots[i] for i in group]
+            log.debug(f"sending {len(packed)} feeds in a digest.")
+            await self.chain_ready.emit(
+                packed[0].feed, [(s.feed, s.state) for s in packed], packed=True
+            )
+            mids = await self.send_digest([(atoms[i], None) for i in group], packed[0].key)
+            for line, s in enumerate(packed, 1):
+                s.state = mids
+                s.packed = line
+
+    async def _send_digest(self, slots: list[FeedSlot]) -> None:
+        """Send feeds of a digest. Runs of packable feeds are packed, others are sent as usual."""
+        if ready := [t for s in slots if (t := self._materialize(s)) is not None]:
+            await asyncio.wait(ready)
+
+        run: list[FeedSlot] = []
+        for s in [*slots, None]:
+            if s is not None and len(s.state) == 1 and type(s.state[0]) is TextAtom:
+                run.append(s)
+                continue
+            if run:
+                await self._send_packed(run)
+                run = []
+            if s is not None:
+                await self._send_shared(s)
+
+    async def _send_digest_in_lane(
+        self, chat_id: ChatId, slots: list[FeedSlot], prev: asyncio.Task | None
+    ) -> None:
+        async with self._prefetch:
+            if prev is not None:
+                await asyncio.wait([prev])
+            async with self._sem:
+                # no more feeds can join once sending starts
+                if (d := self._digests.get(chat_id)) and d[0] is slots:
+                    del self._digests[chat_id]
+                await self._send_digest(slots)
+
+    def _release_packable(self, slot: FeedSlot):
+        """Append a text-only feed to the digest of its chat, if the digest is the last one in
+        the lane and has not started sending. Otherwise a new digest is appended to the lane."""
+        chat_id = slot.chat_id
+        d = self._digests.get(chat_id)
+        if d is None or self._lanes.get(chat_id) is not d[1] or len(d[0]) >= self.digest:
+            slots: list[FeedSlot] = []
+            t = asyncio.create_task(
+                self._send_digest_in_lane(chat_id, slots, self._lanes.get(chat_id))
+            )
+            self._lanes[chat_id] = t
+            d = self._digests[chat_id] = (slots, t)
+        d[0].append(slot)
+        slot.task = self._tasks[slot.key] = d[1]
+
+    def _release(self, slot: FeedSlot):
+        """Append a feed to the lane of its destination chat. Feeds in a lane are sent one by
+        one, and at most ``max_lanes`` lanes are sent in parallel.
+
+        Copies of the feed are appended to lanes of other destinations, so feeds are kept in
+        order in every chat. Text-only feeds sent to only one chat may be packed into digests.
+        """
+        if self.digest > 1 and slot.text_only and not slot.copies:
+            return self._release_packable(slot)
+        t = asyncio.create_task(self._send_in_lane(slot, self._lanes.get(slot.chat_id)))
+        self._lanes[slot.chat_id] = t
+        copies = []
+        for chat_id in slot.copies:
+            c = asyncio.create_task(self._copy_in_lane(slot, chat_id, t, self._lanes.get(chat_id)))
+            copies.append(c)
+            self._lanes[chat_id] = c
+        if copies:
+            t = asyncio.create_task(self._join(t, copies))
+        slot.task = self._tasks[slot.key] = t
+
+    def _release_due(self, slot: FeedSlot):
+        """Release a feed whose window is over, together with feeds before it in sending order
+        so that they are not sent after later ones."""
+        while slot.task is None and self._heap:
+            self._release(heappop(self._heap)[-1])
+
+    @property
+    def released(self) -> dict[FeedKey, asyncio.Task[None]]:
+        """Sending tasks of feeds released so far.
+
+        .. versionadded:: 0.9.9.dev3
+        """
+        return dict(self._tasks)
+
+    def send_all(self) -> dict[FeedKey, asyncio.Task[None]]:
+        """Send all feeds in this batch which are not sent yet. Feeds are sent in the order of
+        ``abstime`` in each destination chat.
+
+        :return: a task per feed key, including those released in streaming mode.
+
+        .. versionchanged:: 0.9.9.dev3
+
+            Keep feeds in order in each chat. Keyed by :obj:`FeedKey`.
+        """
+        while self._heap:
+            self._release(heappop(self._heap)[-1])
+        return self.released
@@ -0,0 +1,213 @@
+"""Rate limits of sending messages.
+
+Telegram limits a bot to about 1 message per second in one chat and 30 messages per second
+in total. Exceeding them results in :external:class:`aiogram.exceptions.TelegramRetryAfter`.
+This module paces sending proactively with token buckets, and honors ``retry_after`` exactly.
+
+All requests of a bot share one budget through :class:`RateLimitMiddleware`. Interactive
+replies are served before bulk sends which wait for the same buckets, according to the
+:class:`Priority` of the context they are made in.
+
+.. versionadded:: 0.9.9.dev3
+"""
+
+import asyncio
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from heapq import heappop, heappush
+from itertools import count
+from math import inf
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware,
+    NextRequestMiddlewareType,
+)
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    CopyMessages,
+    ForwardMessages,
+    SendChatAction,
+    SendMediaGroup,
+    TelegramMethod,
+)
+
+from . import ChatId
+
+log = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    """Priority of requests. Waiters with a smaller value are served first."""
+
+    INTERACTIVE = 0
+    """Replies to the user, such as answering a button or prompting a captcha."""
+    BULK = 1
+    """Sending feeds."""
+
+
+current_priority: ContextVar[Priority] = ContextVar(
+    "current_priority", default=Priority.INTERACTIVE
+)
+"""Priority of requests made in the current context. Requests are interactive by default."""
+
+
+@contextmanager
+def use_priority(priority: Priority):
+    """Make requests in this block with the given priority."""
+    token = current_priority.set(priority)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+class TokenBucket:
+    """A token bucket. Tokens are refilled at :obj:`.rate` per second, up to :obj:`.burst`.
+    Waiters acquire tokens in the order of :class:`Priority`, and in FIFO order within one
+    priority.
+
+    :param rate: tokens per second. ``inf`` means no limit.
+    :param burst: capacity of the bucket.
+    """
+
+    def __init__(self, rate: float, burst: float = 1) -> None:
+        assert rate > 0 and burst >= 1
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = 0.0
+        self._paused_until = 0.0
+        self._busy = False
+        """Whether a waiter is taking tokens."""
+        self._waiters: list[tuple[Priority, int, asyncio.Future[None]]] = []
+        self._seq = count()
+
+    def _refill(self, now: float):
+        if self._last:
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for the given seconds, and drain the bucket."""
+        now = asyncio.get_running_loop().time()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = 0
+        self._last = self._paused_until
+
+    async def _enter(self, priority: Priority):
+        if not self._busy and not self._waiters:
+            self._busy = True
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heappush(self._waiters, (priority, next(self._seq), fut))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # the turn is handed over just before cancelled
+                self._leave()
+            raise
+
+    def _leave(self):
+        while self._waiters:
+            fut = heappop(self._waiters)[-1]
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self._busy = False
+
+    async def acquire(self, n: float = 1, priority: Priority | None = None):
+        """Wait until :obj:`n` tokens are available and take them.
+        :obj:`n` larger than :obj:`.burst` is clipped to it.
+
+        :param priority: defaults to :obj:`current_priority`.
+        """
+        n = min(n, self.burst)
+        loop = asyncio.get_running_loop()
+        await self._enter(current_priority.get() if priority is None else priority)
+        try:
+            while True:
+                now = loop.time()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                if self.rate == inf:
+                    return
+                self._refill(now)
+                if self._tokens >= n:
+                    self._tokens -= n
+                    return
+                await asyncio.sleep((n - self._tokens) / self.rate)
+        finally:
+            self._leave()
+
+
+class RateLimiter:
+    """Per-chat and global token buckets.
+
+    :param global_rate: messages per second of all chats.
+    :param chat_rate: messages per second of each chat.
+    :param chat_burst: max messages sent at once in a chat.
+    """
+
+    def __init__(
+        self, global_rate: float = inf, chat_rate: float = inf, chat_burst: float = 1
+    ) -> None:
+        self.glob = TokenBucket(global_rate, burst=max(1, global_rate if global_rate < inf else 1))
+        self.chats: defaultdict[ChatId, TokenBucket] = defaultdict(
+            lambda: TokenBucket(chat_rate, burst=chat_burst)
+        )
+
+    async def acquire(self, chat_id: ChatId, n: int = 1, priority: Priority | None = None):
+        """Wait until :obj:`n` messages can be sent to the chat.
+
+        :param priority: defaults to :obj:`current_priority`.
+        """
+        await self.chats[chat_id].acquire(n, priority)
+        await self.glob.acquire(n, priority)
+
+    def retry_after(self, chat_id: ChatId, seconds: float):
+        """Pause the chat for ``retry_after`` seconds told by telegram."""
+        log.warning(f"chat {chat_id} is flood limited, retry after {seconds}s")
+        self.chats[chat_id].pause(seconds)
+
+
+def message_num(method: TelegramMethod) -> int:
+    """Number of messages a request sends, counted by rate limits."""
+    match method:
+        case SendMediaGroup():
+            return len(method.media)
+        case CopyMessages() | ForwardMessages():
+            return len(method.message_ids)
+        case SendChatAction():
+            return 0
+    return int(type(method).__name__.startswith(("Send", "Copy", "Forward")))
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """Paces all messages sent by a bot session with a :class:`RateLimiter`. Other requests,
+    such as answering callback queries, are not paced.
+
+    .. code-block:: python
+
+        session.middleware(RateLimitMiddleware(limiter))
+    """
+
+    def __init__(self, limiter: RateLimiter) -> None:
+        self.limiter = limiter
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not (n := message_num(method)):
+            return await make_request(bot, method)
+
+        await self.limiter.acquire(chat_id, n)
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            self.limiter.retry_after(chat_id, e.retry_after)
+            raise
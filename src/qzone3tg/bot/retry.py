@@ -0,0 +1,179 @@
+"""Retry policy of sending atoms.
+
+Errors are classified by :func:`classify`, and each class has its own retry budget in
+:class:`RetryPolicy`. Consecutive network errors trip a shared :class:`CircuitBreaker`, which
+pauses all sending until telegram is reachable again, so that atoms do not burn their
+budgets against a dead network one by one.
+
+.. versionadded:: 0.9.9.dev3
+"""
+
+import asyncio
+import logging
+from enum import StrEnum
+from typing import Final, Mapping
+
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from aiohttp import ClientError
+
+MAX_RETRY: Final[int] = 2
+"""Default retry budget of each error class."""
+
+log = logging.getLogger(__name__)
+
+PAYLOAD_REASONS = (
+    "replied message not found",
+    "http url content",
+    "wrong file identifier/http url specified",
+    "wrong type of the web page content",
+)
+"""Reasons of :exc:`TelegramBadRequest` which can be fixed by changing the payload."""
+
+
+class ErrorClass(StrEnum):
+    PERMANENT = "permanent"
+    """Retrying does not help, e.g. an unknown bad request."""
+    RETRY_AFTER = "retry_after"
+    """Flood limited. The atom is resent after ``retry_after`` seconds."""
+    NETWORK = "network"
+    """Transient network error, such as a timeout or a dead proxy."""
+    PAYLOAD = "payload"
+    """Telegram rejects the payload, which can be fixed before retrying."""
+
+
+def classify(exc: BaseException) -> ErrorClass:
+    match exc:
+        case TelegramRetryAfter():
+            return ErrorClass.RETRY_AFTER
+        case asyncio.TimeoutError() | TelegramNetworkError() | TelegramServerError():
+            return ErrorClass.NETWORK
+        case ClientError() | ConnectionError():
+            return ErrorClass.NETWORK
+        case TelegramBadRequest() if any(r in exc.message.lower() for r in PAYLOAD_REASONS):
+            return ErrorClass.PAYLOAD
+        case _:
+            return ErrorClass.PERMANENT
+
+
+class RetryExhausted(Exception):
+    """Raised when the retry budget of an error class is used up."""
+
+    def __init__(self, kind: ErrorClass, last: BaseException) -> None:
+        super().__init__(f"{kind} retry budget is exhausted: {last!r}")
+        self.kind = kind
+        self.last = last
+
+
+class RetryPolicy:
+    """Retry budgets and backoff of each error class.
+
+    :param budgets: max attempts which fail with each error class.
+        :obj:`~ErrorClass.RETRY_AFTER` is not limited, and :obj:`~ErrorClass.PERMANENT` is
+        never retried.
+    :param backoff: base of exponential backoff of network errors, in seconds.
+    :param max_backoff: max backoff in seconds.
+    """
+
+    def __init__(
+        self,
+        budgets: Mapping[ErrorClass, int] | None = None,
+        backoff: float = 1,
+        max_backoff: float = 60,
+    ) -> None:
+        self.budgets = {ErrorClass.NETWORK: MAX_RETRY, ErrorClass.PAYLOAD: MAX_RETRY}
+        self.budgets.update(budgets or {})
+        self.budgets[ErrorClass.PERMANENT] = 1
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def exhausted(self, kind: ErrorClass, failures: int) -> bool:
+        """Whether an atom has failed with :obj:`kind` for too many times."""
+        if kind == ErrorClass.RETRY_AFTER:
+            return False
+        return failures >= self.budgets[kind]
+
+    def wait(self, kind: ErrorClass, failures: int) -> float:
+        """Seconds to wait before the next attempt. Payload errors are fixed before retrying,
+        so there is no need to wait."""
+        if kind != ErrorClass.NETWORK:
+            return 0
+        return min(self.max_backoff, self.backoff * 2 ** (failures - 1))
+
+
+class CircuitBreaker:
+    """Shared by all senders. It opens after :obj:`threshold` consecutive network errors, and
+    senders wait in :meth:`.wait` while it is open. After :obj:`cooldown` seconds, one sender
+    is let through as a probe. The breaker closes if the probe reaches telegram, otherwise it
+    opens again with a doubled cooldown, up to :obj:`max_cooldown`.
+
+    :param threshold: consecutive network errors to open the breaker.
+    :param cooldown: seconds to wait before probing.
+    :param max_cooldown: max seconds to wait before probing.
+    """
+
+    def __init__(self, threshold: int = 5, cooldown: float = 10, max_cooldown: float = 300):
+        assert threshold >= 1
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._failures = 0
+        self._until = 0.0
+        self._next_cooldown = cooldown
+        self._probe: asyncio.Event | None = None
+        """Set when the probe is done. None if there is no probe."""
+        self.is_open = False
+
+    async def wait(self):
+        """Return at once if the breaker is closed. Otherwise wait until it closes, or until
+        this sender is chosen as the probe."""
+        loop = asyncio.get_running_loop()
+        while self.is_open:
+            if (now := loop.time()) < self._until:
+                await asyncio.sleep(self._until - now)
+            elif self._probe is None:
+                self._probe = asyncio.Event()
+                return
+            else:
+                await self._probe.wait()
+
+    def _probe_done(self):
+        if self._probe is not None:
+            self._probe.set()
+            self._probe = None
+
+    def record(self, kind: ErrorClass | None):
+        """Record the result of an attempt.
+
+        :param kind: class of the error, or None if the attempt succeeded.
+        """
+        if kind != ErrorClass.NETWORK:
+            # telegram is reachable
+            self._failures = 0
+            self._next_cooldown = self.cooldown
+            if self.is_open:
+                log.info("telegram is reachable again, resume sending.")
+                self.is_open = False
+            return self._probe_done()
+
+        self._failures += 1
+        if self.is_open and self._probe is None:
+            # attempts started before the breaker opened
+            return
+        if self.is_open or self._failures >= self.threshold:
+            cooldown = self._next_cooldown
+            self._next_cooldown = min(self.max_cooldown, cooldown * 2)
+            self._until = asyncio.get_running_loop().time() + cooldown
+            if not self.is_open:
+                log.warning(f"{self._failures} network errors in a row, pause sending.")
+            log.info(f"probe telegram after {cooldown}s")
+            self.is_open = True
+            self._probe_done()
+
+    def cancel(self):
+        """Called if an attempt is cancelled. If it is the probe, another sender will probe."""
+        self._probe_done()
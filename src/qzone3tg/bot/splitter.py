@@ -9,7 +9,7 @@ from typing import Sequence, overload
 
 import qzemoji.utils as qeu
 from aiogram.enums.input_media_type import InputMediaType
-from aiogram.types import BufferedInputFile, InputFile
+from aiogram.types import InlineKeyboardMarkup, InputFile
 from aiogram.utils.formatting import Code, Text, TextLink, as_list
 from aiogram.utils.media_group import MediaType as GroupMedia
 from aioqzone.model import AtEntity, ConEntity, EmEntity, LinkEntity, TextEntity
@@ -18,10 +18,16 @@ from aioqzone_feed.type import BaseFeed, FeedContent, VisualMedia
 from qqqr.utils.net import ClientAdapter
 from yarl import URL
 
-from .atom import MediaAtom, MediaGroupAtom, MsgAtom, TextAtom, url_basename
+from . import LIM_TXT
+from .atom import MediaAtom, MediaGroupAtom, MsgAtom, RawMedia, TextAtom, url_basename
+from .cache import SNIFF_SIZE, CachedInputFile, MediaCache, Sniff
+from .transcode import TranscodedInputFile, Transcoder
 
 log = logging.getLogger(__name__)
 
+DIGEST_SEP = "\n\n"
+"""Separator of feeds in a digest message."""
+
 
 async def stringify_entities(entities: list[ConEntity] | None) -> Text:
     """Stringify all entities and concatenate them.
@@ -68,6 +74,54 @@ def is_gif(b: bytes):
     return b.startswith((b"47494638", b"GIF89a", b"GIF87a"))
 
 
+def _digest_label(i: int) -> str:
+    return f"{i}. "
+
+
+def pack_digest(texts: Sequence[Text], max_feeds: int, limit: int = LIM_TXT) -> list[list[int]]:
+    """Greedily pack texts of consecutive feeds into digests. Each digest contains at most
+    :obj:`max_feeds` feeds, and its text, including labels and separators, is no longer than
+    :obj:`limit`.
+
+    :return: indexes of texts in each digest, in order.
+
+    .. versionadded:: 0.9.9.dev3
+    """
+    groups: list[list[int]] = []
+    size = 0
+    for i, t in enumerate(texts):
+        if groups and len(cur := groups[-1]) < max_feeds:
+            n = size + len(DIGEST_SEP) + len(_digest_label(len(cur) + 1)) + len(t)
+            if n <= limit:
+                cur.append(i)
+                size = n
+                continue
+        groups.append([i])
+        size = len(_digest_label(1)) + len(t)
+    return groups
+
+
+def digest_atom(atoms: Sequence[TextAtom]) -> TextAtom:
+    """Join text atoms of several feeds into one message. Feeds are labeled with numbers, and
+    their buttons are gathered into one keyboard, a row per feed, labeled likewise.
+
+    .. versionadded:: 0.9.9.dev3
+    """
+    texts = [Text(_digest_label(i), a.text) for i, a in enumerate(atoms, 1)]
+    rows = []
+    for i, a in enumerate(atoms, 1):
+        if isinstance(kbd := a.reply_markup, InlineKeyboardMarkup):
+            row = [b for r in kbd.inline_keyboard for b in r]
+            label = _digest_label(i)
+            rows.append([b.model_copy(update=dict(text=label + b.text)) for b in row])
+
+    kwds = {k: v for k, v in atoms[0].kwds.items() if k != "reply_markup"}
+    atom = TextAtom(as_list(*texts, sep=DIGEST_SEP), **kwds)
+    if any(rows):
+        atom.reply_markup = InlineKeyboardMarkup(inline_keyboard=[r for r in rows if r])
+    return atom
+
+
 class Splitter(ABC):
     """A splitter is a protocol that ensure an object can do the following jobs:
 
@@ -110,8 +164,9 @@ class LocalSplitter(Splitter):
 
         txt = as_list(self.header(feed), await stringify_entities(feed.entities), sep="：\n\n")
         metas = feed.media or []
-        probe_media = list(await asyncio.gather(*(self.probe(i) for i in metas)))
-        md_types = [self.guess_md_type(i or m) for i, m in zip(probe_media, metas)]
+        probes = list(await asyncio.gather(*(self.probe(i) for i in metas)))
+        md_types = [self.guess_md_type(i or m) for i, m in zip(probes, metas)]
+        probe_media = [self.upload_source(m, i) for m, i in zip(metas, probes)]
 
         pipe_objs = (txt, metas, probe_media, md_types)
 
@@ -169,11 +224,18 @@ class LocalSplitter(Splitter):
         # should not send in <a> since it is not a valid url
         return Text(richname, semt, f"分享了应用 ({feed.forward})")
 
-    async def probe(self, media: VisualMedia, **kw) -> bytes | None:
+    async def probe(self, media: VisualMedia, **kw) -> bytes | Sniff | None:
         """:class:`LocalSpliter` does not probe any media."""
         return
 
-    def guess_md_type(self, media: VisualMedia | bytes) -> InputMediaType:
+    def upload_source(self, media: VisualMedia, probe: bytes | Sniff | None) -> RawMedia:
+        """Get the content to upload from the probe result. None means sending the url.
+
+        .. versionadded:: 0.9.9.dev3
+        """
+        return probe if isinstance(probe, bytes) else None
+
+    def guess_md_type(self, media: VisualMedia | bytes | Sniff) -> InputMediaType:
         """Guess media type according to its metadata.
 
         :param media: metadata to guess
@@ -194,33 +256,89 @@ class LocalSplitter(Splitter):
 class FetchSplitter(LocalSplitter):
     """Fetch splitter has the right to fetch raw content of an url from network to make a
     more precise predict.
+
+    :param cache: medias fetched by :meth:`.probe` and :meth:`.force_bytes`. Defaults to a
+        cache in memory.
+    :param sniff: :meth:`.probe` fetches only the first bytes and the size of medias, which are
+        enough to guess their types. Medias are then sent by url, and fetched only if telegram
+        cannot fetch them.
+    :param transcoder: oversized images are transcoded into photos by it, instead of being
+        sent as documents or links.
+
+    .. versionchanged:: 0.9.9.dev3
+
+        Add ``cache``, ``sniff`` and ``transcoder``.
     """
 
-    def __init__(self, client: ClientAdapter) -> None:
+    def __init__(
+        self,
+        client: ClientAdapter,
+        cache: MediaCache | None = None,
+        sniff: bool = False,
+        transcoder: Transcoder | None = None,
+    ) -> None:
         super().__init__()
         self.client = client
+        self.cache = MediaCache(client) if cache is None else cache
+        self.sniff = sniff
+        self.transcoder = transcoder
 
-    async def probe(self, media: VisualMedia) -> bytes | None:
+    async def probe(self, media: VisualMedia) -> bytes | Sniff | None:
         """:meth:`FetchSplitter.probe` will fetch the media from remote.
 
         :param media: metadata to fetch
+        :return: :class:`~qzone3tg.bot.cache.Sniff` of the media. The whole media is fetched
+            into :obj:`.cache` unless in sniffing mode, but it is not held here.
+            If the media is transcoded, the transcoded image is returned.
         """
 
         if media.is_video:
             return  # video is too large to get
-        if media.height + media.width > 1e4:
+        oversized = Transcoder.oversized(None, media.width, media.height)
+        if oversized and self.transcoder is None:
             return  # media is too large, it will be sent as document/link
 
+        url = str(media.raw)
         try:
             # fetch the media to probe correctly
-            async with self.client.get(str(media.raw)) as r:
-                return await r.content.read()
+            if self.sniff and not oversized:
+                sniff = await self.cache.sniff(url)
+                if not self._should_transcode(sniff):
+                    return sniff
+            data = await self.cache.get(url)
+            sniff = Sniff(data[:SNIFF_SIZE], len(data))
+            if oversized or self._should_transcode(sniff):
+                assert self.transcoder
+                if (r := await self.transcoder(data, self.cache.digest(url))) is not None:
+                    return r
+                if oversized:
+                    return
+            return sniff
         except:
             # give-up if error
             log.warning("Error when probing", exc_info=True)
             return
 
-    def guess_md_type(self, media: VisualMedia | bytes) -> InputMediaType:
+    def _should_transcode(self, sniff: Sniff) -> bool:
+        if self.transcoder is None or is_gif(sniff.head):
+            return False
+        return self.transcoder.oversized(sniff.size)
+
+    def upload_source(self, media: VisualMedia, probe: bytes | Sniff | None) -> RawMedia:
+        """Fetched medias are streamed from :obj:`.cache` when uploading, so that their bytes are
+        not held until sent. So are transcoded images, unless they do not fit in the cache."""
+        url = str(media.raw)
+        if isinstance(probe, bytes):
+            # only transcoded images are probed as bytes
+            if self.transcoder and (digest := self.cache.digest(url)) is not None:
+                if self.cache.digest(self.transcoder.key(digest)) is not None:
+                    return TranscodedInputFile(self.transcoder, url, digest, url_basename(url))
+            return probe
+        if self.sniff or probe is None:
+            return
+        return CachedInputFile(self.cache, url, url_basename(url))
+
+    def guess_md_type(self, media: VisualMedia | bytes | Sniff) -> InputMediaType:
         """Guess media type using media raw, otherwise by metadata.
 
         :param media: metadata to guess
@@ -229,13 +347,14 @@ class FetchSplitter(LocalSplitter):
             # super class handles VisualMedia well
             return super().guess_md_type(media)
 
-        if len(media) > 5e7:
+        head, size = media if isinstance(media, Sniff) else (media, len(media))
+        if size is not None and size > 5e7:
             return InputMediaType.DOCUMENT
 
-        if is_gif(media):
+        if is_gif(head):
             return InputMediaType.ANIMATION
 
-        if len(media) > 1e7:
+        if size is not None and size > 1e7:
             return InputMediaType.DOCUMENT
         return InputMediaType.PHOTO
 
@@ -277,8 +396,8 @@ class FetchSplitter(LocalSplitter):
 
                 log.info(f"force fetch a {call.meth}: {media}")
                 try:
-                    async with self.client.get(media) as r:
-                        call._raw = BufferedInputFile(await r.content.read(), url_basename(media))
+                    await self.cache.fetch(media)
+                    call._raw = CachedInputFile(self.cache, media, url_basename(media))
                 except:
                     log.warning(f"force fetch error, skipped: {media}", exc_info=True)
                 return call
@@ -299,12 +418,11 @@ class FetchSplitter(LocalSplitter):
             )
             return media
 
-        log.info(f"force fetch {media.type}: {media.media}")
+        url = media.media
+        log.info(f"force fetch {media.type}: {url}")
         try:
-            async with self.client.get(media.media) as r:
-                media = media.__class__(
-                    media=BufferedInputFile(await r.content.read(), url_basename(media.media))
-                )
+            await self.cache.fetch(url)
+            media = media.__class__(media=CachedInputFile(self.cache, url, url_basename(url)))
         except:
             log.warning(f"force fetch error, skipped: {media.media}", exc_info=True)
         return media
@@ -0,0 +1,185 @@
+"""Downscale and recompress oversized images to fit telegram photo limits, so that they are
+sent as photos instead of documents or links. :mod:`PIL` is required, which is installed with
+the ``transcode`` extra.
+
+Images are transcoded in a process pool, so the event loop is never blocked. Results are kept
+in :class:`~qzone3tg.bot.cache.MediaCache` by the sha256 of source images.
+
+.. versionadded:: 0.9.9.dev3
+"""
+
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+from importlib.util import find_spec
+from io import BytesIO
+from typing import AsyncGenerator, Final
+
+from aiogram import Bot
+
+from qzone3tg.utils.cache import LRUCache
+
+from .cache import CachedInputFile, MediaCache
+
+MAX_PHOTO_BYTES: Final[int] = 10**7
+"""Max size of a photo."""
+MAX_PHOTO_DIMENSIONS: Final[int] = 10000
+"""Max sum of width and height of a photo."""
+MAX_PHOTO_RATIO: Final[int] = 20
+"""Max ratio of width to height, or height to width, of a photo."""
+MIN_QUALITY: Final[int] = 40
+"""The lowest JPEG quality to try."""
+MAX_SKIPPED: Final[int] = 1024
+"""Max number of images remembered as not transcodable."""
+
+log = logging.getLogger(__name__)
+
+
+def transcode_image(data: bytes, max_side: int = 2560, quality: int = 85) -> bytes | None:
+    """Downscale an image to fit in ``max_side`` and recompress it as JPEG. The quality is
+    lowered until the result fits :obj:`MAX_PHOTO_BYTES`. This runs in worker processes.
+
+    :return: the JPEG, or None if the image is animated or too narrow to be a photo.
+    """
+    from PIL import Image
+
+    with Image.open(BytesIO(data)) as img:
+        if getattr(img, "is_animated", False):
+            return
+        w, h = img.size
+        if max(w, h) > MAX_PHOTO_RATIO * min(w, h):
+            return
+        img.thumbnail((max_side, max_side))
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        while quality >= MIN_QUALITY:
+            buf = BytesIO()
+            img.save(buf, "JPEG", quality=quality, optimize=True)
+            if buf.tell() <= MAX_PHOTO_BYTES:
+                return buf.getvalue()
+            quality -= 15
+
+
+class Transcoder:
+    """Transcodes oversized images by :func:`transcode_image` in a process pool.
+
+    :param cache: where results are kept.
+    :param max_workers: processes of the pool. Defaults to the number of CPUs.
+    :param max_side: max width and height of results.
+    :param quality: JPEG quality of results.
+    """
+
+    def __init__(
+        self,
+        cache: MediaCache,
+        max_workers: int | None = None,
+        max_side: int = 2560,
+        quality: int = 85,
+    ) -> None:
+        assert max_side * 2 <= MAX_PHOTO_DIMENSIONS
+        self.cache = cache
+        self.max_workers = max_workers
+        self.max_side = max_side
+        self.quality = quality
+        self._pool: ProcessPoolExecutor | None = None
+        self._flights: dict[str, asyncio.Future[bytes | None]] = {}
+        """Key of results to the job transcoding it."""
+        self._skip: LRUCache[str, bool] = LRUCache(MAX_SKIPPED)
+        """Keys of images which cannot be transcoded. The least recently used are forgotten."""
+
+    @staticmethod
+    def available() -> bool:
+        """Whether :mod:`PIL` is installed."""
+        return find_spec("PIL") is not None
+
+    @staticmethod
+    def oversized(size: int | None, width: int = 0, height: int = 0) -> bool:
+        """Whether an image cannot be sent as a photo without transcoding, either by its size
+        or by its dimensions. Unknown values are given as None or 0.
+        """
+        return (size or 0) > MAX_PHOTO_BYTES or width + height > MAX_PHOTO_DIMENSIONS
+
+    def key(self, digest: str) -> str:
+        """Key of the result in :obj:`.cache`.
+
+        :param digest: sha256 of the source image.
+        """
+        return f"transcode:{self.max_side}:{self.quality}:{digest}"
+
+    async def __call__(self, data: bytes, digest: str | None = None) -> bytes | None:
+        """Transcode an image. Concurrent calls with the same image share one job.
+
+        :param digest: sha256 of :obj:`data`, if known.
+        :return: the transcoded image, or None if it cannot be transcoded.
+        """
+        digest = digest or await asyncio.to_thread(lambda: sha256(data).hexdigest())
+        key = self.key(digest)
+        if self._skip.get(key):
+            return
+        if (r := await self.cache.peek(key)) is not None:
+            return r
+
+        if (fut := self._flights.get(key)) is None:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.max_workers)
+            loop = asyncio.get_running_loop()
+            fut = self._flights[key] = loop.run_in_executor(
+                self._pool, transcode_image, data, self.max_side, self.quality
+            )
+            fut.add_done_callback(lambda f: self._landed(key, f))
+
+        try:
+            r = await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            raise
+        except BaseException:
+            log.warning(f"cannot transcode image {digest}", exc_info=True)
+            r = None
+
+        if r is None:
+            self._skip[key] = True
+        else:
+            await self.cache.put(key, r)
+        return r
+
+    def _landed(self, key: str, fut: asyncio.Future):
+        self._flights.pop(key, None)
+        if not fut.cancelled():
+            fut.exception()  # retrieved even if all waiters are cancelled
+
+    def close(self):
+        """Shutdown the process pool."""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+class TranscodedInputFile(CachedInputFile):
+    """A transcoded image to be uploaded, which is streamed from :obj:`~Transcoder.cache` by its
+    key, so its bytes are not held until sent. If it is evicted before sent, it is transcoded
+    again from the source image.
+
+    :param transcoder: the transcoder which produced the image.
+    :param source: url of the source image.
+    :param digest: sha256 of the source image.
+    :param filename: filename to be propagated to telegram.
+    """
+
+    def __init__(self, transcoder: Transcoder, source: str, digest: str, filename: str):
+        super().__init__(transcoder.cache, transcoder.key(digest), filename)
+        self.transcoder = transcoder
+        self.source = source
+        self.source_digest = digest
+
+    async def read(self, bot: Bot) -> AsyncGenerator[bytes, None]:
+        if self.cache.digest(self.url) is not None:
+            async for chunk in super().read(bot):
+                yield chunk
+            return
+
+        data = await self.cache.get(self.source)
+        if (r := await self.transcoder(data, self.source_digest)) is None:
+            raise ValueError(f"cannot transcode image {self.source}")
+        for i in range(0, len(r), self.chunk_size):
+            yield r[i : i + self.chunk_size]
@@ -38,6 +38,36 @@ class UpLoginConfig(_UpConfig):
     """
 
 
+class SqliteProfile(BaseModel):
+    """SQLite 性能配置，对应 :obj:`bot.storage.profile <.StorageConfig.profile>`。这些参数会应用到每一个数据库连接上。
+
+    .. versionadded:: 0.9.9.dev3
+
+    .. seealso:: https://www.sqlite.org/pragma.html
+    """
+
+    journal_mode: Literal["WAL", "DELETE", "TRUNCATE", "PERSIST", "MEMORY", "OFF"] = "WAL"
+    """日志模式，默认为 ``WAL``。``WAL`` 模式下读写互不阻塞。"""
+
+    synchronous: Literal["OFF", "NORMAL", "FULL", "EXTRA"] = "NORMAL"
+    """同步模式，默认为 ``NORMAL``。在 ``WAL`` 模式下，``NORMAL`` 已足以保证数据库不会损坏。"""
+
+    mmap_size: int = 64 * 2**20
+    """内存映射的最大字节数，默认为 64MiB。设为0以禁用内存映射。"""
+
+    cache_size: int = -16000
+    """页缓存大小。正数表示页数，负数表示 KiB 数。默认为 -16000，即约 16MB。"""
+
+    busy_timeout: int = 5000
+    """数据库被锁定时的最长等待时间，单位毫秒，默认为5000。"""
+
+    checkpoint_interval: float = 10
+    """``WAL`` 模式下，每隔多长时间将日志写回数据库并截断日志文件，单位分钟，默认为10。小于等于0时不定时执行。"""
+
+    def pragmas(self) -> dict[str, str | int]:
+        return self.model_dump(exclude={"checkpoint_interval"})
+
+
 class StorageConfig(BaseModel):
     """Bot 存储配置，对应 :obj:`bot.storage <.BotConf.storage>`。Bot 将保留说说的一部分必要参数，用于验证说说是否已爬取、已发送，以及用于点赞、取消赞等.
     存储的信息不包括说说内容, 但通常能够通过存储的参数复原说说内容."""
@@ -49,6 +79,12 @@ class StorageConfig(BaseModel):
     keepdays: float = 30
     """一条记录要保存多长时间，以天为单位. 默认为30."""
 
+    profile: SqliteProfile = Field(default_factory=SqliteProfile)
+    """SQLite 性能配置。
+
+    .. versionadded:: 0.9.9.dev3
+    """
+
 
 class PollingConf(BaseModel):
     """对应 :obj:`bot.init_args <.BotConf.init_args>`. 顾名思义，:term:`polling` 模式通过频繁地向 telegram 查询消息来确保能够响应用户的命令.
@@ -152,6 +188,77 @@ class NetworkConf(BaseModel):
     """
 
 
+class RateLimitConf(BaseModel):
+    """发送速率限制，对应 :obj:`bot.rate_limit <.BotConf.rate_limit>`。Bot 会主动控制发送速度，
+    避免触发 telegram 的频率限制；若仍被限制，将按照 telegram 要求的时间等待后重发。
+
+    .. versionadded:: 0.9.9.dev3
+    """
+
+    global_rate: float = Field(default=25, gt=0)
+    """所有会话合计每秒最多发送的消息数，默认为25。"""
+    chat_rate: float = Field(default=1, gt=0)
+    """每个会话每秒最多发送的消息数，默认为1。"""
+    chat_burst: int = Field(default=3, ge=1)
+    """每个会话最多连续发送的消息数，默认为3。"""
+
+
+class RetryConf(BaseModel):
+    """发送失败时的重试策略，对应 :obj:`bot.retry <.BotConf.retry>`。发送错误分为以下几类，分别计算重试次数：
+
+    * 网络错误（超时、代理不可用等），按指数退避等待后重试；
+    * 可修复的请求错误（如 telegram 无法获取图片链接），修复后立即重试；
+    * 频率限制，按照 telegram 要求的时间等待后重试，不计次数；
+    * 其他错误，不重试。
+
+    连续的网络错误达到 :obj:`.breaker_threshold` 次时，暂停所有发送，等待 :obj:`.breaker_cooldown`
+    秒后试探性地发送一条消息，成功则恢复发送。
+
+    .. versionadded:: 0.9.9.dev3
+    """
+
+    network: int = Field(default=2, ge=1)
+    """网络错误最多尝试的次数，默认为2。"""
+    payload: int = Field(default=2, ge=1)
+    """可修复的请求错误最多尝试的次数，默认为2。"""
+    backoff: float = Field(default=1, ge=0)
+    """网络错误后首次重试前等待的秒数，之后每次翻倍，默认为1。"""
+    max_backoff: float = Field(default=60, ge=0)
+    """重试前最多等待的秒数，默认为60。"""
+    breaker_threshold: int = Field(default=5, ge=1)
+    """连续多少次网络错误后暂停发送，默认为5。"""
+    breaker_cooldown: float = Field(default=10, gt=0)
+    """暂停发送后，等待多少秒开始试探，默认为10。试探失败则等待时间翻倍，最长为300秒。"""
+
+
+class MediaConf(BaseModel):
+    """媒体缓存，对应 :obj:`bot.media <.BotConf.media>`。Bot 下载的图片会被缓存，
+    重试发送或多条说说包含同一图片时不再重复下载。内容相同的图片只保存一份。
+
+    .. versionadded:: 0.9.9.dev3
+    """
+
+    cache_dir: Path | None = None
+    """缓存目录。默认为 ``None``，即只在内存中缓存。"""
+    max_size: float = Field(default=64, gt=0)
+    """缓存的最大容量，单位 MB，默认为64。超出时优先删除最久未使用的图片。"""
+    keepdays: float = Field(default=3, gt=0)
+    """图片下载后最多缓存多少天，默认为3。"""
+    sniff: bool = False
+    """是否只下载图片的开头部分来判断图片类型，默认为 ``False``，即图片总是下载后上传。
+    设为 ``True`` 时，图片以链接形式发送，仅当 telegram 无法获取图片时才下载完整的图片。"""
+    budget: float = Field(default=32, gt=0)
+    """同时下载中的图片最多占用的内存，单位 MB，默认为32。超出时，新的下载会等待之前的下载完成。"""
+    prefetch: int = Field(default=16, ge=1)
+    """最多提前准备多少条待发送的说说，默认为16。说说只在即将发送时才下载图片，
+    因此内存占用不随一次更新的说说数量增长。"""
+    transcode: bool = False
+    """是否将过大的图片缩小并重新压缩，使其能以图片而非文件或链接的形式发送，默认为 ``False``。
+    需要安装 ``transcode`` 额外依赖（:program:`Pillow`）。图片在独立的进程中处理，不会阻塞 bot。"""
+    transcode_workers: int | None = Field(default=None, ge=1)
+    """处理图片的进程数，默认为 CPU 核数。"""
+
+
 class BotConf(BaseModel):
     """对应配置文件中的 :obj:`bot <.Settings.bot>` 项。"""
 
@@ -178,6 +285,59 @@ class BotConf(BaseModel):
     .. versionadded:: 0.2.7.dev2
     """
 
+    rate_limit: RateLimitConf = Field(default_factory=RateLimitConf)
+    """发送速率限制。
+
+    .. versionadded:: 0.9.9.dev3
+    """
+
+    retry: RetryConf = Field(default_factory=RetryConf)
+    """发送失败时的重试策略。
+
+    .. versionadded:: 0.9.9.dev3
+    """
+
+    media: MediaConf = Field(default_factory=MediaConf)
+    """媒体缓存。
+
+    .. versionadded:: 0.9.9.dev3
+    """
+
+    routes: list["RouteRule"] = Field(default_factory=list)
+    """发送规则。说说发送到第一条匹配规则的 :obj:`~.RouteRule.to` 中的所有会话；
+    没有匹配的规则时，发送给 :obj:`.admin`。
+
+    .. versionadded:: 0.9.9.dev3
+    """
+
+    mirrors: list[int] = Field(default_factory=list)
+    """镜像会话（如频道）ID。所有说说都会额外发送到这些会话。
+
+    .. versionadded:: 0.9.9.dev3
+    """
+
+    digest: int = Field(default=0, ge=0, le=20)
+    """摘要模式。大于1时，同一会话中连续的纯文本说说会合并为一条消息发送，每条消息最多合并此数目的说说，
+    且不超过单条消息的长度限制。说说按序号区分，各自保留标题链接，按钮合并为一个键盘，每行对应一条说说。
+    发送到多个会话的说说不会合并。默认为0，即不合并。
+
+    .. versionadded:: 0.9.9.dev3
+    """
+
+    max_lanes: int = Field(default=8, ge=1)
+    """最多同时向多少个会话发送消息，默认为8。同一会话中的说说总是按时间顺序依次发送。
+
+    .. versionadded:: 0.9.9.dev3
+    """
+
+    stream_window: float | None = Field(default=None, ge=0)
+    """流式发送窗口，单位秒。设置后，说说进入发送队列并等待此时长后即开始发送，无需等待整批说说爬取完成，
+    从而更快地收到第一条消息。同一时刻放行的说说按时间顺序发送，窗口越大，乱序的可能越小。
+    默认为 ``None``，即整批爬取完成后再按时间顺序发送。
+
+    .. versionadded:: 0.9.9.dev3
+    """
+
     @model_validator(mode="before")
     def webhook_first(cls, v: dict):
         with suppress(BaseException):
@@ -185,6 +345,44 @@ class BotConf(BaseModel):
         return v
 
 
+class FilterRule(BaseModel):
+    """说说过滤规则，对应 :obj:`qzone.filters <.QzoneConf.filters>` 中的一项。
+    规则中设置的条件 **全部** 满足时，说说会被丢弃；未设置的条件不参与判断。
+
+    .. versionadded:: 0.9.9.dev3
+    """
+
+    uin: list[int] | None = None
+    """发布者 qq 在此列表中。"""
+    nickname: str | None = None
+    """发布者昵称匹配此正则表达式（:external:func:`re.search`）。"""
+    appid: list[int] | None = None
+    """说说的 appid 在此列表中。"""
+    typeid: list[int] | None = None
+    """说说的 typeid 在此列表中。"""
+    keywords: list[Annotated[str, Field(min_length=1)]] | None = Field(default=None, min_length=1)
+    """说说文本包含此列表中的任一关键词（区分大小写）。列表不能为空。"""
+
+    @model_validator(mode="after")
+    def not_empty(self):
+        if all(getattr(self, k) is None for k in FilterRule.model_fields):
+            raise ValueError("filter rule should have at least one condition")
+        return self
+
+
+class RouteRule(FilterRule):
+    """说说发送规则，对应 :obj:`bot.routes <.BotConf.routes>` 中的一项。
+    规则中设置的条件 **全部** 满足时，说说发送到 :obj:`.to` 中的会话。条件的含义同 :class:`.FilterRule`。
+
+    一条说说发送到多个会话时，只在第一个会话中上传一次，其余会话复制已发送的消息，不会重复上传媒体。
+
+    .. versionadded:: 0.9.9.dev3
+    """
+
+    to: list[int] = Field(min_length=1)
+    """目标会话ID。"""
+
+
 class QzoneConf(BaseModel):
     """对应配置文件中的 ``qzone`` 项。包含要登录的QQ账户信息和爬虫相关的设置。"""
 
@@ -207,6 +405,11 @@ class QzoneConf(BaseModel):
     """黑名单 qq. 列表中的用户发布的任何内容会被直接丢弃."""
     block_self: bool = True
     """是否舍弃当前登录账号发布的内容. 等同于在 :obj:`.block` 中加入当前 :obj:`.uin`"""
+    filters: list[FilterRule] = Field(default_factory=list)
+    """过滤规则。满足任一规则的说说会在发送前被丢弃。
+
+    .. versionadded:: 0.9.9.dev3
+    """
 
     @model_validator(mode="after")
     def consistency_uin(self):
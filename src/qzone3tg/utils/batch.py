@@ -0,0 +1,187 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Generic, Hashable, Mapping, TypeVar
+
+from tylisten.futstore import FutureStore
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+log = logging.getLogger(__name__)
+
+
+class MicroBatcher(Generic[K, V]):
+    """A micro-batcher collects single-key lookups for a short window and resolves them
+    with one call of :obj:`.resolve`. Callers still await their own key, so per-call latency
+    is bounded by :obj:`.delay` while the backend sees one request per window.
+
+    :param resolve: batch lookup. It must return a mapping containing every requested key.
+    :param delay: how long (in seconds) to collect keys before resolving, defaults to 5ms.
+    :param max_size: resolve immediately once this many keys are pending, defaults to 256.
+    """
+
+    def __init__(
+        self,
+        resolve: Callable[[set[K]], Awaitable[Mapping[K, V]]],
+        *,
+        delay: float = 0.005,
+        max_size: int = 256,
+    ) -> None:
+        self.resolve = resolve
+        self.delay = delay
+        self.max_size = max_size
+        self._pending: dict[K, asyncio.Future[V]] = {}
+        self._timer: asyncio.TimerHandle | None = None
+        self._ch_resolve = FutureStore()
+
+    async def get(self, key: K) -> V:
+        """Lookup a key. Concurrent lookups of the same key share one result."""
+        if (fut := self._pending.get(key)) is None:
+            loop = asyncio.get_running_loop()
+            fut = self._pending[key] = loop.create_future()
+            if len(self._pending) >= self.max_size:
+                self.flush()
+            elif self._timer is None:
+                self._timer = loop.call_later(self.delay, self.flush)
+        # one cancelled caller should not cancel the others
+        return await asyncio.shield(fut)
+
+    def flush(self):
+        """Resolve all pending keys now."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        self._ch_resolve.add_awaitable(self._resolve(batch))
+
+    async def _resolve(self, batch: dict[K, asyncio.Future[V]]):
+        try:
+            r = await self.resolve(set(batch))
+        except BaseException as e:
+            for fut in batch.values():
+                if not fut.done():
+                    fut.set_exception(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return
+
+        for k, fut in batch.items():
+            if fut.done():
+                continue
+            if k in r:
+                fut.set_result(r[k])
+            else:
+                fut.set_exception(KeyError(k))
+
+    async def wait(self):
+        """Flush and wait for all pending lookups to be resolved."""
+        self.flush()
+        await self._ch_resolve.wait()
+
+
+class WriteBehind(Generic[K, V]):
+    """A write-behind buffer accumulates values and writes them with one call of :obj:`.write`
+    per :obj:`.max_size` values or per :obj:`.delay` seconds, whichever comes first. Values of the
+    same key are merged, the later wins. Batches are written one by one in order.
+
+    Values are visible to :meth:`.peek` from being pushed until they are written, so readers
+    can read their writes before the buffer is flushed.
+
+    A failed batch is retried with exponential backoff, and later batches wait for it so that
+    they are still written in order. If it fails :obj:`.retries` more times, it is passed to
+    :obj:`.on_error` and dropped, so that the caller can roll back what it assumed written.
+
+    :param write: batch writer.
+    :param delay: how long (in seconds) to accumulate values before writing, defaults to 200ms.
+    :param max_size: write immediately once this many values are pending, defaults to 64.
+    :param store: the future store to save writing tasks, defaults to a new one.
+    :param retries: max retries of a failed batch, defaults to 3.
+    :param backoff: seconds to wait before the first retry, doubled after each retry.
+    :param on_error: called with a batch which cannot be written.
+    """
+
+    def __init__(
+        self,
+        write: Callable[[dict[K, V]], Awaitable[Any]],
+        *,
+        delay: float = 0.2,
+        max_size: int = 64,
+        store: FutureStore | None = None,
+        retries: int = 3,
+        backoff: float = 1.0,
+        on_error: Callable[[dict[K, V]], Any] | None = None,
+    ) -> None:
+        self.write = write
+        self.delay = delay
+        self.max_size = max_size
+        self.retries = retries
+        self.backoff = backoff
+        self.on_error = on_error
+        self._pending: dict[K, V] = {}
+        self._writing: list[dict[K, V]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._lock = asyncio.Lock()
+        self._ch_write = store or FutureStore()
+
+    def __len__(self) -> int:
+        return len(self._pending) + sum(len(i) for i in self._writing)
+
+    def push(self, key: K, value: V):
+        self._pending[key] = value
+        if len(self._pending) >= self.max_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.delay, self.flush)
+
+    def peek(self, key: K) -> V | None:
+        """Get the latest value of the key which is not written yet."""
+        if key in self._pending:
+            return self._pending[key]
+        for batch in reversed(self._writing):
+            if key in batch:
+                return batch[key]
+
+    def flush(self):
+        """Write all pending values now."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        self._writing.append(batch)
+        self._ch_write.add_awaitable(self._write(batch))
+
+    async def _write(self, batch: dict[K, V]):
+        try:
+            # retry in the lock, so that later batches are not written before this one
+            async with self._lock:
+                for i in range(self.retries + 1):
+                    try:
+                        return await self.write(batch)
+                    except asyncio.CancelledError:
+                        raise
+                    except:
+                        if i < self.retries:
+                            delay = self.backoff * 2**i
+                            log.warning(
+                                f"Error when writing a batch of {len(batch)} values, "
+                                f"retry in {delay:.1f}s.",
+                                exc_info=True,
+                            )
+                            await asyncio.sleep(delay)
+                            continue
+                        log.error(
+                            f"Error when writing a batch of {len(batch)} values.", exc_info=True
+                        )
+                        if self.on_error is not None:
+                            self.on_error(batch)
+        finally:
+            self._writing.remove(batch)
+
+    async def wait(self):
+        """Flush and wait for all values to be written."""
+        self.flush()
+        await self._ch_write.wait()
@@ -0,0 +1,52 @@
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """A bounded mapping which drops the least recently used item when it is full.
+
+    :param maxsize: max number of items, defaults to 1024.
+    """
+
+    __slots__ = ("maxsize", "_data")
+
+    def __init__(self, maxsize: int = 1024) -> None:
+        assert maxsize > 0
+        self.maxsize = maxsize
+        self._data: OrderedDict[K, V] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._data
+
+    def get(self, key: K) -> V | None:
+        if (v := self._data.get(key)) is not None:
+            self._data.move_to_end(key)
+        return v
+
+    def __setitem__(self, key: K, value: V):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: K) -> V | None:
+        return self._data.pop(key, None)
+
+    def evict_if(self, pred: Callable[[K, V], bool]) -> int:
+        """Remove all items satisfying the predicate.
+
+        :return: number of removed items.
+        """
+        keys = [k for k, v in self._data.items() if pred(k, v)]
+        for k in keys:
+            del self._data[k]
+        return len(keys)
+
+    def clear(self):
+        self._data.clear()
@@ -1,6 +1,8 @@
+import asyncio
+from contextlib import asynccontextmanager
 from datetime import datetime
 
-from aiogram.types import Chat, Message
+from aiogram.types import Chat, Message, MessageId
 from aioqzone.model import TextEntity
 from aioqzone_feed.type import FeedContent, VisualMedia
 
@@ -43,6 +45,55 @@ class FakeBot:
         self.log.append(("animation", chat_id, animation, text, kw))
         return fake_message(len(self.log))
 
+    async def copy_message(self, chat_id: ChatId, from_chat_id: ChatId, message_id: int, **kw):
+        self.log.append(("copy", chat_id, [message_id], kw))
+        return MessageId(message_id=len(self.log))
+
+    async def copy_messages(
+        self, chat_id: ChatId, from_chat_id: ChatId, message_ids: list[int], **kw
+    ):
+        self.log.append(("copy", chat_id, message_ids, kw))
+        return [MessageId(message_id=len(self.log)) for _ in message_ids]
+
+
+class FakeContent:
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+
+    async def iter_chunked(self, n: int):
+        while chunk := await self.read(n):
+            yield chunk
+
+    async def read(self, n: int = -1):
+        await asyncio.sleep(0.01)
+        r, self.data = (self.data, b"") if n < 0 else (self.data[:n], self.data[n:])
+        return r
+
+
+class FakeResponse:
+    """A server which does not support ``Range``."""
+
+    status = 200
+    headers = {}
+
+    def __init__(self, data: bytes) -> None:
+        self.content = FakeContent(data)
+        self.content_length = len(data)
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeClient:
+    def __init__(self, medias: dict[str, bytes]) -> None:
+        self.medias = medias
+        self.log: list[str] = []
+
+    @asynccontextmanager
+    async def get(self, url: str, **kw):
+        self.log.append(url)
+        yield FakeResponse(self.medias[url])
+
 
 class Feed4Test(FeedContent):
     def __hash__(self) -> int:
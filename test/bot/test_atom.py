@@ -1,12 +1,12 @@
 import pytest
-from aiogram.types import InputMedia
+from aiogram.types import InputMedia, PhotoSize
 from qqqr.utils.net import ClientAdapter
 from qzemoji.utils import build_html
 
 import qzone3tg.bot.atom as atom
 from qzone3tg.bot.splitter import FetchSplitter, LocalSplitter
 
-from . import fake_feed, fake_media
+from . import fake_feed, fake_media, fake_message
 
 pytestmark = pytest.mark.asyncio
 
@@ -101,3 +101,71 @@ class TestFetch:
         pair = await fetch.split(f)
         assert len(pair) == 1
         assert isinstance(pair[0], atom.VideoAtom)
+
+
+class TestDump:
+    async def test_text(self, local: LocalSplitter):
+        atoms = await local.split(fake_feed(1))
+        atoms[0].kwds["chat_id"] = 1
+        a = atom.load_atom(atoms[0].dump())
+        assert isinstance(a, atom.TextAtom)
+        assert a.text and a.text.render() == atoms[0].text.render()  # type: ignore
+        assert a.kwds["chat_id"] == 1
+
+    async def test_media(self, local: LocalSplitter):
+        f = fake_feed(1)
+        f.media = [fake_media(build_html(100))]
+        atoms = await local.split(f)
+        a = atom.load_atom(atoms[0].dump())
+        assert isinstance(a, atom.PicAtom)
+        assert a.content == f.media[0].raw
+
+    async def test_media_group(self, local: LocalSplitter):
+        f = fake_feed(1)
+        f.media = [fake_media(build_html(100))] * 2
+        atoms = await local.split(f)
+        a = atom.load_atom(atoms[0].dump())
+        assert isinstance(a, atom.MediaGroupAtom)
+        assert a.message_num == 2
+        assert a.dump() == atoms[0].dump()
+
+    async def test_copy(self):
+        copy = atom.CopyAtom(1, [2, 3], chat_id=4)
+        a = atom.load_atom(copy.dump())
+        assert isinstance(a, atom.CopyAtom)
+        assert (a.from_chat_id, a.message_ids, a.kwds) == (1, [2, 3], {"chat_id": 4})
+
+
+class TestFileId:
+    async def test_media(self, local: LocalSplitter):
+        f = fake_feed(1)
+        f.media = [fake_media(build_html(100))]
+        (a,) = await local.split(f)
+        assert isinstance(a, atom.PicAtom)
+        assert not a.use_file_ids({})
+
+        msg = fake_message(1).model_copy(
+            update=dict(photo=[PhotoSize(file_id="id", file_unique_id="", width=1, height=1)])
+        )
+        ids = a.sent_file_ids(msg)
+        assert list(ids.values()) == ["id"]
+        assert a.use_file_ids(ids)
+        assert a.content == "id"
+        # nothing new is uploaded
+        assert not a.sent_file_ids(msg)
+
+        assert a.drop_file_ids()
+        assert a.content == f.media[0].raw
+
+    async def test_media_group(self, local: LocalSplitter):
+        f = fake_feed(1)
+        media = [fake_media(build_html(100)), fake_media(build_html(101))]
+        f.media = media.copy()
+        (a,) = await local.split(f)
+        assert isinstance(a, atom.MediaGroupAtom)
+
+        ids = {atom.media_keys("photo", media[1])[0]: "id"}
+        assert a.use_file_ids(ids)
+        assert [m.media for m in a.builder._media] == [media[0].raw, "id"]
+        assert a.drop_file_ids()
+        assert [m.media for m in a.builder._media] == [i.raw for i in media]
@@ -0,0 +1,106 @@
+import asyncio
+from pathlib import Path
+
+import pytest
+
+from qzone3tg.bot.cache import CachedInputFile, MediaCache, MemoryBudget
+
+from . import FakeClient
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_single_flight():
+    client = FakeClient({"a": b"a" * 10})
+    cache = MediaCache(client)  # type: ignore
+    r = await asyncio.gather(*(cache.get("a") for _ in range(3)))
+    assert r == [b"a" * 10] * 3
+    assert await cache.get("a") == b"a" * 10
+    assert client.log == ["a"]
+    assert (cache.hits, cache.misses, cache.bytes_saved) == (3, 1, 30)
+
+
+async def test_content_addressed(tmp_path: Path):
+    client = FakeClient({"a": b"same", "b": b"same", "c": b"other"})
+    cache = MediaCache(client, tmp_path)  # type: ignore
+    for url in "abc":
+        await cache.get(url)
+    assert len(cache) == 2
+    assert cache.size == 9
+    assert len(list(tmp_path.glob("??/*"))) == 2
+
+    await cache.save()
+    cache = MediaCache(client, tmp_path)  # type: ignore
+    await cache.load()
+    assert await cache.get("b") == b"same"
+    assert client.log == ["a", "b", "c"]
+
+
+async def test_lru():
+    client = FakeClient({"a": b"a" * 4, "b": b"b" * 4, "c": b"c" * 4})
+    cache = MediaCache(client, max_size=8)  # type: ignore
+    await cache.get("a")
+    await cache.get("b")
+    await cache.get("a")
+    await cache.get("c")
+    # b is the least recently used
+    assert cache.size == 8
+    await cache.get("a")
+    await cache.get("b")
+    assert client.log == ["a", "b", "c", "b"]
+
+
+async def test_expire(tmp_path: Path):
+    client = FakeClient({"a": b"a"})
+    cache = MediaCache(client, tmp_path, keepdays=0)  # type: ignore
+    await cache.get("a")
+    assert await cache.clean() == 1
+    assert len(cache) == 0
+    assert not list(tmp_path.glob("??/*"))
+    await cache.get("a")
+    assert client.log == ["a", "a"]
+
+
+async def test_sniff():
+    client = FakeClient({"a": b"GIF89a" + b"\0" * 10000, "b": b"b" * 4})
+    cache = MediaCache(client)  # type: ignore
+    head, size = await cache.sniff("a")
+    assert head.startswith(b"GIF89a") and len(head) <= 4096
+    assert size == 10006
+    # small medias are fetched as a whole
+    assert await cache.sniff("b") == (b"b" * 4, 4)
+    assert await cache.get("b") == b"b" * 4
+    assert client.log == ["a", "b"]
+
+
+@pytest.mark.parametrize("disk", [False, True])
+async def test_stream(tmp_path: Path, disk: bool):
+    data = bytes(range(256)) * 1000
+    client = FakeClient({"a": data, "b": data[::-1]})
+    cache = MediaCache(client, tmp_path if disk else None)  # type: ignore
+    await cache.fetch("a")
+    f = CachedInputFile(cache, "a", "a.jpg", chunk_size=1000)
+    assert f.digest
+    chunks = [c async for c in f.read(None)]  # type: ignore
+    assert len(chunks) == 256 and b"".join(chunks) == data
+    assert client.log == ["a"]
+
+    # not cached, streamed from the url
+    f = CachedInputFile(cache, "b", "b.jpg")
+    assert f.digest is None
+    assert b"".join([c async for c in f.read(None)]) == data[::-1]  # type: ignore
+    assert len(cache) == 1
+
+
+async def test_budget():
+    budget = MemoryBudget(10)
+    held: list[int] = []
+
+    async def hold(n: int):
+        async with budget.hold(n):
+            held.append(budget.used)
+            await asyncio.sleep(0.01)
+
+    await asyncio.gather(*(hold(4) for _ in range(5)), hold(100))
+    assert max(held) <= 10
+    assert budget.used == 0
@@ -4,13 +4,18 @@ from unittest.mock import patch
 
 import pytest
 from aiogram import Bot
-from aiogram.exceptions import TelegramBadRequest
-from aiogram.types import InlineKeyboardMarkup
+from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup, PhotoSize
+from aiogram.utils.formatting import Text
+from aioqzone_feed.type import FeedContent
 from qqqr.utils.net import ClientAdapter
 from qzemoji.utils import build_html
 
-from qzone3tg.bot.queue import SendQueue, all_is_atom
-from qzone3tg.bot.splitter import FetchSplitter
+from qzone3tg.bot.atom import CopyAtom, TextAtom
+from qzone3tg.bot.queue import FeedSlot, SendQueue, all_is_atom
+from qzone3tg.bot.ratelimit import RateLimiter
+from qzone3tg.bot.retry import CircuitBreaker, ErrorClass
+from qzone3tg.bot.splitter import FetchSplitter, LocalSplitter
 
 from . import FakeBot, fake_feed, fake_media
 
@@ -40,35 +45,42 @@ class TestQueue:
         queue.new_batch(0)
         f = fake_feed(0)
         queue.add(0, f)
-        await queue.ch_feed[f].wait()
-        assert len(queue.feed_state) == 1
-        assert len(queue._send_order) == 1
-        assert queue.feed_state[f] and all_is_atom(queue.feed_state[f])
+        slot = queue.slots[(f.uin, f.abstime)]
+        # atoms are not built until sending
+        assert slot.ready is None and slot.plan is f
+        await queue._materialize(slot)  # type: ignore
+        assert len(queue.slots) == 1
+        assert queue.add_num == 1
+        assert slot.state and all_is_atom(slot.state)
+        # the feed content is released
+        assert not isinstance(slot.feed, FeedContent)
 
         # test batch mismatch
         queue.add(1, f)
-        await queue.ch_feed[f].wait()
-        assert len(queue.feed_state) == 1
-        assert len(queue._send_order) == 1
+        assert len(queue.slots) == 1
+        assert queue.add_num == 1
 
         # test add another uin but the same abstime
         f = fake_feed(1)
         f.uin = 1
         queue.add(0, f)
-        await queue.ch_feed[f].wait()
-        assert len(queue.feed_state) == 2
-        assert len(queue._send_order) == 2
-        assert queue.feed_state[f] and all_is_atom(queue.feed_state[f])
+        slot = queue.slots[(f.uin, f.abstime)]
+        await queue._materialize(slot)  # type: ignore
+        assert len(queue.slots) == 2
+        assert queue.add_num == 2
+        assert slot.state and all_is_atom(slot.state)
 
         # reference the first feed
         f = fake_feed(2)
         f.abstime = 2000
         f.forward = fake_feed(0)
         queue.add(0, f)
-        await queue.ch_feed[f].wait()
-        assert len(queue.feed_state) == 3
-        assert len(queue._send_order) == 3
-        assert queue.feed_state[f] and all_is_atom(queue.feed_state[f])
+        slot = queue.slots[(f.uin, f.abstime)]
+        await queue._materialize(slot)  # type: ignore
+        assert len(queue.slots) == 3
+        assert queue.add_num == 3
+        assert slot.state and all_is_atom(slot.state)
+        assert slot.forward is queue.slots[(0, 0)]
 
     async def test_drop_dup_feed(self, queue: SendQueue):
         queue.new_batch(3)
@@ -79,17 +91,17 @@ class TestQueue:
         f = fake_feed(1)
         f.abstime = 1
         queue.add(3, f)  # dup
-        assert len(queue._send_order) == 1
+        assert queue.add_num == 1
 
         f = fake_feed(1)
         f.uin = f.abstime = 2
         queue.add(3, f)  # not dup
-        assert len(queue._send_order) == 2
+        assert queue.add_num == 2
 
         f = fake_feed(1)
         f.abstime = 3
         queue.add(3, f)  # dup
-        assert len(queue._send_order) == 2
+        assert queue.add_num == 2
 
     async def test_send_norm(self, queue: SendQueue, fake_bot: FakeBot):
         queue.new_batch(1)
@@ -109,7 +121,7 @@ class TestQueue:
         queue.new_batch(2)
         queue.add(2, f)
         await asyncio.wait(queue.send_all().values())
-        assert len(queue.feed_state) == 2
+        assert len(queue.slots) == 2
         assert len(fake_bot.log) == 2
         for i in fake_bot.log:
             assert isinstance(i[-1]["reply_markup"], InlineKeyboardMarkup)
@@ -133,7 +145,70 @@ class TestQueue:
             await asyncio.wait(queue.send_all().values())
 
         assert not fake_bot.log
-        assert len(queue.exc_groups[f]) == grp_len
+        assert len(queue.exc_groups[(f.uin, f.abstime)]) == grp_len
+
+    async def test_retry_after(self, queue: SendQueue, fake_bot: FakeBot):
+        send_message = FakeBot.send_message
+        flooded = []
+
+        async def flood(self, *args, **kw):
+            if not flooded:
+                flooded.append(1)
+                raise TelegramRetryAfter(None, "flood", 1)  # type: ignore
+            return await send_message(self, *args, **kw)
+
+        queue.new_batch(0)
+        f = fake_feed(1)
+        queue.add(0, f)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        with patch.object(FakeBot, "send_message", flood):
+            await asyncio.wait(queue.send_all().values())
+
+        assert loop.time() - start >= 1
+        assert len(fake_bot.log) == 1
+        assert not queue.exc_groups[(f.uin, f.abstime)]
+
+    async def test_lanes(self, client: ClientAdapter, fake_bot: FakeBot):
+        queue = SendQueue(fake_bot, FetchSplitter(client), {1: 10, 2: 10, 3: 20})  # type: ignore
+        send_message = FakeBot.send_message
+
+        async def slow(self, chat_id, text, **kw):
+            if text.endswith("1"):
+                await asyncio.sleep(0.1)
+            return await send_message(self, chat_id, text, **kw)
+
+        queue.new_batch(0)
+        for i in range(1, 4):
+            f = fake_feed(i)
+            f.abstime = f.uin = i
+            queue.add(0, f)
+
+        with patch.object(FakeBot, "send_message", slow):
+            await asyncio.wait(queue.send_all().values())
+
+        # chat 20 is not blocked by chat 10, while feeds in chat 10 are in order
+        assert [(s[1], s[2][-1]) for s in fake_bot.log] == [(20, "3"), (10, "1"), (10, "2")]
+
+    async def test_stream(self, client: ClientAdapter, fake_bot: FakeBot):
+        queue = SendQueue(fake_bot, FetchSplitter(client), defaultdict(int), window=0.05)
+        queue.new_batch(0)
+        for i in range(2, 0, -1):
+            f = fake_feed(i)
+            f.abstime = f.uin = i
+            queue.add(0, f)
+
+        await asyncio.sleep(0.2)
+        # sent before send_all, in order
+        assert [s[2][-1] for s in fake_bot.log] == ["1", "2"]
+
+        f = fake_feed(3)
+        f.abstime = f.uin = 3
+        queue.add(0, f)
+        tasks = queue.send_all()
+        assert len(tasks) == 3
+        await asyncio.wait(tasks.values())
+        assert len(fake_bot.log) == 3
 
     async def test_forward_order(self, queue: SendQueue, fake_bot: FakeBot):
         f1, f2, f3 = [fake_feed(i) for i in range(3)]
@@ -152,3 +227,246 @@ class TestQueue:
         assert fake_bot.log
         uin_order = [int(s[2][0]) for s in fake_bot.log]
         assert uin_order == [2, 1, 3]
+
+    async def test_chain(self, queue: SendQueue, fake_bot: FakeBot):
+        chains, sent = [], []
+
+        @queue.chain_ready.add_impl
+        async def _(feed, chain):
+            chains.append((feed.uin, [f.uin for f, _ in chain]))
+
+        @queue.atom_sent.add_impl
+        async def _(atom, mids):
+            sent.append(mids)
+
+        f1, f2 = fake_feed(1), fake_feed(2)
+        f2.uin = f2.abstime = 2
+        f2.forward = f1
+
+        queue.new_batch(0)
+        queue.add(0, f2)
+        await asyncio.wait(queue.send_all().values())
+        assert chains == [(2, [0, 2])]
+        assert sent == [[1], [2]]
+
+        # resume the chain, atoms with mids are skipped
+        atoms = [(await queue.splitter.split(fake_feed(i)))[0] for i in range(3)]
+        for a in atoms:
+            a.kwds["chat_id"] = 0
+        r = await queue.send_chain([(atoms[0], [1]), (atoms[1], None), (atoms[2], None)], (2, 2))
+        assert r == [[1], [3], [4]]
+        assert fake_bot.log[-1][3]["reply_to_message_id"] == 3
+
+        # a digest is sent once, and its message ids are shared
+        digest = [(atoms[0], None), (atoms[1], None)]
+        assert await queue.send_digest(digest, (2, 2)) == [5]
+        assert sent[-2:] == [[5], [5]]
+        assert await queue.send_digest([(atoms[0], None), (atoms[1], [5])], (2, 2)) == [5]
+        assert len(fake_bot.log) == 5
+
+        # copies do not reply
+        copy = CopyAtom(0, [3], chat_id=1)
+        assert await queue.send_chain([(copy, None)], (2, 2), reply=False) == [[6]]
+        assert "reply_to_message_id" not in fake_bot.log[-1][3]
+
+    async def test_scale(self, fake_bot: FakeBot):
+        """Bookkeeping per feed should not scan the whole batch."""
+        queue = SendQueue(fake_bot, LocalSplitter(), defaultdict(int))  # type: ignore
+        scans = 0
+
+        class ScannedDict(dict):
+            def __iter__(self):
+                nonlocal scans
+                scans += 1
+                return super().__iter__()
+
+            def values(self):
+                nonlocal scans
+                scans += 1
+                return super().values()
+
+            def items(self):
+                nonlocal scans
+                scans += 1
+                return super().items()
+
+        class ScannedList(list):
+            def __iter__(self):
+                nonlocal scans
+                scans += 1
+                return super().__iter__()
+
+            def __contains__(self, x):
+                nonlocal scans
+                scans += 1
+                return super().__contains__(x)
+
+        queue.slots, queue._tasks, queue._heap = ScannedDict(), ScannedDict(), ScannedList()
+
+        async def run(n: int):
+            nonlocal scans
+            queue.new_batch(n)
+            feeds = [fake_feed(i) for i in range(n)]
+            for i, f in enumerate(feeds):
+                f.uin, f.abstime = i, n - i
+            scans = 0
+            for f in feeds:
+                queue.add(n, f)
+            await asyncio.wait(queue.send_all().values())
+            assert len(queue.slots) == n
+            return scans
+
+        # scans are per batch, not per feed
+        assert await run(10) == await run(1000)
+
+    async def test_breaker(self, client: ClientAdapter, fake_bot: FakeBot):
+        breaker = CircuitBreaker(threshold=1, cooldown=0.1)
+        queue = SendQueue(fake_bot, FetchSplitter(client), defaultdict(int), breaker=breaker)
+        send_message = FakeBot.send_message
+        calls = []
+
+        async def down(self, *args, **kw):
+            calls.append(1)
+            if len(calls) == 1:
+                raise TelegramNetworkError(None, "proxy is down")  # type: ignore
+            return await send_message(self, *args, **kw)
+
+        queue.new_batch(0)
+        for i in range(1, 4):
+            f = fake_feed(i)
+            f.abstime = f.uin = i
+            queue.add(0, f)
+
+        with patch.object(FakeBot, "send_message", down):
+            await asyncio.wait(queue.send_all().values())
+
+        # other feeds wait for the breaker instead of failing
+        assert len(calls) == 4
+        assert len(fake_bot.log) == 3
+        assert queue.exc_num == 0
+
+    async def test_breaker_cancel(self, client: ClientAdapter, fake_bot: FakeBot):
+        breaker = CircuitBreaker(threshold=1, cooldown=0)
+        limiter = RateLimiter()
+        queue = SendQueue(
+            fake_bot, FetchSplitter(client), defaultdict(int), limiter=limiter, breaker=breaker
+        )
+        breaker.record(ErrorClass.NETWORK)
+        assert breaker.is_open
+
+        # the probe is cancelled while it waits for the limiter
+        limiter.chats[0].pause(10)
+        probe = asyncio.create_task(queue._send_atom_paced(TextAtom(Text("0"), chat_id=0)))
+        await asyncio.sleep(0.01)
+        probe.cancel()
+        await asyncio.wait([probe])
+
+        # another sender becomes the probe
+        r = queue._send_atom_paced(TextAtom(Text("1"), chat_id=1))
+        await asyncio.wait_for(r, 1)
+        assert not breaker.is_open
+
+    async def test_file_id(self, queue: SendQueue, fake_bot: FakeBot):
+        uploaded = {}
+        queue.file_ids = uploaded
+        queue.file_uploaded.add_impl(uploaded.update)
+        send_photo = FakeBot.send_photo
+
+        async def photo(self, *args, **kw):
+            r = await send_photo(self, *args, **kw)
+            size = PhotoSize(file_id=f"id{r.message_id}", file_unique_id="", width=1, height=1)
+            return r.model_copy(update=dict(photo=[size]))
+
+        with patch.object(FakeBot, "send_photo", photo):
+            for i in range(2):
+                queue.new_batch(i)
+                f = fake_feed(i)
+                f.media = [fake_media(build_html(100))]
+                queue.add(i, f)
+                await asyncio.wait(queue.send_all().values())
+
+        assert len(fake_bot.log) == 2
+        assert fake_bot.log[0][2] != "id1"
+        # the second one is sent by file_id
+        assert fake_bot.log[1][2] == "id1"
+        assert set(uploaded.values()) == {"id1"}
+
+    async def test_fanout(self, queue: SendQueue, fake_bot: FakeBot):
+        copies: list[tuple[int, int]] = []
+
+        @queue.chain_ready.add_impl
+        async def _(feed, chain):
+            atoms = [a for _, atoms in chain for a in atoms]
+            if all(isinstance(a, CopyAtom) for a in atoms):
+                copies.append((feed.uin, atoms[0].kwds["chat_id"]))
+
+        queue.router = lambda feed, default: (default, 1, default, 2)
+        queue.new_batch(0)
+        f = fake_feed(1)
+        f.abstime = 2000
+        f.forward = fake_feed(0)
+        queue.add(0, f)
+        await asyncio.wait(queue.send_all().values())
+
+        slot = queue.slots[(0, 2000)]
+        assert slot.chat_id == 0 and slot.copies == (1, 2)
+        # uploaded once, and copied to other chats
+        assert [i[:2] for i in fake_bot.log[:2]] == [("message", 0)] * 2
+        assert sorted(i[:2] for i in fake_bot.log[2:]) == [("copy", 1)] * 2 + [("copy", 2)] * 2
+        # the markup is kept
+        assert all(i[3].get("reply_markup") for i in fake_bot.log[2:])
+        assert slot.forward and slot.forward.copied.keys() == slot.copied.keys() == {1, 2}
+        assert queue.exc_num == 0
+        # copies are persisted like other atoms
+        assert sorted(copies) == [(0, 1), (0, 1), (0, 2), (0, 2)]
+
+    async def test_copy_atoms(self, queue: SendQueue):
+        slot = FeedSlot(fake_feed(0), (0, 1))
+        slot.state = list(range(150))
+        slot.markup = (3, InlineKeyboardMarkup(inline_keyboard=[]))
+        atoms = queue._copy_atoms(slot, 1)
+        assert [len(a.message_ids) for a in atoms] == [3, 1, 100, 46]
+        assert [a.reply_markup is not None for a in atoms] == [False, True, False, False]
+        assert all(a.kwds["chat_id"] == 1 and a.from_chat_id == 0 for a in atoms)
+
+    async def test_digest(self, queue: SendQueue, fake_bot: FakeBot):
+        queue.digest = 3
+        queue.new_batch(0)
+        for i in range(5):
+            f = fake_feed(i)
+            f.abstime = i * 1000
+            if i == 3:
+                f.media = [fake_media(build_html(100))]
+            queue.add(0, f)
+        await asyncio.wait(queue.send_all().values())
+
+        # 0-2 are packed, 3 has a media, 4 is sent alone
+        assert [i[0] for i in fake_bot.log] == ["message", "photo", "message"]
+        assert all(f"\n\n{i}. " in fake_bot.log[0][2] for i in (2, 3))
+        slots = [queue.slots[(0, i * 1000)] for i in range(5)]
+        assert [s.packed for s in slots] == [1, 2, 3, 0, 0]
+        assert slots[0].state == slots[1].state == slots[2].state == [1]
+        assert queue.exc_num == 0
+
+    async def test_prefetch(self, fake_bot: FakeBot):
+        queue = SendQueue(fake_bot, LocalSplitter(), defaultdict(int), prefetch=2)  # type: ignore
+        split = queue.splitter.split
+        ahead: list[int] = []
+
+        async def _split(feed):
+            ahead.append(
+                sum(s.ready is not None for s in queue.slots.values()) - len(fake_bot.log)
+            )
+            return await split(feed)
+
+        queue.new_batch(0)
+        with patch.object(queue.splitter, "split", _split):
+            for i in range(10):
+                f = fake_feed(i)
+                f.abstime = i * 1000
+                queue.add(0, f)
+            assert not ahead
+            await asyncio.wait(queue.send_all().values())
+
+        assert len(fake_bot.log) == 10
+        assert len(ahead) == 10 and max(ahead) <= 2
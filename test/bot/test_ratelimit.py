@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import AnswerCallbackQuery, SendChatAction, SendMessage
+
+from qzone3tg.bot.ratelimit import (
+    Priority,
+    RateLimiter,
+    RateLimitMiddleware,
+    TokenBucket,
+    use_priority,
+)
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_bucket():
+    bucket = TokenBucket(20, burst=2)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    for _ in range(4):
+        await bucket.acquire()
+    # the first two are in burst, the rest wait 50ms each
+    assert 0.09 <= loop.time() - start < 0.5
+
+
+async def test_pause():
+    bucket = TokenBucket(float("inf"))
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    bucket.pause(0.1)
+    await bucket.acquire()
+    assert loop.time() - start >= 0.1
+
+
+async def test_limiter():
+    limiter = RateLimiter(global_rate=1000, chat_rate=10, chat_burst=1)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    # chats are paced independently
+    await asyncio.gather(*(limiter.acquire(i) for i in range(10)))
+    assert loop.time() - start < 0.05
+
+    start = loop.time()
+    await asyncio.gather(*(limiter.acquire(0) for _ in range(3)))
+    assert loop.time() - start >= 0.2
+
+
+async def test_priority():
+    bucket = TokenBucket(20, burst=1)
+    await bucket.acquire()
+    done: list[str] = []
+
+    async def acquire(name: str, priority: Priority):
+        with use_priority(priority):
+            await bucket.acquire()
+        done.append(name)
+
+    bulk = [asyncio.create_task(acquire(f"bulk{i}", Priority.BULK)) for i in range(3)]
+    await asyncio.sleep(0)
+    await acquire("reply", Priority.INTERACTIVE)
+    await asyncio.gather(*bulk)
+    # bulk0 is already waiting for tokens, the others are overtaken
+    assert done == ["bulk0", "reply", "bulk1", "bulk2"]
+
+
+async def test_cancel():
+    bucket = TokenBucket(20, burst=1)
+    await bucket.acquire()
+    task = asyncio.create_task(bucket.acquire())
+    await asyncio.sleep(0)
+    waiter = asyncio.create_task(bucket.acquire())
+    await asyncio.sleep(0)
+    waiter.cancel()
+    await task
+    # the cancelled waiter does not block the bucket
+    await asyncio.wait_for(bucket.acquire(), 1)
+
+
+async def test_middleware():
+    limiter = RateLimiter(chat_rate=10, chat_burst=1)
+    middleware = RateLimitMiddleware(limiter)
+    loop = asyncio.get_running_loop()
+
+    async def make_request(bot, method):
+        return True
+
+    start = loop.time()
+    for _ in range(3):
+        await middleware(make_request, None, SendChatAction(chat_id=1, action="typing"))  # type: ignore
+        await middleware(make_request, None, AnswerCallbackQuery(callback_query_id="0"))  # type: ignore
+    assert loop.time() - start < 0.05
+
+    for _ in range(3):
+        await middleware(make_request, None, SendMessage(chat_id=1, text="a"))  # type: ignore
+    assert loop.time() - start >= 0.2
+
+    async def flood(bot, method):
+        raise TelegramRetryAfter(method, "flood", 1)
+
+    with pytest.raises(TelegramRetryAfter):
+        await middleware(flood, None, SendMessage(chat_id=2, text="a"))  # type: ignore
+    assert limiter.chats[2]._paused_until > loop.time()
@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError, TelegramRetryAfter
+
+from qzone3tg.bot.retry import CircuitBreaker, ErrorClass, RetryPolicy, classify
+
+
+def test_classify():
+    assert classify(asyncio.TimeoutError()) == ErrorClass.NETWORK
+    assert classify(TelegramNetworkError(None, "proxy")) == ErrorClass.NETWORK  # type: ignore
+    assert classify(TelegramRetryAfter(None, "flood", 1)) == ErrorClass.RETRY_AFTER  # type: ignore
+    bad = TelegramBadRequest(None, "Bad Request: failed to get HTTP URL content")  # type: ignore
+    assert classify(bad) == ErrorClass.PAYLOAD
+    bad = TelegramBadRequest(None, "Bad Request: chat not found")  # type: ignore
+    assert classify(bad) == ErrorClass.PERMANENT
+    assert classify(RuntimeError()) == ErrorClass.PERMANENT
+
+
+def test_policy():
+    policy = RetryPolicy({ErrorClass.NETWORK: 3}, backoff=1, max_backoff=3)
+    assert not policy.exhausted(ErrorClass.NETWORK, 2)
+    assert policy.exhausted(ErrorClass.NETWORK, 3)
+    assert policy.exhausted(ErrorClass.PERMANENT, 1)
+    assert not policy.exhausted(ErrorClass.RETRY_AFTER, 100)
+    assert [policy.wait(ErrorClass.NETWORK, i) for i in range(1, 4)] == [1, 2, 3]
+    assert policy.wait(ErrorClass.PAYLOAD, 1) == 0
+
+
+@pytest.mark.asyncio
+async def test_breaker():
+    breaker = CircuitBreaker(threshold=2, cooldown=0.1)
+    loop = asyncio.get_running_loop()
+    breaker.record(ErrorClass.NETWORK)
+    await breaker.wait()
+    breaker.record(ErrorClass.NETWORK)
+    assert breaker.is_open
+
+    # only one probe is let through after cooldown
+    start = loop.time()
+    waiters = [asyncio.create_task(breaker.wait()) for _ in range(3)]
+    done, pending = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+    assert loop.time() - start >= 0.1
+    assert len(done) == 1 and len(pending) == 2
+
+    # the probe fails, the cooldown is doubled
+    breaker.record(ErrorClass.NETWORK)
+    start = loop.time()
+    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    assert loop.time() - start >= 0.2
+    assert len(done) == 1
+
+    # the probe succeeds, all waiters go
+    breaker.record(None)
+    assert not breaker.is_open
+    await asyncio.wait_for(asyncio.gather(*pending), 0.1)
@@ -1,7 +1,8 @@
 from typing import Callable
 
 import pytest
-from aiogram.types import BufferedInputFile
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.utils.formatting import Text
 from qqqr.utils.net import ClientAdapter
 from qzemoji.utils import build_html
 
@@ -15,7 +16,8 @@ from qzone3tg.bot.atom import (
     PicAtom,
     TextAtom,
 )
-from qzone3tg.bot.splitter import FetchSplitter, LocalSplitter
+from qzone3tg.bot.cache import CachedInputFile
+from qzone3tg.bot.splitter import FetchSplitter, LocalSplitter, digest_atom, pack_digest
 
 from . import fake_feed, fake_media, invalid_media
 
@@ -127,7 +129,7 @@ class TestFetch:
         p = ps[0]
         assert isinstance(p, MediaGroupAtom)
         ipm = await fetch.force_bytes_inputmedia(p.builder._media[0])
-        assert isinstance(ipm.media, BufferedInputFile)
+        assert isinstance(ipm.media, CachedInputFile)
 
     async def test_force_bytes(self, fetch: FetchSplitter):
         f = fake_feed(0)
@@ -139,7 +141,30 @@ class TestFetch:
 
         p = await fetch.force_bytes(ps[0])
         for i in p.builder._media:
-            assert isinstance(i.media, BufferedInputFile)
+            assert isinstance(i.media, CachedInputFile)
 
         p = await fetch.force_bytes(ps[1])
-        assert isinstance(p.content, BufferedInputFile)
+        assert isinstance(p.content, CachedInputFile)
+
+
+class TestDigest:
+    async def test_pack(self):
+        texts = [Text("a" * 10)] * 5
+        assert pack_digest(texts, 3) == [[0, 1, 2], [3, 4]]
+        # "1. " + 10, then "\n\n2. " + 10
+        assert pack_digest(texts, 5, limit=28) == [[0, 1], [2, 3], [4]]
+        assert pack_digest([Text("a" * LIM_TXT)] * 2, 5) == [[0], [1]]
+
+    async def test_atom(self):
+        btn = lambda t: InlineKeyboardButton(text=t, callback_data=t)
+        atoms = [TextAtom(Text(str(i)), chat_id=1) for i in range(3)]
+        atoms[0].reply_markup = InlineKeyboardMarkup(inline_keyboard=[[btn("a"), btn("b")]])
+        atoms[2].reply_markup = InlineKeyboardMarkup(inline_keyboard=[[btn("a")], [btn("c")]])
+        atom = digest_atom(atoms)
+        assert atom.text and atom.text.render()[0] == "1. 0\n\n2. 1\n\n3. 2"
+        assert atom.kwds["chat_id"] == 1
+        assert isinstance(kbd := atom.reply_markup, InlineKeyboardMarkup)
+        assert [[b.text for b in r] for r in kbd.inline_keyboard] == [
+            ["1. a", "1. b"],
+            ["3. a", "3. c"],
+        ]
@@ -0,0 +1,101 @@
+from io import BytesIO
+
+import pytest
+from aiogram.enums import InputMediaType
+
+from qzone3tg.bot.cache import MediaCache
+from qzone3tg.bot.splitter import FetchSplitter
+from qzone3tg.bot.transcode import (
+    MAX_PHOTO_BYTES,
+    TranscodedInputFile,
+    Transcoder,
+    transcode_image,
+)
+
+from . import FakeClient, fake_media, invalid_media
+
+pytestmark = pytest.mark.asyncio
+
+
+def _image(w: int, h: int, fmt="PNG", **kw) -> bytes:
+    Image = pytest.importorskip("PIL.Image")
+    buf = BytesIO()
+    Image.effect_noise((w, h), 64).save(buf, fmt, **kw)
+    return buf.getvalue()
+
+
+def test_image():
+    r = transcode_image(_image(6000, 5000), max_side=2560)
+    assert r and len(r) <= MAX_PHOTO_BYTES
+    Image = pytest.importorskip("PIL.Image")
+    with Image.open(BytesIO(r)) as img:
+        assert img.format == "JPEG" and max(img.size) == 2560
+
+    # too narrow to be a photo
+    assert transcode_image(_image(100, 3000)) is None
+
+
+async def test_oversized():
+    assert not Transcoder.oversized(MAX_PHOTO_BYTES, 5000, 5000)
+    assert Transcoder.oversized(MAX_PHOTO_BYTES + 1)
+    assert Transcoder.oversized(None, 6000, 5000)
+
+
+async def test_transcoder():
+    data = _image(3000, 2000)
+    cache = MediaCache(FakeClient({}))  # type: ignore
+    transcoder = Transcoder(cache, max_workers=1)
+    try:
+        a = await transcoder(data)
+        assert a and await transcoder(data) == a
+        assert len(cache) == 1
+    finally:
+        transcoder.close()
+
+
+class FakeTranscoder(Transcoder):
+    def __init__(self, cache: MediaCache) -> None:
+        super().__init__(cache)
+        self.log: list[bytes] = []
+
+    async def __call__(self, data: bytes, digest: str | None = None) -> bytes | None:
+        self.log.append(data)
+        if digest:
+            await self.cache.put(self.key(digest), b"jpeg")
+        return b"jpeg"
+
+
+async def test_probe():
+    client = FakeClient({"big": b"big", "small": b"small", "huge": b"\0" * (MAX_PHOTO_BYTES + 1)})
+    cache = MediaCache(client, max_size=2**30)  # type: ignore
+    transcoder = FakeTranscoder(cache)
+    fetch = FetchSplitter(client, cache, sniff=True, transcoder=transcoder)  # type: ignore
+
+    # too large by metadata, or by size
+    for media in (invalid_media("big"), fake_media("huge")):
+        r = await fetch.probe(media)
+        assert r == b"jpeg"
+        assert fetch.guess_md_type(r) == InputMediaType.PHOTO
+        f = fetch.upload_source(media, r)
+        assert isinstance(f, TranscodedInputFile)
+        assert b"".join([i async for i in f.read(None)]) == b"jpeg"  # type: ignore
+    assert len(transcoder.log) == 2
+
+    r = await fetch.probe(fake_media("small"))
+    assert r == (b"small", 5)
+    assert len(transcoder.log) == 2
+
+
+async def test_evicted():
+    client = FakeClient({"big": b"big"})
+    cache = MediaCache(client, max_size=2**30)  # type: ignore
+    transcoder = FakeTranscoder(cache)
+    fetch = FetchSplitter(client, cache, sniff=True, transcoder=transcoder)  # type: ignore
+
+    media = invalid_media("big")
+    f = fetch.upload_source(media, await fetch.probe(media))
+    assert isinstance(f, TranscodedInputFile)
+    # evicted before sent, so it is transcoded again
+    cache._urls.pop(f.url)
+    assert b"".join([i async for i in f.read(None)]) == b"jpeg"  # type: ignore
+    assert transcoder.log == [b"big", b"big"]
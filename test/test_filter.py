@@ -0,0 +1,76 @@
+import pytest
+from aioqzone.model import AtEntity, TextEntity
+from aioqzone_feed.type import FeedContent
+
+from qzone3tg.app.filter import FeedFilter, FeedRouter, feed_text
+from qzone3tg.settings import FilterRule, RouteRule
+
+
+def feed(text: str = "", uin: int = 1, appid: int = 311, typeid: int = 0, nickname: str = ""):
+    return FeedContent(
+        entities=[TextEntity(con=text)],
+        appid=appid,
+        typeid=typeid,
+        fid="",
+        abstime=0,
+        uin=uin,
+        nickname=nickname,
+    )
+
+
+def test_empty_rule():
+    with pytest.raises(ValueError):
+        FilterRule()
+    # an empty keyword list would drop every feed
+    with pytest.raises(ValueError):
+        FilterRule(keywords=[])
+
+
+def test_feed_text():
+    f = feed("hello")
+    f.entities.append(AtEntity(nick="world", uin=2))  # type: ignore
+    assert feed_text(f) == "hello@world"
+
+
+def test_uin():
+    ff = FeedFilter([FilterRule(uin=[2])], uins=[3])
+    assert ff.match_many([feed(uin=1), feed(uin=2), feed(uin=3)]) == [False, True, True]
+
+
+def test_conditions():
+    ff = FeedFilter([FilterRule(uin=[1], appid=[202]), FilterRule(nickname="^bot_")])
+    assert ff.match(feed(uin=1, appid=202))
+    assert not ff.match(feed(uin=1, appid=311))
+    assert ff.match(feed(nickname="bot_1"))
+    assert not ff.match(feed(nickname="a bot_1"))
+
+
+def test_keywords():
+    ff = FeedFilter(
+        [
+            FilterRule(keywords=["广告", "ab"]),
+            FilterRule(keywords=["abc"], typeid=[1]),
+            FilterRule(keywords=["bcd"]),
+        ]
+    )
+    feeds = [
+        feed("这是一条广告"),
+        feed("xabcx"),  # "ab" is a prefix of "abc"
+        feed("abcd", typeid=1),  # "bcd" overlaps "abc"
+        feed("xbx"),
+        feed("cd"),  # keywords never span two feeds
+    ]
+    assert ff.match_many(feeds) == [True, True, True, False, False]
+    assert not FeedFilter().match(feed("广告"))
+
+
+def test_router():
+    router = FeedRouter(
+        [RouteRule(uin=[2], to=[10, 11]), RouteRule(keywords=["广告"], to=[12])], mirrors=[11, 13]
+    )
+    assert router.route(feed(uin=2), 0) == (10, 11, 13)
+    assert router.route(feed("广告"), 0) == (12, 11, 13)
+    assert router.route(feed(), 0) == (0, 11, 13)
+    assert FeedRouter().route(feed(), 0) == (0,)
+    with pytest.raises(ValueError):
+        RouteRule(to=[1])
@@ -1,10 +1,13 @@
+import asyncio
 from pathlib import Path
 from unittest import mock
 
 import pytest
 import pytest_asyncio
 import sqlalchemy as sa
+from aiogram.utils.formatting import Text
 from aioqzone.api import QrLoginConfig, UpLoginConfig
+from aioqzone.model import PersudoCurkey
 from qqqr.utils.net import ClientAdapter
 from qzemoji.base import AsyncEngineFactory
 from sqlalchemy.ext.asyncio import AsyncEngine
@@ -14,11 +17,16 @@ from qzone3tg.app.base import StorageMixin
 from qzone3tg.app.storage import FeedOrm, StorageMan
 from qzone3tg.app.storage.blockset import BlockSet
 from qzone3tg.app.storage.loginman import *
-from qzone3tg.app.storage.orm import CookieOrm, MessageOrm
+from qzone3tg.app.storage.migration import schema_version
+from qzone3tg.app.storage.orm import OUTBOX_SENT, CookieOrm, MessageOrm, OutboxOrm
+from qzone3tg.bot.atom import CopyAtom, TextAtom
+from qzone3tg.settings import SqliteProfile
+from qzone3tg.utils.batch import MicroBatcher, WriteBehind
 
 from . import fake_feed
 
 pytestmark = pytest.mark.asyncio
+CHAT = 100
 
 
 @pytest.fixture(scope="class")
@@ -70,30 +78,316 @@ class TestFeedStore:
 
     async def test_insert(self, app: StorageMixin, fixed: list):
         await app.SaveFeed(fixed[1])
-        await app.SaveFeed(fixed[2], [0])
+        await app.SaveFeed(fixed[2], [0], CHAT)
 
     async def test_exist(self, store: StorageMan, fixed: list):
         assert not await store.exists(*FeedOrm.primkey(fixed[0]))
         assert not await store.exists(*FeedOrm.primkey(fixed[1]))
         assert await store.exists(*FeedOrm.primkey(fixed[2]))
 
+    async def test_seen(self, store: StorageMan, fixed: list):
+        keys = [FeedOrm.key(i) for i in fixed]
+        assert [k in store.seen for k in keys] == [False, False, True]
+
+        await store.warm_seen()
+        hits = store.seen.hits
+        assert [k in store.seen for k in keys] == [False, False, True]
+        assert store.seen.hits == hits + 1
+
+    async def test_exist_many(self, store: StorageMan, fixed: list):
+        keys = [(i.uin, i.abstime) for i in fixed]
+        assert await store.exists_many(keys) == {keys[2]}
+        mids = await store.get_mids_many(keys)
+        assert mids == {keys[0]: [], keys[1]: [], keys[2]: [(CHAT, 0)]}
+
+    async def test_mid_batcher(self, store: StorageMan, fixed: list):
+        m = mock.AsyncMock(wraps=store.get_mids_many)
+        batcher = MicroBatcher(m)
+        r = await asyncio.gather(*(batcher.get((i.uin, i.abstime)) for i in fixed))
+        assert r == [[], [], [(CHAT, 0)]]
+        m.assert_called_once()
+
     async def test_update(self, store: StorageMan, fixed: list):
         pack = await store.get(*FeedOrm.primkey(fixed[1]))
         assert pack
         feed, mids = pack
         assert not mids
 
-    async def test_mid2feed(self, app: StorageMixin, fixed: list):
-        await app._update_message_ids(fixed[2], [1, 2])
-        feed = await app.Mid2Feed(1)
+    async def test_mid2feed(self, app: StorageMixin, store: StorageMan, fixed: list):
+        await app.SaveFeeds({FeedOrm.key(fixed[2]): (fixed[2], [(CHAT, 1), (CHAT, 2)])})
+        feed = await app.Mid2Feed(CHAT, 1)
         assert feed == fixed[2]
+        assert store.mid_cache.get((CHAT, 1)) == feed
+        assert await app.Mid2Feed(CHAT + 1, 1) is None
+
+    async def test_mid_collision(self, app: StorageMixin, store: StorageMan, fixed: list):
+        await app.SaveFeed(fixed[1], [1], CHAT + 1)
+        store.mid_cache.clear()
+        assert await app.Mid2Feed(CHAT, 1) == fixed[2]
+        assert await app.Mid2Feed(CHAT + 1, 1) == fixed[1]
+        assert len(await store.get_msg_orms(MessageOrm.mid == 1)) == 2
+        assert len(await store.get_msg_orms(MessageOrm.mid == 1, chat_id=CHAT)) == 1
+
+    async def test_mid_evict(self, app: StorageMixin, store: StorageMan, fixed: list):
+        assert await app.Mid2Feed(CHAT, 2) == fixed[2]
+        await app.SaveFeeds({FeedOrm.key(fixed[2]): (fixed[2], [(CHAT, 1), (CHAT, 3)])})
+        # replaced message ids are evicted, others are kept
+        assert store.mid_cache.get((CHAT, 2)) is None
+        assert store.mid_cache.get((CHAT, 1)) == fixed[2]
+        assert await app.Mid2Feed(CHAT, 2) is None
 
     async def test_remove(self, store: StorageMan, fixed: list):
-        await store.clean(0)  # clean all
+        assert await store.clean(0) == (2, 3)  # clean all
         assert not await store.exists(*FeedOrm.primkey(fixed[2]))
+        assert FeedOrm.key(fixed[2]) not in store.seen
+        assert not len(store.mid_cache)
         assert not await store.get_msg_orms(MessageOrm.mid == 1)
 
 
+class TestWriteBehind:
+    async def test_save_many(self, app: StorageMixin, store: StorageMan, fixed: list):
+        items = {FeedOrm.key(f): (f, [(CHAT, i)] if i else None) for i, f in enumerate(fixed)}
+        await app.SaveFeeds(items)
+        assert await store.exists_many(items) == set(list(items)[1:])
+
+        # update
+        await app.SaveFeeds({FeedOrm.key(fixed[1]): (fixed[1], [(CHAT, 3), (CHAT, 4)])})
+        mids = await store.get_mids_many(items)
+        assert mids[FeedOrm.key(fixed[1])] == [(CHAT, 3), (CHAT, 4)]
+        assert mids[FeedOrm.key(fixed[2])] == [(CHAT, 2)]
+
+        # message ids in other chats are kept
+        await app.SaveFeeds({FeedOrm.key(fixed[1]): (fixed[1], [(CHAT + 1, 5)])})
+        mids = await store.get_mids_many([FeedOrm.key(fixed[1])])
+        assert sorted(mids[FeedOrm.key(fixed[1])]) == [(CHAT, 3), (CHAT, 4), (CHAT + 1, 5)]
+        # a feed without message ids is not sent in any chat
+        await app.SaveFeeds({FeedOrm.key(fixed[1]): (fixed[1], None)})
+        assert not (await store.get_mids_many([FeedOrm.key(fixed[1])]))[FeedOrm.key(fixed[1])]
+
+    async def test_buffer(self, app: StorageMixin, store: StorageMan, fixed: list):
+        buffer = WriteBehind(app.SaveFeeds, max_size=2)
+        for i, f in enumerate(fixed):
+            buffer.push(FeedOrm.key(f), (f, [(CHAT, i + 10)]))
+        assert len(buffer) == 3
+        assert buffer.peek(FeedOrm.key(fixed[0])) == (fixed[0], [(CHAT, 10)])
+
+        await buffer.wait()
+        assert not len(buffer)
+        assert buffer.peek(FeedOrm.key(fixed[0])) is None
+        mids = await store.get_mids_many(FeedOrm.key(f) for f in fixed)
+        assert sorted(mid for _, mid in sum(mids.values(), [])) == [10, 11, 12]
+
+    async def test_retry(self, fixed: list):
+        written, failed = [], []
+
+        async def write(batch: dict):
+            if len(written) < 2:
+                written.append(None)
+                raise OSError
+            written.append(batch)
+
+        buffer = WriteBehind(write, backoff=0, on_error=failed.append)
+        buffer.push(FeedOrm.key(fixed[0]), fixed[0])
+        await buffer.wait()
+        assert written[-1] == {FeedOrm.key(fixed[0]): fixed[0]}
+        assert not failed
+
+        buffer.retries = 0
+        written.clear()
+        buffer.push(FeedOrm.key(fixed[1]), fixed[1])
+        await buffer.wait()
+        assert failed == [{FeedOrm.key(fixed[1]): fixed[1]}]
+        assert buffer.peek(FeedOrm.key(fixed[1])) is None
+
+    async def test_shared(self, app: StorageMixin, store: StorageMan):
+        msg = (CHAT + 2, 5)
+        feeds = [fake_feed(), fake_feed()]
+        await app.SaveFeeds({FeedOrm.key(f): (f, [msg], i) for i, f in enumerate(feeds, 1)})
+        mids = await store.get_mids_many(FeedOrm.key(f) for f in feeds)
+        assert all(m == [msg] for m in mids.values())
+        # feeds of a digest message are looked up by their labels
+        assert await app.Mid2Feed(*msg) is None
+        assert await app.Mid2Feed(*msg, 2) == feeds[1]
+        assert await app.Mid2Feed(*msg, 3) is None
+        assert msg not in store.mid_cache
+
+
+class TestOutbox:
+    async def test_put(self, store: StorageMan, fixed: list):
+        atoms = [TextAtom(Text(str(i)), chat_id=CHAT) for i in range(3)]
+        await store.outbox.put(fixed[0], [(fixed[0], atoms)])
+        await store.outbox.ack(atoms[0], [1])
+
+        chains = await store.outbox.pending()
+        assert len(chains) == 1
+        assert [p.mids for p in chains[0]] == [[1], None, None]
+        assert [p.atom.text.render()[0] for p in chains[0]] == ["0", "1", "2"]  # type: ignore
+        assert chains[0][0].feed.fid == fixed[0].fid
+
+        # loaded atoms can be acked
+        await store.outbox.ack(chains[0][1].atom, [2])
+        await store.outbox.wait()
+        async with store.sess() as sess:
+            r = await sess.scalars(sa.select(OutboxOrm.status).order_by(OutboxOrm.id))
+            assert list(r) == [OUTBOX_SENT, OUTBOX_SENT, 0]
+
+    async def test_batch(self, store: StorageMan, fixed: list):
+        atoms = [TextAtom(Text(str(i)), chat_id=CHAT) for i in range(3)]
+        with mock.patch.object(store.outbox, "_write", wraps=store.outbox._write) as m:
+            store.outbox.buffer.write = m
+            await store.outbox.put(fixed[1], [(fixed[1], atoms)])
+            for i, atom in enumerate(atoms):
+                await store.outbox.ack(atom, [i])
+            await store.outbox.wait()
+        # puts and acks are written in one transaction
+        m.assert_called_once()
+        chains = await store.outbox.pending()
+        assert [p.mids for p in chains[-1]] == [[0], [1], [2]]
+        await store.outbox.discard([FeedOrm.key(fixed[1])])
+
+    async def test_copy(self, store: StorageMan, fixed: list):
+        await store.outbox.put(fixed[2], [(fixed[2], [TextAtom(Text("1"), chat_id=CHAT)])])
+        await store.outbox.put(fixed[2], [(fixed[2], [CopyAtom(CHAT, [1], chat_id=CHAT + 1)])])
+        # copies are resumed apart from the uploaded chain
+        chains = await store.outbox.pending()
+        copy = next(c for c in chains if isinstance(c[0].atom, CopyAtom))
+        assert len(copy) == 1 and copy[0].atom.kwds["chat_id"] == CHAT + 1
+        await store.outbox.discard([FeedOrm.key(fixed[2])])
+
+    async def test_packed(self, store: StorageMan):
+        feeds = [fake_feed() for _ in range(3)]
+        chain = [(f, [TextAtom(Text(str(i)), chat_id=CHAT)]) for i, f in enumerate(feeds)]
+        await store.outbox.put(feeds[0], chain, packed=True)
+        chains = await store.outbox.pending()
+        assert [p.line for p in chains[-1]] == [1, 2, 3]
+        await store.outbox.discard([FeedOrm.key(f) for f in feeds])
+
+    async def test_save(self, app: StorageMixin, store: StorageMan, fixed: list):
+        await app.SaveFeeds({FeedOrm.key(fixed[0]): (fixed[0], [(CHAT, 1), (CHAT, 2)])})
+        assert not await store.outbox.pending()
+
+    async def test_discard(self, store: StorageMan, fixed: list):
+        await store.outbox.put(fixed[1], [(fixed[1], [TextAtom(Text("1"), chat_id=CHAT)])])
+        await store.outbox.discard([FeedOrm.key(fixed[1])])
+        assert not await store.outbox.pending()
+
+
+class TestFileId:
+    async def test_put(self, store: StorageMan):
+        await store.file_ids.put({"photo:a": "1", "photo:b": "2"})
+        assert store.file_ids.ids["photo:a"] == "1"
+        # loaded from database
+        store.file_ids.ids.clear()
+        await store.file_ids.create()
+        assert store.file_ids.ids == {"photo:a": "1", "photo:b": "2"}
+
+    async def test_clean(self, store: StorageMan):
+        assert await store.file_ids.clean(-86400) == 0
+        assert await store.file_ids.clean(2**40) == 2
+        assert not store.file_ids.ids
+
+
+@pytest_asyncio.fixture(scope="class")
+async def legacy_engine():
+    db = Path("tmp/legacy.db")
+    db.unlink(missing_ok=True)
+    async with AsyncEngineFactory.sqlite3(db) as engine:
+        async with engine.begin() as conn:
+            for sql in [
+                "CREATE TABLE feed (fid VARCHAR NOT NULL, uin INTEGER NOT NULL, "
+                "abstime INTEGER NOT NULL, appid INTEGER NOT NULL, curkey VARCHAR, unikey VARCHAR,"
+                ' typeid INTEGER NOT NULL, "topicId" VARCHAR NOT NULL, nickname VARCHAR NOT NULL, '
+                "PRIMARY KEY (uin, abstime))",
+                "CREATE TABLE message (mid INTEGER NOT NULL, uin INTEGER NOT NULL, "
+                "abstime INTEGER NOT NULL, PRIMARY KEY (mid), "
+                "FOREIGN KEY(uin) REFERENCES feed (uin), "
+                "FOREIGN KEY(abstime) REFERENCES feed (abstime))",
+                "INSERT INTO feed VALUES ('fid', 1, 100, 311, NULL, NULL, 0, '', 'nick')",
+                "INSERT INTO message VALUES (1, 1, 100), (2, 1, 100), (3, 2, 200)",
+            ]:
+                await conn.execute(sa.text(sql))
+        yield engine
+    db.unlink(missing_ok=True)
+
+
+class TestMigration:
+    async def test_migrate(self, legacy_engine: AsyncEngine):
+        store = StorageMan(legacy_engine)
+        with pytest.raises(ValueError):
+            await store.create()
+        await store.create(default_chat_id=CHAT)
+
+        async with legacy_engine.connect() as conn:
+            assert await conn.scalar(sa.text("PRAGMA user_version")) == schema_version()
+            indexes = await conn.run_sync(lambda c: sa.inspect(c).get_indexes("message"))
+            assert any(i["column_names"] == ["uin", "abstime"] for i in indexes)
+            pk = await conn.run_sync(lambda c: sa.inspect(c).get_pk_constraint("message"))
+            assert pk["constrained_columns"] == ["chat_id", "mid", "line"]
+
+        # orphan message is dropped
+        mids = await store.get_mids_many([(1, 100), (2, 200)])
+        assert mids == {(1, 100): [(CHAT, 1), (CHAT, 2)], (2, 200): []}
+        assert (1, 100) in store.seen
+
+    async def test_cascade(self, legacy_engine: AsyncEngine):
+        store = StorageMan(legacy_engine)
+        async with legacy_engine.begin() as conn:
+            await conn.execute(
+                sa.delete(FeedOrm).where(*FeedOrm.primkey(PersudoCurkey(uin=1, abstime=100)))
+            )
+        assert not await store.get_msg_orms(MessageOrm.uin == 1)
+
+
+async def test_digest_line():
+    db = Path("tmp/digest.db")
+    db.unlink(missing_ok=True)
+    async with AsyncEngineFactory.sqlite3(db) as engine:
+        async with engine.begin() as conn:
+            for sql in [
+                "CREATE TABLE feed (fid VARCHAR NOT NULL, uin INTEGER NOT NULL, "
+                "abstime INTEGER NOT NULL, appid INTEGER NOT NULL, curkey VARCHAR, unikey VARCHAR,"
+                ' typeid INTEGER NOT NULL, "topicId" VARCHAR NOT NULL, nickname VARCHAR NOT NULL, '
+                "PRIMARY KEY (uin, abstime))",
+                "CREATE TABLE message (chat_id INTEGER NOT NULL, mid INTEGER NOT NULL, "
+                "uin INTEGER NOT NULL, abstime INTEGER NOT NULL, PRIMARY KEY (chat_id, mid))",
+                "CREATE TABLE outbox (id INTEGER NOT NULL, head_uin INTEGER NOT NULL, "
+                "head_abstime INTEGER NOT NULL, uin INTEGER NOT NULL, abstime INTEGER NOT NULL, "
+                "chat_id INTEGER NOT NULL, payload JSON NOT NULL, status INTEGER NOT NULL, "
+                "mids JSON, PRIMARY KEY (id))",
+                "INSERT INTO feed VALUES ('a', 1, 200, 311, NULL, NULL, 0, '', 'nick')",
+                "INSERT INTO message VALUES (0, 1, 1, 200), (0, 2, 1, 200)",
+                "PRAGMA user_version = 3",
+            ]:
+                await conn.execute(sa.text(sql))
+        store = StorageMan(engine)
+        await store.create()
+
+        async with engine.connect() as conn:
+            assert await conn.scalar(sa.text("PRAGMA user_version")) == schema_version()
+            cols = await conn.run_sync(lambda c: sa.inspect(c).get_columns("outbox"))
+            assert "line" in {c["name"] for c in cols}
+        # existing messages are not digests
+        r = await store.get_msg_orms(MessageOrm.chat_id == 0)
+        assert sorted((m.mid, m.line) for m in r) == [(1, 0), (2, 0)]
+        assert not await store.outbox.pending()
+    db.unlink(missing_ok=True)
+
+
+async def test_profile():
+    db = Path("tmp/profile.db")
+    db.unlink(missing_ok=True)
+    async with AsyncEngineFactory.sqlite3(db) as engine:
+        StorageMan.apply_profile(engine, SqliteProfile(synchronous="OFF"))
+        store = StorageMan(engine)
+        await store.create()
+        pragmas = await store.pragmas()
+        assert pragmas["journal_mode"] == "wal"
+        assert pragmas["synchronous"] == 0
+        assert pragmas["foreign_keys"] == 1
+        assert await store.checkpoint()
+    db.unlink(missing_ok=True)
+
+
 class TestCookieStore:
     async def test_loginman_miss(self, login: LoginManager):
         cookie = dict(errno="12")
@@ -158,16 +452,35 @@ class TestBlockSet:
         await blockset.add(1)
 
     async def test_contains(self, blockset: BlockSet):
-        assert await blockset.contains(1)
+        assert 1 in blockset
+        # loaded from database
+        await blockset.create()
+        assert 1 in blockset
 
     async def test_delete(self, blockset: BlockSet):
-        await blockset.delete(1)
-        assert not await blockset.contains(1)
+        assert await blockset.delete(1)
+        assert 1 not in blockset
+        assert not await blockset.delete(1)
 
     async def test_list(self, blockset: BlockSet):
         async with blockset.sess() as sess:
             await blockset.add(1, sess=sess, flush=False)
             await blockset.add(2, sess=sess, flush=False)
+            assert 1 not in blockset
             await blockset.add(3, sess=sess, flush=True)
 
         assert [1, 2, 3] == sorted(await blockset.all())
+        assert len(blockset) == 3
+
+    async def test_rollback(self, blockset: BlockSet):
+        async with blockset.sess() as sess:
+            await blockset.add(4, sess=sess, flush=False)
+            await sess.rollback()
+            await blockset.add(5, sess=sess, flush=True)
+
+        assert 4 not in blockset and 5 in blockset
+        assert 4 not in await blockset.all()
+
+    async def test_concurrent(self, blockset: BlockSet):
+        await asyncio.gather(blockset.add(6), blockset.add(6))
+        assert 6 in blockset